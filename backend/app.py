@@ -1,35 +1,60 @@
-from flask import Flask, jsonify, request, send_file
+from flask import Flask, Response, g, jsonify, request, send_file, stream_with_context
 from flask_cors import CORS
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.datastructures import FileStorage
+from werkzeug.middleware.proxy_fix import ProxyFix
 from datetime import datetime, timedelta
-import jwt
-import requests
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
 import os
+import json
+import itertools
+import shutil
+from collections import Counter
 from dotenv import load_dotenv
-from openpyxl import Workbook
-from io import BytesIO, StringIO
-import csv
-from reportlab.lib.pagesizes import A4
-from reportlab.lib import colors
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
-from reportlab.lib.units import cm
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.cidfonts import UnicodeCIDFont
-
-from models import db, Customer, Order, OrderItem, Admin, User, BookCache, BookSelectionList, BookSelectionItem, WishlistItem
+
+from models import db, Customer, Order, Admin, User, BookCache, BookSelectionList, BookSelectionItem, WishlistItem, Job
+from search_index import filter_by_text
+from facets import GENRES, TARGET_AUDIENCES, facet_conditions, filter_options, overall_facets, search_facets
+from serializers import apply_load_plan
+from pagination import parse_page_args, keyset_page, project
+from books_client import BooksClient, CircuitOpenError
+from book_cache import BookCachePolicy, upsert_books
+from migrations import run_migrations
+from isbn import canonical_isbn, looks_like_isbn
+from selection_lists import add_items
+from importers import ImportFormatError, iter_sheet_rows, import_rows
+from orders import OrderValidationError, create_orders
+from idempotency import IDEMPOTENCY_HEADER, MAX_KEY_LENGTH, IdempotencyConflict, request_fingerprint, saved_response, save_response
+from pdf_render import PdfRenderer
+from exports import WRITERS, ExportCache, OrderItemSource, SelectionListSource, TrackedSource, export_key, parse_order_filters
+from jobs import JobQueue
+from auth import Authenticator, bearer_token, current_user
+from credentials import CredentialsBusy, LoginRateLimiter, PasswordHasher
+from query_plans import check_query_plans
+from database import REPLICA_BIND, DatabaseConfig, normalize_url, read_replica, replica_reads, write_intent, write_transaction
 
 load_dotenv()
 
 app = Flask(__name__)
 
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'your-secret-key')
-app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///database.db')
+app.config['SQLALCHEMY_DATABASE_URI'] = normalize_url(os.getenv('DATABASE_URL', 'sqlite:///database.db'))
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# 接続プールと SQLite の PRAGMA（WAL など）
+db_config = DatabaseConfig.from_env()
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = db_config.engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+# リードレプリカ（@read_replica を付けたルートの SELECT を送る）
+if os.getenv('DATABASE_REPLICA_URL'):
+    replica_url = normalize_url(os.getenv('DATABASE_REPLICA_URL'))
+    app.config['SQLALCHEMY_BINDS'] = {REPLICA_BIND: dict(db_config.engine_options(replica_url), url=replica_url)}
 
 # CORS設定 - シンプル版
 CORS(app)
 
+# リバースプロキシ（Render など）の後ろでは X-Forwarded-For からクライアントの IP アドレスを得る
+if int(os.getenv('TRUSTED_PROXY_COUNT', 0)):
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=int(os.getenv('TRUSTED_PROXY_COUNT')))
+
 # すべてのOPTIONSリクエストに対応
 @app.before_request
 def handle_preflight():
@@ -37,106 +62,185 @@ def handle_preflight():
         response = jsonify({'status': 'ok'})
         response.headers['Access-Control-Allow-Origin'] = '*'
         response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
-        response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, Idempotency-Key'
         return response, 200
 
 @app.after_request
 def after_request(response):
     response.headers['Access-Control-Allow-Origin'] = '*'
-    response.headers['Access-Control-Allow-Headers'] = 'Content-Type,Authorization'
+    response.headers['Access-Control-Allow-Headers'] = 'Content-Type,Authorization,Idempotency-Key'
     response.headers['Access-Control-Allow-Methods'] = 'GET,POST,PUT,DELETE,OPTIONS'
     return response
 
 db.init_app(app)
 
-GOOGLE_BOOKS_API_KEY = os.getenv('GOOGLE_BOOKS_API_KEY', '')
+# Google Books API クライアント（接続プール・重複呼び出しの集約・再試行）
+books_client = BooksClient.from_env()
 
-with app.app_context():
-    db.create_all()
+# パスワードのハッシュ計算（プロセスプール）とログインの試行回数制限
+password_hasher = PasswordHasher.from_env()
+password_hasher.start()
+login_limiter = LoginRateLimiter.from_env()
+
+def init_database():
+    """マイグレーションを適用し、初期の管理者アカウントを作成する"""
+    run_migrations()
     admin_username = os.getenv('ADMIN_USERNAME', 'admin')
     admin_password = os.getenv('ADMIN_PASSWORD', 'admin123')
     if not Admin.query.filter_by(username=admin_username).first():
-        admin = Admin(username=admin_username, password_hash=generate_password_hash(admin_password))
+        admin = Admin(username=admin_username, password_hash=password_hasher.hash(admin_password))
         db.session.add(admin)
         db.session.commit()
         print(f"管理者アカウントを作成しました: {admin_username}")
 
-def generate_token(admin_id):
-    payload = {'admin_id': admin_id, 'exp': datetime.utcnow() + timedelta(days=7)}
-    return jwt.encode(payload, app.config['SECRET_KEY'], algorithm='HS256')
+@app.cli.command('migrate')
+def migrate_command():
+    """データベースを初期化・更新する（flask --app app migrate）"""
+    init_database()
 
-def verify_token(token):
-    try:
-        payload = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
-        return payload['admin_id']
-    except:
-        return None
+@app.cli.command('check-indexes')
+def check_indexes_command():
+    """よく使うクエリがインデックスを使っているかを EXPLAIN で確認する（flask --app app check-indexes）"""
+    failed = 0
+    for name, index_name, used, plan in check_query_plans(db.engine):
+        print(f"{'OK ' if used else 'NG '} {name}: {index_name}")
+        if not used:
+            failed += 1
+            for line in plan:
+                print(f"      {line}")
+    if failed:
+        raise SystemExit(1)
+
+with app.app_context():
+    for engine in db.engines.values():
+        db_config.install(engine)
+    # 複数のプロセスで起動する場合は RUN_MIGRATIONS=0 にし、デプロイ時に `flask --app app migrate` を実行する
+    if os.getenv('RUN_MIGRATIONS', '1') != '0':
+        init_database()
+
+# 検証済みのトークンをキャッシュする認証（ルートには @auth.user_required / @auth.admin_required を付ける）
+auth = Authenticator.from_env(app.config['SECRET_KEY'])
+
+def generate_token(admin_id):
+    return auth.issue({'admin_id': admin_id}, timedelta(days=7))
 
 def generate_user_token(user_id):
-    payload = {'user_id': user_id, 'exp': datetime.utcnow() + timedelta(days=30)}
-    return jwt.encode(payload, app.config['SECRET_KEY'], algorithm='HS256')
+    return auth.issue({'user_id': user_id}, timedelta(days=30))
 
-def verify_user_token(token):
-    try:
-        payload = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
-        return payload['user_id']
-    except:
-        return None
+def fetch_google_books(query=None, isbn=None):
+    """Google Books API で検索し、結果をキャッシュに登録する（失敗時は例外を送出）"""
+    # 上流への問い合わせの間、キャッシュを読んだトランザクションを開いたままにしない
+    # （その間にほかの接続がコミットすると、同じトランザクションでの書き込みが待たずに失敗する）
+    db.session.commit()
+    if isbn:
+        data = books_client.lookup_isbn(isbn)
+    elif query:
+        data = books_client.search_volumes(query, max_results=10)
+    else:
+        return []
+    
+    books = []
+    if 'items' in data:
+        for item in data['items']:
+            volume_info = item.get('volumeInfo', {})
+            # ISBN-13 を優先し、ISBN-10 しかない場合も ISBN-13 に揃える
+            identifiers = {
+                identifier.get('type'): identifier.get('identifier')
+                for identifier in volume_info.get('industryIdentifiers', [])
+            }
+            raw_isbn = identifiers.get('ISBN_13') or identifiers.get('ISBN_10')
+            book_isbn = canonical_isbn(raw_isbn) or raw_isbn
+            
+            book = {
+                'isbn': book_isbn,
+                'title': volume_info.get('title', ''),
+                'author': ', '.join(volume_info.get('authors', [])),
+                'publisher': volume_info.get('publisher', ''),
+                'published_date': volume_info.get('publishedDate', ''),
+                'thumbnail': volume_info.get('imageLinks', {}).get('thumbnail', ''),
+                'description': volume_info.get('description', '')
+            }
+            books.append(book)
+        
+        # 取得結果をまとめてキャッシュに登録・更新する
+        with write_intent():
+            upsert_books(books)
+            db.session.commit()
+    return books
 
 def search_google_books(query=None, isbn=None):
     try:
-        if isbn:
-            url = f"https://www.googleapis.com/books/v1/volumes?q=isbn:{isbn}"
-        elif query:
-            url = f"https://www.googleapis.com/books/v1/volumes?q={query}&maxResults=10"
-        else:
-            return []
-        
-        if GOOGLE_BOOKS_API_KEY:
-            url += f"&key={GOOGLE_BOOKS_API_KEY}"
-        
-        response = requests.get(url, timeout=5)
-        response.raise_for_status()
-        data = response.json()
-        
-        books = []
-        if 'items' in data:
-            for item in data['items']:
-                volume_info = item.get('volumeInfo', {})
-                book_isbn = None
-                for identifier in volume_info.get('industryIdentifiers', []):
-                    if identifier.get('type') in ['ISBN_13', 'ISBN_10']:
-                        book_isbn = identifier.get('identifier')
-                        break
-                
-                book = {
-                    'isbn': book_isbn,
-                    'title': volume_info.get('title', ''),
-                    'author': ', '.join(volume_info.get('authors', [])),
-                    'publisher': volume_info.get('publisher', ''),
-                    'thumbnail': volume_info.get('imageLinks', {}).get('thumbnail', ''),
-                    'description': volume_info.get('description', '')
-                }
-                books.append(book)
-                
-                if book_isbn and not BookCache.query.filter_by(isbn=book_isbn).first():
-                    cached_book = BookCache(
-                        isbn=book_isbn,
-                        title=book['title'],
-                        author=book['author'],
-                        publisher=book['publisher'],
-                        thumbnail=book['thumbnail'],
-                        description=book['description']
-                    )
-                    db.session.add(cached_book)
-            db.session.commit()
-        return books
+        return fetch_google_books(query=query, isbn=isbn)
+    except CircuitOpenError:
+        # 上流が不安定な間はキャッシュの結果のみを返す
+        return []
     except Exception as e:
         print(f"Google Books API エラー: {str(e)}")
         db.session.rollback()
         return []
 
+# BookCache の有効期限・先読み更新・削除
+cache_policy = BookCachePolicy.from_env()
+BATCH_LOOKUP_MAX = int(os.getenv('BATCH_LOOKUP_MAX', 1000))
+cache_policy.start(app, refresh=lambda isbn: search_google_books(isbn=isbn))
+
+# エクスポート結果のキャッシュと注文書 PDF の生成キュー
+export_cache = ExportCache.from_env()
+pdf_renderer = PdfRenderer.from_env(export_cache)
+# 重い処理のバックグラウンドジョブ（処理関数を登録した後、ファイルの末尾で開始する）
+job_queue = JobQueue.from_env()
+
+def _with_etag(response, etag):
+    response.set_etag(etag)
+    # 認証が必要なデータなので共有キャッシュには置かせず、毎回検証させる
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def send_export(source, fmt, download_name, **options):
+    """エクスポートを返す
+
+    データが変わっていなければ保存済みの結果を返し、If-None-Match が一致すれば 304 を返す。
+    """
+    writer = WRITERS[fmt]
+    key = export_key(source, fmt, **options)
+    if request.if_none_match.contains(key):
+        return _with_etag(Response(status=304), key)
+    
+    path = export_cache.get(key, writer.extension)
+    if path is None and writer.streaming:
+        # 初回はストリーミングで返しながら保存する
+        chunks = export_cache.store_stream(key, writer.extension, writer.iter_bytes(source, **options))
+        response = Response(stream_with_context(chunks), mimetype=writer.mimetype,
+                            headers={'Content-Disposition': f'attachment; filename={download_name}'})
+        return _with_etag(response, key)
+    if path is None:
+        path = export_cache.store(key, writer.extension, lambda output: writer.write(source, output, **options))
+    response = send_file(path, mimetype=writer.mimetype, as_attachment=True,
+                         download_name=download_name, conditional=False)
+    return _with_etag(response, key)
+
+def _wants_async():
+    """?async=1 の場合はリクエスト内で処理せず、ジョブとして登録する"""
+    return request.args.get('async') in ('1', 'true')
+
+def _job_accepted(job_id):
+    return jsonify({
+        'job_id': job_id,
+        'status': 'queued',
+        'status_url': f'/api/jobs/{job_id}',
+        'result_url': f'/api/jobs/{job_id}/result'
+    }), 202
+
+def _enqueue_export(owner, source, fmt, download_name, **options):
+    """エクスポートをジョブとして登録する。source は供給元を組み立てるための値"""
+    params = dict(source, format=fmt, download_name=download_name, options=options)
+    return _job_accepted(job_queue.enqueue('export', params, owner))
+
+def _order_filter_args():
+    return {key: request.args[key] for key in ('start_date', 'end_date', 'status') if request.args.get(key)}
+
 @app.route('/api/books/search', methods=['POST', 'OPTIONS'])
+@read_replica
 def search_books_api():
     if request.method == 'OPTIONS':
         return jsonify({'status': 'ok'}), 200
@@ -148,90 +252,52 @@ def search_books_api():
     if not query:
         return jsonify({'error': '検索キーワードを入力してください'}), 400
     
-    is_isbn = query.replace('-', '').isdigit() and len(query.replace('-', '')) in [10, 13]
+    is_isbn = looks_like_isbn(query)
     books = []
+    facets = None
     
     if is_isbn:
-        cached = BookCache.query.filter_by(isbn=query).first()
-        if cached:
-            books = [cached.to_dict()]
-        if not books:
-            books = search_google_books(isbn=query)
+        book = cache_policy.get_book(query, fetch=lambda isbn: fetch_google_books(isbn=isbn))
+        if book:
+            books = [book]
     else:
-        # キャッシュから検索
-        cache_query = BookCache.query
-        
-        # テキスト検索
-        if query:
-            cache_query = cache_query.filter(
-                (BookCache.title.contains(query)) |
-                (BookCache.author.contains(query)) |
-                (BookCache.publisher.contains(query))
-            )
-        
-        # フィルタリング
-        if filters.get('target_audience'):
-            cache_query = cache_query.filter(BookCache.target_audience == filters['target_audience'])
+        # キャッシュから検索（全文検索インデックスを使用し、関連度順に並べる）
+        text_query = filter_by_text(BookCache.query, query)
         
-        if filters.get('genre'):
-            cache_query = cache_query.filter(BookCache.genre == filters['genre'])
-        
-        if filters.get('price_min'):
-            cache_query = cache_query.filter(BookCache.price >= filters['price_min'])
-        
-        if filters.get('price_max'):
-            cache_query = cache_query.filter(BookCache.price <= filters['price_max'])
+        # フィルタリング（利用対象・ジャンル・出版社・価格）
+        try:
+            conditions = facet_conditions(BookCache, filters)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        cache_query = text_query
+        for facet_filters in conditions.values():
+            cache_query = cache_query.filter(*facet_filters)
         
         cached_books = cache_query.limit(20).all()
         books = [book.to_dict() for book in cached_books]
+        # 絞り込みの候補ごとの件数（キャッシュ内の書籍のみ）
+        facets = search_facets(text_query, filters)
         
         # キャッシュに十分な結果がない場合はGoogle Books APIも使用
         if len(books) < 5:
             google_books = search_google_books(query=query)
             books.extend(google_books)
     
-    return jsonify({'books': books}), 200
+    return jsonify({'books': books, 'facets': facets}), 200
 
 @app.route('/api/books/filters', methods=['GET', 'OPTIONS'])
+@read_replica
 def get_search_filters():
-    """検索フィルタの選択肢を取得"""
-    if request.method == 'OPTIONS':
-        return jsonify({'status': 'ok'}), 200
-    
-    # 利用対象の選択肢
-    target_audiences = [
-        '未就学',
-        '小学校低学年',
-        '小学校中学年', 
-        '小学校高学年',
-        '中学生',
-        '高校生',
-        '一般',
-        '教員',
-        '保護者'
-    ]
-    
-    # ジャンルの選択肢
-    genres = [
-        '事典・辞書',
-        '国際理解',
-        '社会科',
-        '理科・科学',
-        '読み物',
-        'ノンフィクション',
-        '伝記・偉人',
-        '歴史',
-        '地理',
-        '環境・自然',
-        '平和・戦争',
-        '教師用',
-        '特別支援用',
-        'その他'
-    ]
+    """検索フィルタの選択肢と、キャッシュ全体での件数を取得"""
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'ok'}), 200
     
+    # 件数は書籍の変更に合わせて更新している集計表から読む（BookCache は走査しない）
+    facets = overall_facets()
     return jsonify({
-        'target_audiences': target_audiences,
-        'genres': genres
+        'target_audiences': filter_options(TARGET_AUDIENCES, facets['target_audience'] if facets else []),
+        'genres': filter_options(GENRES, facets['genre'] if facets else []),
+        'facets': facets
     }), 200
 
 @app.route('/api/books/<isbn>', methods=['GET', 'OPTIONS'])
@@ -239,69 +305,122 @@ def get_book_detail(isbn):
     if request.method == 'OPTIONS':
         return jsonify({'status': 'ok'}), 200
     
-    cached = BookCache.query.filter_by(isbn=isbn).first()
-    if cached:
-        return jsonify(cached.to_dict()), 200
-    books = search_google_books(isbn=isbn)
-    if books:
-        return jsonify(books[0]), 200
+    # メモリキャッシュ → BookCache → Google Books の順に探す
+    book = cache_policy.get_book(isbn, fetch=lambda isbn: fetch_google_books(isbn=isbn))
+    if book:
+        return jsonify(book), 200
     return jsonify({'error': '書籍が見つかりませんでした'}), 404
 
+@app.route('/api/books/batch', methods=['POST', 'OPTIONS'])
+def get_books_batch():
+    """複数の ISBN をまとめて検索し、結果を NDJSON で1件ずつ返す"""
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'ok'}), 200
+    
+    data = request.get_json() or {}
+    isbns = data.get('isbns')
+    if not isinstance(isbns, list) or not isbns:
+        return jsonify({'error': 'isbns に ISBN のリストを指定してください'}), 400
+    if len(isbns) > BATCH_LOOKUP_MAX:
+        return jsonify({'error': f'一度に検索できるのは {BATCH_LOOKUP_MAX} 件までです'}), 400
+    
+    if _wants_async():
+        # 結果を取り出すために認証が必要
+        owner = _job_owner()
+        if not owner:
+            return jsonify({'error': '認証が必要です'}), 401
+        return _job_accepted(job_queue.enqueue('books_batch', {'isbns': [str(isbn) for isbn in isbns]}, owner))
+    
+    def generate():
+        results = cache_policy.iter_books([str(isbn) for isbn in isbns],
+                                          fetch=lambda isbn: fetch_google_books(isbn=isbn))
+        for isbn, status, book in results:
+            yield json.dumps({'isbn': isbn, 'status': status, 'book': book}, ensure_ascii=False) + '\n'
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+# 一括注文で一度に登録できる件数
+ORDER_BATCH_MAX = int(os.getenv('ORDER_BATCH_MAX', 500))
+
 @app.route('/api/orders', methods=['POST', 'OPTIONS'])
+@write_transaction
 def create_order():
     if request.method == 'OPTIONS':
         return jsonify({'status': 'ok'}), 200
     
     try:
-        data = request.get_json()
-        customer_data = data.get('customer', {})
-        customer_name = customer_data.get('name')
-        if not customer_name:
-            return jsonify({'error': '顧客名は必須です'}), 400
-        
-        customer = Customer.query.filter_by(
-            name=customer_name,
-            email=customer_data.get('email')
-        ).first()
-        
-        if not customer:
-            customer = Customer(
-                name=customer_name,
-                email=customer_data.get('email'),
-                phone=customer_data.get('phone'),
-                organization=customer_data.get('organization')
-            )
-            db.session.add(customer)
-            db.session.flush()
-        
-        order = Order(
-            customer_id=customer.id,
-            notes=data.get('notes', ''),
-            total_items=len(data.get('items', []))
-        )
-        db.session.add(order)
-        db.session.flush()
-        
-        for item_data in data.get('items', []):
-            item = OrderItem(
-                order_id=order.id,
-                isbn=item_data.get('isbn'),
-                title=item_data.get('title'),
-                author=item_data.get('author'),
-                publisher=item_data.get('publisher'),
-                quantity=item_data.get('quantity', 1),
-                thumbnail=item_data.get('thumbnail')
-            )
-            db.session.add(item)
-        
-        db.session.commit()
-        return jsonify({'message': '注文が完了しました', 'order_id': order.id}), 201
+        data = request.get_json() or {}
+        return submit_orders('orders', data, [data],
+                             lambda order_ids: {'message': '注文が完了しました', 'order_id': order_ids[0]})
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/orders/batch', methods=['POST', 'OPTIONS'])
+@write_transaction
+def create_orders_batch():
+    """複数の注文を1トランザクションで登録する（1件でも不正なら何も登録しない）"""
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'ok'}), 200
+    
+    try:
+        data = request.get_json() or {}
+        payloads = data.get('orders')
+        if not isinstance(payloads, list) or not payloads:
+            return jsonify({'error': 'orders に注文の配列を指定してください'}), 400
+        if len(payloads) > ORDER_BATCH_MAX:
+            return jsonify({'error': f'一度に登録できる注文は{ORDER_BATCH_MAX}件までです'}), 400
+        return submit_orders('orders_batch', data, payloads,
+                             lambda order_ids: {'message': f'{len(order_ids)}件の注文が完了しました', 'order_ids': order_ids})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+def _replay(saved):
+    body, status_code = saved
+    response = jsonify(body)
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response, status_code
+
+def submit_orders(scope, payload, payloads, make_body):
+    """注文を登録してレスポンスを返す
+
+    Idempotency-Key ヘッダーがあれば、同じキーでの再送には最初のレスポンスを返す。
+    """
+    key = request.headers.get(IDEMPOTENCY_HEADER, '').strip()
+    if len(key) > MAX_KEY_LENGTH:
+        return jsonify({'error': f'冪等キーは{MAX_KEY_LENGTH}文字以内で指定してください'}), 400
+    fingerprint = request_fingerprint(payload)
+    if key:
+        try:
+            saved = saved_response(scope, key, fingerprint)
+        except IdempotencyConflict as e:
+            return jsonify({'error': str(e)}), 422
+        if saved:
+            return _replay(saved)
+    
+    try:
+        order_ids = create_orders(payloads)
+    except OrderValidationError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e), 'errors': e.errors}), 400
+    body = make_body(order_ids)
+    if key:
+        save_response(scope, key, fingerprint, body, 201)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # 同じキーの並行リクエストが先にコミットした場合はその結果を返す
+        db.session.rollback()
+        saved = saved_response(scope, key, fingerprint) if key else None
+        if saved is None:
+            raise
+        return _replay(saved)
+    return jsonify(body), 201
+
 # ユーザー認証API
 @app.route('/api/register', methods=['POST', 'OPTIONS'])
+@write_transaction
 def user_register():
     if request.method == 'OPTIONS':
         return jsonify({'status': 'ok'}), 200
@@ -315,6 +434,12 @@ def user_register():
         if not username or not email or not password:
             return jsonify({'error': '必須項目が不足しています'}), 400
         
+        # ハッシュの計算は書き込みのロックを取る（最初のクエリの）前に済ませる
+        try:
+            password_hash = password_hasher.hash(password)
+        except CredentialsBusy:
+            return _credentials_busy()
+        
         if User.query.filter_by(username=username).first():
             return jsonify({'error': 'このユーザー名はすでに使用されています'}), 400
         
@@ -324,7 +449,7 @@ def user_register():
         user = User(
             username=username,
             email=email,
-            password_hash=generate_password_hash(password),
+            password_hash=password_hash,
             full_name=data.get('full_name'),
             organization=data.get('organization'),
             phone=data.get('phone')
@@ -349,18 +474,36 @@ def user_login():
     
     data = request.get_json()
     username_or_email = data.get('username')
-    password = data.get('password')
+    password = data.get('password') or ''
+    
+    # 試行回数の上限を超えていればハッシュを計算する前に断る
+    account = f'user:{username_or_email}'
+    retry_after = login_limiter.retry_after(account, request.remote_addr)
+    if retry_after:
+        return _too_many_attempts(retry_after)
     
     user = User.query.filter(
         (User.username == username_or_email) | (User.email == username_or_email)
     ).first()
     
-    if user and check_password_hash(user.password_hash, password):
+    try:
+        valid, new_hash = password_hasher.verify(user.password_hash, password) if user else (False, None)
+    except CredentialsBusy:
+        return _credentials_busy()
+    
+    if valid:
+        login_limiter.reset(account)
         if not user.is_active:
             return jsonify({'error': 'アカウントが無効です'}), 401
         
-        user.last_login = datetime.utcnow()
+        # ハッシュの計算中も開いていた読み取りのトランザクションを終え、書き込みのロックを取って更新する
         db.session.commit()
+        with write_intent():
+            if new_hash:
+                # ハッシュ方式の設定が変わっていれば新しい方式で保存し直す
+                user.password_hash = new_hash
+            user.last_login = datetime.utcnow()
+            db.session.commit()
         
         token = generate_user_token(user.id)
         return jsonify({
@@ -368,119 +511,239 @@ def user_login():
             'user': user.to_dict()
         }), 200
     
+    login_limiter.record_failure(account, request.remote_addr)
     return jsonify({'error': 'ユーザー名またはパスワードが正しくありません'}), 401
 
+def _too_many_attempts(retry_after):
+    response = jsonify({'error': 'ログインの試行回数が多すぎます。しばらくしてから再度お試しください'})
+    response.headers['Retry-After'] = str(retry_after)
+    return response, 429
+
+def _credentials_busy():
+    response = jsonify({'error': 'ただいま混み合っています。しばらくしてから再度お試しください'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
 @app.route('/api/user/profile', methods=['GET', 'OPTIONS'])
+@auth.user_required
 def get_user_profile():
     if request.method == 'OPTIONS':
         return jsonify({'status': 'ok'}), 200
     
-    user_id = verify_user_token(request.headers.get('Authorization', '').replace('Bearer ', ''))
-    if not user_id:
-        return jsonify({'error': '認証が必要です'}), 401
-    
-    user = User.query.get(user_id)
+    user = current_user()
     if not user:
         return jsonify({'error': 'ユーザーが見つかりません'}), 404
     
     return jsonify({'user': user.to_dict()}), 200
 
+@app.route('/api/logout', methods=['POST', 'OPTIONS'])
+@app.route('/api/admin/logout', methods=['POST', 'OPTIONS'])
+@write_transaction
+def logout():
+    """トークンを失効させる（ユーザー・管理者共通）"""
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'ok'}), 200
+    
+    if not auth.revoke(bearer_token()):
+        return jsonify({'error': '認証が必要です'}), 401
+    db.session.commit()
+    return jsonify({'message': 'ログアウトしました'}), 200
+
 @app.route('/api/admin/login', methods=['POST', 'OPTIONS'])
 def admin_login():
     if request.method == 'OPTIONS':
         return jsonify({'status': 'ok'}), 200
     
     data = request.get_json()
+    account = f'admin:{data.get("username")}'
+    retry_after = login_limiter.retry_after(account, request.remote_addr)
+    if retry_after:
+        return _too_many_attempts(retry_after)
+    
     admin = Admin.query.filter_by(username=data.get('username')).first()
-    if admin and check_password_hash(admin.password_hash, data.get('password')):
+    try:
+        valid, new_hash = password_hasher.verify(admin.password_hash, data.get('password') or '') if admin else (False, None)
+    except CredentialsBusy:
+        return _credentials_busy()
+    
+    if valid:
+        login_limiter.reset(account)
+        if new_hash:
+            db.session.commit()
+            with write_intent():
+                admin.password_hash = new_hash
+                db.session.commit()
         token = generate_token(admin.id)
         return jsonify({'token': token, 'username': admin.username}), 200
+    login_limiter.record_failure(account, request.remote_addr)
     return jsonify({'error': 'ユーザー名またはパスワードが正しくありません'}), 401
 
 @app.route('/api/admin/orders', methods=['GET', 'OPTIONS'])
+@auth.admin_required
+@read_replica
 def admin_get_orders():
     if request.method == 'OPTIONS':
         return jsonify({'status': 'ok'}), 200
     
-    if not verify_token(request.headers.get('Authorization', '').replace('Bearer ', '')):
-        return jsonify({'error': '認証が必要です'}), 401
-    orders = Order.query.order_by(Order.order_date.desc()).all()
-    return jsonify({'orders': [order.to_dict() for order in orders]}), 200
+    try:
+        cursor, limit, fields = parse_page_args(request.args)
+        orders, next_cursor = keyset_page(
+            apply_load_plan(Order.query, 'admin_get_orders'),
+            (Order.order_date, Order.id), cursor, limit,
+            key=lambda o: (o.order_date, o.id)
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({
+        'orders': [project(order.to_dict(), fields) for order in orders],
+        'next_cursor': next_cursor
+    }), 200
 
 @app.route('/api/admin/customers', methods=['GET', 'OPTIONS'])
+@auth.admin_required
+@read_replica
 def admin_get_customers():
     if request.method == 'OPTIONS':
         return jsonify({'status': 'ok'}), 200
     
-    if not verify_token(request.headers.get('Authorization', '').replace('Bearer ', '')):
-        return jsonify({'error': '認証が必要です'}), 401
-    customers = Customer.query.all()
+    # 顧客ごとの注文数・最終注文日を集計したサブクエリを LEFT JOIN する（1クエリで取得）
+    order_stats = db.session.query(
+        Order.customer_id,
+        func.count(Order.id).label('order_count'),
+        func.max(Order.order_date).label('last_order_date')
+    ).group_by(Order.customer_id).subquery()
+    order_count = func.coalesce(order_stats.c.order_count, 0)
+    
+    query = db.session.query(Customer, order_count, order_stats.c.last_order_date) \
+        .outerjoin(order_stats, order_stats.c.customer_id == Customer.id)
+    
+    # 顧客名・組織名で検索
+    keyword = request.args.get('q', '').strip()
+    if keyword:
+        query = query.filter(
+            (Customer.name.contains(keyword)) |
+            (Customer.organization.contains(keyword))
+        )
+    
+    # 並び替え（NULL はキーセットで比較できないため既定値に置き換える）
+    epoch = datetime(1970, 1, 1)
+    sort_columns = {
+        'id': None,
+        'name': Customer.name,
+        'created_at': func.coalesce(Customer.created_at, epoch),
+        'order_count': order_count,
+        'last_order_date': func.coalesce(order_stats.c.last_order_date, epoch)
+    }
+    sort_key = request.args.get('sort', 'id')
+    if sort_key not in sort_columns:
+        return jsonify({'error': f'sort は {", ".join(sort_columns)} のいずれかを指定してください'}), 400
+    sort_column = sort_columns[sort_key]
+    if sort_column is None:
+        columns = (Customer.id,)
+        key = lambda row: (row[0].id,)
+    else:
+        query = query.add_columns(sort_column.label('sort_value'))
+        columns = (sort_column, Customer.id)
+        key = lambda row: (row.sort_value, row[0].id)
+    
+    try:
+        cursor, limit, fields = parse_page_args(request.args)
+        rows, next_cursor = keyset_page(query, columns, cursor, limit,
+                                        descending=request.args.get('order', 'asc') == 'desc',
+                                        key=key)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
     result = []
-    for c in customers:
-        customer_dict = c.to_dict()
-        customer_dict['order_count'] = Order.query.filter_by(customer_id=c.id).count()
-        result.append(customer_dict)
-    return jsonify({'customers': result}), 200
+    for row in rows:
+        customer_dict = row[0].to_dict()
+        customer_dict['order_count'] = row[1]
+        customer_dict['last_order_date'] = row[2].isoformat() if row[2] else None
+        result.append(project(customer_dict, fields))
+    return jsonify({'customers': result, 'next_cursor': next_cursor}), 200
 
 @app.route('/api/admin/customer/<int:customer_id>/orders', methods=['GET', 'OPTIONS'])
+@auth.admin_required
+@read_replica
 def admin_get_customer_orders(customer_id):
     if request.method == 'OPTIONS':
         return jsonify({'status': 'ok'}), 200
     
-    if not verify_token(request.headers.get('Authorization', '').replace('Bearer ', '')):
-        return jsonify({'error': '認証が必要です'}), 401
     customer = Customer.query.get_or_404(customer_id)
-    orders = Order.query.filter_by(customer_id=customer_id).order_by(Order.order_date.desc()).all()
+    try:
+        cursor, limit, fields = parse_page_args(request.args)
+        orders, next_cursor = keyset_page(
+            apply_load_plan(Order.query, 'admin_get_customer_orders').filter_by(customer_id=customer_id),
+            (Order.order_date, Order.id), cursor, limit,
+            key=lambda o: (o.order_date, o.id)
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     return jsonify({
         'customer': customer.to_dict(),
-        'orders': [o.to_dict() for o in orders]
+        'orders': [project(o.to_dict(), fields) for o in orders],
+        'next_cursor': next_cursor
     }), 200
 
 @app.route('/api/admin/export/csv', methods=['GET', 'OPTIONS'])
+@auth.admin_required
+@read_replica
 def export_csv():
     if request.method == 'OPTIONS':
         return jsonify({'status': 'ok'}), 200
     
-    if not verify_token(request.headers.get('Authorization', '').replace('Bearer ', '')):
-        return jsonify({'error': '認証が必要です'}), 401
+    try:
+        filters = parse_order_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    download_name = f'orders_{datetime.now().strftime("%Y%m%d")}.csv'
+    if _wants_async():
+        return _enqueue_export('admin', {'source': 'orders', 'filters': _order_filter_args()}, 'csv', download_name)
+    # 1クエリをバッチで読み出しながら CSV をストリーミングで返す
+    return send_export(OrderItemSource(filters), 'csv', download_name)
+
+@app.route('/api/admin/export/json', methods=['GET', 'OPTIONS'])
+@auth.admin_required
+@read_replica
+def export_json():
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'ok'}), 200
     
-    si = StringIO()
-    writer = csv.writer(si)
-    writer.writerow(['注文ID', '注文日', '顧客名', '組織', 'ISBN', '書名', '著者', '出版社', '数量'])
-    orders = Order.query.order_by(Order.order_date.desc()).all()
-    for order in orders:
-        for item in order.items:
-            writer.writerow([
-                order.id,
-                order.order_date.strftime('%Y-%m-%d'),
-                order.customer.name,
-                order.customer.organization or '',
-                item.isbn or '',
-                item.title,
-                item.author or '',
-                item.publisher or '',
-                item.quantity
-            ])
-    
-    output = BytesIO(si.getvalue().encode('utf-8-sig'))
-    output.seek(0)
-    return send_file(output, mimetype='text/csv', as_attachment=True,
-                     download_name=f'orders_{datetime.now().strftime("%Y%m%d")}.csv')
+    try:
+        filters = parse_order_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    download_name = f'orders_{datetime.now().strftime("%Y%m%d")}.json'
+    if _wants_async():
+        return _enqueue_export('admin', {'source': 'orders', 'filters': _order_filter_args()}, 'json', download_name)
+    return send_export(OrderItemSource(filters), 'json', download_name)
 
 # 選書リスト管理API
 @app.route('/api/selection-lists', methods=['GET', 'POST', 'OPTIONS'])
+@auth.user_required
+@write_transaction
 def manage_selection_lists():
     if request.method == 'OPTIONS':
         return jsonify({'status': 'ok'}), 200
     
-    user_id = verify_user_token(request.headers.get('Authorization', '').replace('Bearer ', ''))
-    if not user_id:
-        return jsonify({'error': '認証が必要です'}), 401
+    user_id = g.user_id
     
     if request.method == 'GET':
         # ユーザーの選書リスト一覧を取得
-        lists = BookSelectionList.query.filter_by(user_id=user_id).order_by(BookSelectionList.updated_at.desc()).all()
-        return jsonify({'lists': [book_list.to_dict() for book_list in lists]}), 200
+        try:
+            cursor, limit, fields = parse_page_args(request.args)
+            lists, next_cursor = keyset_page(
+                apply_load_plan(BookSelectionList.query, 'manage_selection_lists').filter_by(user_id=user_id),
+                (BookSelectionList.updated_at, BookSelectionList.id), cursor, limit,
+                key=lambda l: (l.updated_at, l.id)
+            )
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify({
+            'lists': [project(book_list.to_dict(), fields) for book_list in lists],
+            'next_cursor': next_cursor
+        }), 200
     
     elif request.method == 'POST':
         # 新しい選書リストを作成
@@ -507,13 +770,13 @@ def manage_selection_lists():
             return jsonify({'error': str(e)}), 500
 
 @app.route('/api/selection-lists/<int:list_id>', methods=['GET', 'PUT', 'DELETE', 'OPTIONS'])
+@auth.user_required
+@write_transaction
 def manage_selection_list(list_id):
     if request.method == 'OPTIONS':
         return jsonify({'status': 'ok'}), 200
     
-    user_id = verify_user_token(request.headers.get('Authorization', '').replace('Bearer ', ''))
-    if not user_id:
-        return jsonify({'error': '認証が必要です'}), 401
+    user_id = g.user_id
     
     book_list = BookSelectionList.query.filter_by(id=list_id, user_id=user_id).first()
     if not book_list:
@@ -549,13 +812,13 @@ def manage_selection_list(list_id):
             return jsonify({'error': str(e)}), 500
 
 @app.route('/api/selection-lists/<int:list_id>/items', methods=['GET', 'POST', 'OPTIONS'])
+@auth.user_required
+@write_transaction
 def manage_selection_list_items(list_id):
     if request.method == 'OPTIONS':
         return jsonify({'status': 'ok'}), 200
     
-    user_id = verify_user_token(request.headers.get('Authorization', '').replace('Bearer ', ''))
-    if not user_id:
-        return jsonify({'error': '認証が必要です'}), 401
+    user_id = g.user_id
     
     book_list = BookSelectionList.query.filter_by(id=list_id, user_id=user_id).first()
     if not book_list:
@@ -563,8 +826,19 @@ def manage_selection_list_items(list_id):
     
     if request.method == 'GET':
         # リストのアイテム一覧を取得
-        items = BookSelectionItem.query.filter_by(list_id=list_id).order_by(BookSelectionItem.added_at.desc()).all()
-        return jsonify({'items': [item.to_dict() for item in items]}), 200
+        try:
+            cursor, limit, fields = parse_page_args(request.args, default_limit=100)
+            items, next_cursor = keyset_page(
+                BookSelectionItem.query.filter_by(list_id=list_id),
+                (BookSelectionItem.added_at, BookSelectionItem.id), cursor, limit,
+                key=lambda i: (i.added_at, i.id)
+            )
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify({
+            'items': [project(item.to_dict(), fields) for item in items],
+            'next_cursor': next_cursor
+        }), 200
     
     elif request.method == 'POST':
         # リストにアイテムを追加
@@ -576,8 +850,12 @@ def manage_selection_list_items(list_id):
             if not isbn or not title:
                 return jsonify({'error': 'ISBNと書名は必須です'}), 400
             
-            # 既存チェック
-            existing_item = BookSelectionItem.query.filter_by(list_id=list_id, isbn=isbn).first()
+            # 既存チェック（ISBN-10/13・ハイフンの違いは同じ書籍として扱う）
+            canonical = canonical_isbn(isbn)
+            if canonical:
+                existing_item = BookSelectionItem.query.filter_by(list_id=list_id, isbn13=canonical).first()
+            else:
+                existing_item = BookSelectionItem.query.filter_by(list_id=list_id, isbn=isbn).first()
             if existing_item:
                 return jsonify({'error': 'この書籍は既にリストに追加されています'}), 400
             
@@ -605,14 +883,104 @@ def manage_selection_list_items(list_id):
             db.session.rollback()
             return jsonify({'error': str(e)}), 500
 
+@app.route('/api/selection-lists/<int:list_id>/items/bulk', methods=['POST', 'OPTIONS'])
+@auth.user_required
+@write_transaction
+def bulk_add_selection_list_items(list_id):
+    """選書リストに複数の書籍をまとめて追加"""
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'ok'}), 200
+    
+    user_id = g.user_id
+    
+    book_list = BookSelectionList.query.filter_by(id=list_id, user_id=user_id).first()
+    if not book_list:
+        return jsonify({'error': '選書リストが見つかりません'}), 404
+    
+    data = request.get_json() or {}
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'items に追加する書籍のリストを指定してください'}), 400
+    
+    try:
+        results = add_items(book_list, items, merge_quantities=bool(data.get('merge_quantities')))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+    
+    summary = {}
+    for result in results:
+        summary[result['status']] = summary.get(result['status'], 0) + 1
+    return jsonify({'results': results, 'summary': summary}), 200
+
+@app.route('/api/selection-lists/<int:list_id>/import', methods=['POST', 'OPTIONS'])
+@auth.user_required
+def import_selection_list_items(list_id):
+    """CSV / Excel の注文シートを選書リストに取り込む（進捗と結果を NDJSON で返す）"""
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'ok'}), 200
+    
+    user_id = g.user_id
+    
+    book_list = BookSelectionList.query.filter_by(id=list_id, user_id=user_id).first()
+    if not book_list:
+        return jsonify({'error': '選書リストが見つかりません'}), 404
+    
+    upload = request.files.get('file')
+    if not upload:
+        return jsonify({'error': 'ファイルを指定してください'}), 400
+    merge_quantities = request.form.get('merge_quantities') in ('1', 'true')
+    
+    if _wants_async():
+        path = job_queue.save_upload(upload)
+        try:
+            _check_sheet(path, upload.filename)
+        except ImportFormatError as e:
+            os.unlink(path)
+            return jsonify({'error': str(e)}), 400
+        params = {'list_id': list_id, 'path': path, 'filename': upload.filename,
+                  'merge_quantities': merge_quantities}
+        return _job_accepted(job_queue.enqueue('import_selection_list', params, f'user:{user_id}'))
+    
+    # 見出し行の誤りはストリーミングを始める前に返す
+    try:
+        rows = iter_sheet_rows(upload)
+        first = next(rows, None)
+    except ImportFormatError as e:
+        return jsonify({'error': str(e)}), 400
+    if first is not None:
+        rows = itertools.chain([first], rows)
+    
+    def generate():
+        for event in import_rows(list_id, rows, _lookup_books_for_import, merge_quantities=merge_quantities):
+            yield json.dumps(event, ensure_ascii=False) + '\n'
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+def _lookup_books_for_import(isbns, fetch_isbns):
+    # 書名が分からない行だけ Google Books に問い合わせる
+    results = itertools.chain(
+        cache_policy.iter_books([isbn for isbn in isbns if isbn not in fetch_isbns], fetch=None),
+        cache_policy.iter_books(list(fetch_isbns), fetch=lambda isbn: fetch_google_books(isbn=isbn))
+    )
+    return {isbn: book for isbn, status, book in results if book}
+
+def _check_sheet(path, filename):
+    """保存したファイルの見出し行を確認する（不正なら ImportFormatError）"""
+    with open(path, 'rb') as f:
+        rows = iter_sheet_rows(FileStorage(stream=f, filename=filename))
+        next(rows, None)
+        rows.close()
+
 @app.route('/api/selection-lists/<int:list_id>/items/<int:item_id>', methods=['PUT', 'DELETE', 'OPTIONS'])
+@auth.user_required
+@write_transaction
 def manage_selection_list_item(list_id, item_id):
     if request.method == 'OPTIONS':
         return jsonify({'status': 'ok'}), 200
     
-    user_id = verify_user_token(request.headers.get('Authorization', '').replace('Bearer ', ''))
-    if not user_id:
-        return jsonify({'error': '認証が必要です'}), 401
+    user_id = g.user_id
     
     book_list = BookSelectionList.query.filter_by(id=list_id, user_id=user_id).first()
     if not book_list:
@@ -651,168 +1019,168 @@ def manage_selection_list_item(list_id, item_id):
 
 # 書店向け注文データ出力API
 @app.route('/api/selection-lists/<int:list_id>/export/csv', methods=['GET', 'OPTIONS'])
+@auth.user_required
+@read_replica
 def export_selection_list_csv(list_id):
     if request.method == 'OPTIONS':
         return jsonify({'status': 'ok'}), 200
     
-    user_id = verify_user_token(request.headers.get('Authorization', '').replace('Bearer ', ''))
-    if not user_id:
-        return jsonify({'error': '認証が必要です'}), 401
+    user_id = g.user_id
+    
+    book_list = BookSelectionList.query.filter_by(id=list_id, user_id=user_id).first()
+    if not book_list:
+        return jsonify({'error': '選書リストが見つかりません'}), 404
+    
+    download_name = f'selection_list_{list_id}_{datetime.now().strftime("%Y%m%d")}.csv'
+    if _wants_async():
+        return _enqueue_export(f'user:{user_id}', {'source': 'selection_list', 'list_id': list_id, 'user_id': user_id},
+                               'csv', download_name)
+    return send_export(SelectionListSource(book_list), 'csv', download_name)
+
+@app.route('/api/selection-lists/<int:list_id>/export/<any(xlsx, json):fmt>', methods=['GET', 'OPTIONS'])
+@auth.user_required
+@read_replica
+def export_selection_list(list_id, fmt):
+    """選書リストを Excel / JSON で出力"""
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'ok'}), 200
+    
+    user_id = g.user_id
     
     book_list = BookSelectionList.query.filter_by(id=list_id, user_id=user_id).first()
     if not book_list:
         return jsonify({'error': '選書リストが見つかりません'}), 404
     
-    si = StringIO()
-    writer = csv.writer(si)
-    writer.writerow(['ISBN', '書名', '著者', '出版社', '本体価格（税別）', '数量', '合計金額（税別）'])
-    
-    total_amount = 0
-    for item in book_list.items:
-        subtotal = (item.price or 0) * item.quantity
-        total_amount += subtotal
-        writer.writerow([
-            item.isbn or '',
-            item.title,
-            item.author or '',
-            item.publisher or '',
-            item.price or 0,
-            item.quantity,
-            subtotal
-        ])
-    
-    writer.writerow([])  # 空行
-    writer.writerow(['合計', '', '', '', '', '', total_amount])
-    
-    output = BytesIO(si.getvalue().encode('utf-8-sig'))
-    output.seek(0)
-    return send_file(output, 
-                     mimetype='text/csv', 
-                     as_attachment=True,
-                     download_name=f'selection_list_{list_id}_{datetime.now().strftime("%Y%m%d")}.csv')
+    options = {'sheet_title': '選書リスト'} if fmt == 'xlsx' else {}
+    download_name = f'selection_list_{list_id}_{datetime.now().strftime("%Y%m%d")}.{fmt}'
+    if _wants_async():
+        return _enqueue_export(f'user:{user_id}', {'source': 'selection_list', 'list_id': list_id, 'user_id': user_id},
+                               fmt, download_name, **options)
+    return send_export(SelectionListSource(book_list), fmt, download_name, **options)
 
 @app.route('/api/selection-lists/<int:list_id>/export/pdf', methods=['GET', 'OPTIONS'])
+@auth.user_required
 def export_selection_list_pdf(list_id):
     if request.method == 'OPTIONS':
         return jsonify({'status': 'ok'}), 200
     
-    user_id = verify_user_token(request.headers.get('Authorization', '').replace('Bearer ', ''))
-    if not user_id:
-        return jsonify({'error': '認証が必要です'}), 401
+    user_id = g.user_id
     
     book_list = BookSelectionList.query.filter_by(id=list_id, user_id=user_id).first()
     if not book_list:
         return jsonify({'error': '選書リストが見つかりません'}), 404
     
-    user = User.query.get(user_id)
+    source = SelectionListSource(book_list, current_user())
+    render_id = _pdf_render_id(source)
+    if request.if_none_match.contains(render_id):
+        return _with_etag(Response(status=304), render_id)
+    path = pdf_renderer.cached_path(render_id)
+    if path is None:
+        if _wants_async():
+            # ?async=1 の場合は生成を待たず、状況確認の URL を返す
+            pdf_renderer.submit(render_id, _pdf_writer(source))
+            return jsonify(_pdf_render_status(list_id, render_id)), 202
+        path = pdf_renderer.render(render_id, _pdf_writer(source))
+    
+    return _send_pdf(path, book_list, render_id)
+
+def _pdf_render_id(source):
+    return f'{source.book_list.id}-{export_key(source, "pdf")}'
+
+def _pdf_writer(source):
+    """生成キューで実行する書き出し関数（DB からの読み出しはここで済ませる）"""
+    source.document()
+    return lambda output: WRITERS['pdf'].write(source, output)
+
+def _send_pdf(path, book_list, render_id):
+    response = send_file(path,
+                         mimetype='application/pdf',
+                         as_attachment=True,
+                         download_name=f'order_{book_list.name}_{datetime.now().strftime("%Y%m%d")}.pdf',
+                         conditional=False)
+    return _with_etag(response, render_id)
+
+def _pdf_render_status(list_id, render_id):
+    status = pdf_renderer.status(render_id)
+    status['render_id'] = render_id
+    status['status_url'] = f'/api/selection-lists/{list_id}/export/pdf/render/{render_id}'
+    if status['status'] == 'done':
+        status['download_url'] = status['status_url'] + '/download'
+    return status
+
+@app.route('/api/selection-lists/<int:list_id>/export/pdf/render', methods=['POST', 'OPTIONS'])
+@auth.user_required
+def render_selection_list_pdf(list_id):
+    """注文書 PDF の生成を依頼する（生成済みならすぐにダウンロードできる）"""
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'ok'}), 200
     
-    # PDF生成
-    buffer = BytesIO()
+    user_id = g.user_id
     
-    # 日本語フォント登録
-    try:
-        pdfmetrics.registerFont(UnicodeCIDFont('HeiseiKakuGo-W5'))
-        font_name = 'HeiseiKakuGo-W5'
-    except:
-        font_name = 'Helvetica'  # フォールバック
-    
-    doc = SimpleDocTemplate(buffer, pagesize=A4)
-    story = []
-    
-    styles = getSampleStyleSheet()
-    title_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Heading1'],
-        fontName=font_name,
-        fontSize=16,
-        spaceAfter=20,
-        alignment=1  # センター揃え
-    )
+    book_list = BookSelectionList.query.filter_by(id=list_id, user_id=user_id).first()
+    if not book_list:
+        return jsonify({'error': '選書リストが見つかりません'}), 404
     
-    normal_style = ParagraphStyle(
-        'CustomNormal',
-        parent=styles['Normal'],
-        fontName=font_name,
-        fontSize=10,
-        spaceAfter=6
-    )
+    source = SelectionListSource(book_list, current_user())
+    render_id = _pdf_render_id(source)
+    if pdf_renderer.cached_path(render_id):
+        return jsonify(_pdf_render_status(list_id, render_id)), 200
+    pdf_renderer.submit(render_id, _pdf_writer(source))
+    return jsonify(_pdf_render_status(list_id, render_id)), 202
+
+@app.route('/api/selection-lists/<int:list_id>/export/pdf/render/<render_id>', methods=['GET', 'OPTIONS'])
+@auth.user_required
+def get_selection_list_pdf_status(list_id, render_id):
+    """注文書 PDF の生成状況"""
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'ok'}), 200
     
-    # タイトル
-    story.append(Paragraph('図書注文書', title_style))
-    story.append(Spacer(1, 20))
-    
-    # 注文者情報
-    story.append(Paragraph(f'注文者: {user.full_name or user.username}', normal_style))
-    if user.organization:
-        story.append(Paragraph(f'所属: {user.organization}', normal_style))
-    story.append(Paragraph(f'メール: {user.email}', normal_style))
-    if user.phone:
-        story.append(Paragraph(f'電話: {user.phone}', normal_style))
-    
-    story.append(Spacer(1, 20))
-    
-    # リスト情報
-    story.append(Paragraph(f'選書リスト名: {book_list.name}', normal_style))
-    story.append(Paragraph(f'作成日: {book_list.created_at.strftime("%Y年%m月%d日")}', normal_style))
-    story.append(Spacer(1, 20))
-    
-    # 書籍リスト
-    if book_list.items:
-        data = [['ISBN', '書名', '著者', '出版社', '本体価格', '数量', '小計']]
-        total_amount = 0
-        
-        for item in book_list.items:
-            subtotal = (item.price or 0) * item.quantity
-            total_amount += subtotal
-            data.append([
-                item.isbn or '',
-                item.title[:30] + '...' if len(item.title) > 30 else item.title,
-                item.author[:20] + '...' if item.author and len(item.author) > 20 else (item.author or ''),
-                item.publisher[:15] + '...' if item.publisher and len(item.publisher) > 15 else (item.publisher or ''),
-                f'¥{item.price:,.0f}' if item.price else '未定',
-                str(item.quantity),
-                f'¥{subtotal:,.0f}' if item.price else '未定'
-            ])
-        
-        data.append(['', '', '', '', '', '合計', f'¥{total_amount:,.0f}'])
-        
-        table = Table(data)
-        table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, -1), font_name),
-            ('FONTSIZE', (0, 0), (-1, -1), 8),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-            ('BACKGROUND', (0, 1), (-1, -2), colors.beige),
-            ('BACKGROUND', (0, -1), (-1, -1), colors.lightgrey),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black)
-        ]))
-        story.append(table)
-    
-    doc.build(story)
-    buffer.seek(0)
-    
-    return send_file(buffer,
-                     mimetype='application/pdf',
-                     as_attachment=True,
-                     download_name=f'order_{book_list.name}_{datetime.now().strftime("%Y%m%d")}.pdf')
+    user_id = g.user_id
+    
+    book_list = BookSelectionList.query.filter_by(id=list_id, user_id=user_id).first()
+    if not book_list or not render_id.startswith(f'{list_id}-'):
+        return jsonify({'error': '選書リストが見つかりません'}), 404
+    
+    status = _pdf_render_status(list_id, render_id)
+    if status['status'] == 'missing':
+        return jsonify(dict(status, error='PDFが見つかりません。再度生成を依頼してください')), 404
+    return jsonify(status), 200
+
+@app.route('/api/selection-lists/<int:list_id>/export/pdf/render/<render_id>/download', methods=['GET', 'OPTIONS'])
+@auth.user_required
+def download_selection_list_pdf(list_id, render_id):
+    """生成済みの注文書 PDF をダウンロード"""
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'ok'}), 200
+    
+    user_id = g.user_id
+    
+    book_list = BookSelectionList.query.filter_by(id=list_id, user_id=user_id).first()
+    if not book_list or not render_id.startswith(f'{list_id}-'):
+        return jsonify({'error': '選書リストが見つかりません'}), 404
+    
+    if request.if_none_match.contains(render_id):
+        return _with_etag(Response(status=304), render_id)
+    path = pdf_renderer.cached_path(render_id)
+    if not path:
+        return jsonify({'error': 'PDFはまだ生成されていません'}), 404
+    
+    return _send_pdf(path, book_list, render_id)
 
 @app.route('/api/selection-lists/<int:list_id>/export/order-data', methods=['GET', 'OPTIONS'])
+@auth.user_required
 def get_selection_list_order_data(list_id):
     """選書リストの注文確認データを取得"""
     if request.method == 'OPTIONS':
         return jsonify({'status': 'ok'}), 200
     
-    user_id = verify_user_token(request.headers.get('Authorization', '').replace('Bearer ', ''))
-    if not user_id:
-        return jsonify({'error': '認証が必要です'}), 401
+    user_id = g.user_id
     
     book_list = BookSelectionList.query.filter_by(id=list_id, user_id=user_id).first()
     if not book_list:
         return jsonify({'error': '選書リストが見つかりません'}), 404
     
-    user = User.query.get(user_id)
+    user = current_user()
     total_amount = sum((item.price or 0) * item.quantity for item in book_list.items)
     total_quantity = sum(item.quantity for item in book_list.items)
     
@@ -839,39 +1207,215 @@ def get_selection_list_order_data(list_id):
     }), 200
 
 @app.route('/api/admin/export/excel', methods=['GET', 'OPTIONS'])
+@auth.admin_required
+@read_replica
 def export_excel():
     if request.method == 'OPTIONS':
         return jsonify({'status': 'ok'}), 200
     
-    if not verify_token(request.headers.get('Authorization', '').replace('Bearer ', '')):
+    try:
+        filters = parse_order_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    split_by_month = request.args.get('split') == 'month'
+    
+    download_name = f'orders_{datetime.now().strftime("%Y%m%d")}.xlsx'
+    if _wants_async():
+        return _enqueue_export('admin', {'source': 'orders', 'filters': _order_filter_args()}, 'xlsx', download_name,
+                               split_by_month=split_by_month)
+    # write-only モードでファイルに書き出し、メモリ使用量を一定に保つ
+    return send_export(OrderItemSource(filters), 'xlsx', download_name, split_by_month=split_by_month)
+
+@app.route('/api/admin/cache/stats', methods=['GET', 'OPTIONS'])
+@auth.admin_required
+def admin_cache_stats():
+    """書籍キャッシュのヒット率・件数などの指標を取得"""
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'ok'}), 200
+    
+    return jsonify({'book_cache': cache_policy.stats()}), 200
+
+# バックグラウンドジョブ
+def _job_owner():
+    """リクエストの認証情報からジョブの所有者を決める。認証されていなければ None"""
+    if auth.current_admin_id():
+        return 'admin'
+    user_id = auth.current_user_id()
+    return f'user:{user_id}' if user_id else None
+
+def _export_source(params):
+    """ジョブの値からエクスポートの供給元を組み立てる"""
+    if params['source'] == 'orders':
+        return OrderItemSource(parse_order_filters(params.get('filters', {})))
+    book_list = BookSelectionList.query.filter_by(id=params['list_id'], user_id=params['user_id']).first()
+    if not book_list:
+        raise ValueError('選書リストが見つかりません')
+    return SelectionListSource(book_list)
+
+@job_queue.handler('export')
+def run_export_job(ctx, params):
+    """エクスポート。結果はエクスポートのキャッシュにも保存する"""
+    fmt = params['format']
+    writer = WRITERS[fmt]
+    options = params.get('options', {})
+    with replica_reads():
+        source = _export_source(params)
+        key = export_key(source, fmt, **options)
+        path = export_cache.get(key, writer.extension)
+        if path is None:
+            tracked = TrackedSource(source, lambda count: ctx.progress(processed=count))
+            path = export_cache.store(key, writer.extension, lambda output: writer.write(tracked, output, **options))
+    # キャッシュから先に削除されても結果を返せるよう、ジョブの結果として複製しておく
+    result_path = os.path.join(ctx.result_dir, params['download_name'])
+    try:
+        os.link(path, result_path)
+    except OSError:
+        shutil.copyfile(path, result_path)
+    return {'file': result_path, 'download_name': params['download_name'], 'mimetype': writer.mimetype}
+
+@job_queue.handler('import_selection_list')
+def run_import_job(ctx, params, max_errors=1000):
+    """選書リストへの取り込み。エラーの行は max_errors 件まで結果に含める"""
+    summary, errors = {}, []
+    try:
+        with open(params['path'], 'rb') as f:
+            rows = iter_sheet_rows(FileStorage(stream=f, filename=params['filename']))
+            events = import_rows(params['list_id'], rows, _lookup_books_for_import,
+                                 merge_quantities=params['merge_quantities'])
+            for event in events:
+                if event['type'] == 'progress':
+                    ctx.progress(processed=event['processed'])
+                elif event['type'] == 'error':
+                    if len(errors) < max_errors:
+                        errors.append(event)
+                else:
+                    summary = event
+    finally:
+        os.unlink(params['path'])
+    summary.pop('type', None)
+    return dict(summary, errors=errors)
+
+@job_queue.handler('books_batch')
+def run_books_batch_job(ctx, params):
+    """書籍の一括検索。結果は /api/books/batch と同じ NDJSON のファイル"""
+    isbns = params['isbns']
+    path = os.path.join(ctx.result_dir, 'books.ndjson')
+    counts = Counter()
+    with open(path, 'w', encoding='utf-8') as f:
+        results = cache_policy.iter_books(isbns, fetch=lambda isbn: fetch_google_books(isbn=isbn))
+        for isbn, status, book in ctx.track(results, every=20, total=len(isbns)):
+            counts[status] += 1
+            f.write(json.dumps({'isbn': isbn, 'status': status, 'book': book}, ensure_ascii=False) + '\n')
+    return dict(counts, file=path, download_name='books.ndjson', mimetype='application/x-ndjson')
+
+def _get_owned_job(job_id):
+    owner = _job_owner()
+    if not owner:
+        return None, (jsonify({'error': '認証が必要です'}), 401)
+    job = db.session.get(Job, job_id)
+    if not job or job.owner != owner:
+        return None, (jsonify({'error': 'ジョブが見つかりません'}), 404)
+    return job, None
+
+def _job_dict(job):
+    data = job.to_dict()
+    data['status_url'] = f'/api/jobs/{job.id}'
+    data['result_url'] = f'/api/jobs/{job.id}/result'
+    return data
+
+@app.route('/api/jobs', methods=['GET', 'POST', 'OPTIONS'])
+@write_transaction
+def manage_jobs():
+    """ジョブの一覧（新しい順）と登録"""
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'ok'}), 200
+    
+    owner = _job_owner()
+    if not owner:
         return jsonify({'error': '認証が必要です'}), 401
     
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "注文一覧"
-    ws.append(['注文ID', '注文日', '顧客名', '組織', 'ISBN', '書名', '著者', '出版社', '数量'])
-    orders = Order.query.order_by(Order.order_date.desc()).all()
-    for order in orders:
-        for item in order.items:
-            ws.append([
-                order.id,
-                order.order_date.strftime('%Y-%m-%d'),
-                order.customer.name,
-                order.customer.organization or '',
-                item.isbn or '',
-                item.title,
-                item.author or '',
-                item.publisher or '',
-                item.quantity
-            ])
-    
-    output = BytesIO()
-    wb.save(output)
-    output.seek(0)
-    return send_file(output,
-                     mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-                     as_attachment=True,
-                     download_name=f'orders_{datetime.now().strftime("%Y%m%d")}.xlsx')
+    if request.method == 'GET':
+        jobs = Job.query.filter_by(owner=owner).order_by(Job.created_at.desc()).limit(50).all()
+        return jsonify({'jobs': [_job_dict(job) for job in jobs]}), 200
+    
+    data = request.get_json() or {}
+    kind = data.get('kind')
+    if kind == 'books_batch':
+        isbns = data.get('isbns')
+        if not isinstance(isbns, list) or not isbns:
+            return jsonify({'error': 'isbns に ISBN のリストを指定してください'}), 400
+        if len(isbns) > BATCH_LOOKUP_MAX:
+            return jsonify({'error': f'一度に検索できるのは {BATCH_LOOKUP_MAX} 件までです'}), 400
+        return _job_accepted(job_queue.enqueue('books_batch', {'isbns': [str(isbn) for isbn in isbns]}, owner))
+    
+    if kind == 'export':
+        fmt = data.get('format')
+        if fmt not in ('csv', 'xlsx', 'json'):
+            return jsonify({'error': 'format には csv / xlsx / json を指定してください'}), 400
+        date = datetime.now().strftime("%Y%m%d")
+        if owner == 'admin':
+            filters = data.get('filters') or {}
+            try:
+                parse_order_filters(filters)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            options = {'split_by_month': bool(data.get('split_by_month'))} if fmt == 'xlsx' else {}
+            return _enqueue_export(owner, {'source': 'orders', 'filters': filters}, fmt,
+                                   f'orders_{date}.{fmt}', **options)
+        user_id = int(owner.split(':', 1)[1])
+        list_id = data.get('list_id')
+        if not BookSelectionList.query.filter_by(id=list_id, user_id=user_id).first():
+            return jsonify({'error': '選書リストが見つかりません'}), 404
+        options = {'sheet_title': '選書リスト'} if fmt == 'xlsx' else {}
+        return _enqueue_export(owner, {'source': 'selection_list', 'list_id': list_id, 'user_id': user_id}, fmt,
+                               f'selection_list_{list_id}_{date}.{fmt}', **options)
+    
+    return jsonify({'error': 'kind には export または books_batch を指定してください'}), 400
+
+@app.route('/api/jobs/<job_id>', methods=['GET', 'OPTIONS'])
+def get_job(job_id):
+    """ジョブの状態・進捗"""
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'ok'}), 200
+    
+    job, error = _get_owned_job(job_id)
+    if error:
+        return error
+    return jsonify(_job_dict(job)), 200
+
+@app.route('/api/jobs/<job_id>/result', methods=['GET', 'OPTIONS'])
+def get_job_result(job_id):
+    """ジョブの結果（ファイルの場合はダウンロード）"""
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'ok'}), 200
+    
+    job, error = _get_owned_job(job_id)
+    if error:
+        return error
+    if job.status != 'succeeded':
+        return jsonify(dict(_job_dict(job), error=job.error or 'ジョブはまだ完了していません')), 409
+    if not job.result_path:
+        return jsonify(job.to_dict()['result']), 200
+    if not os.path.exists(job.result_path):
+        return jsonify({'error': '結果の保存期間が過ぎています'}), 410
+    return send_file(job.result_path, mimetype=job.result_mimetype, as_attachment=True,
+                     download_name=job.result_name)
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST', 'OPTIONS'])
+@write_transaction
+def cancel_job(job_id):
+    """ジョブをキャンセルする"""
+    if request.method == 'OPTIONS':
+        return jsonify({'status': 'ok'}), 200
+    
+    job, error = _get_owned_job(job_id)
+    if error:
+        return error
+    if job.status in ('succeeded', 'failed', 'cancelled'):
+        return jsonify({'error': 'ジョブは既に終了しています'}), 409
+    job_queue.cancel(job.id)
+    db.session.refresh(job)
+    return jsonify(_job_dict(job)), 200
 
 @app.route('/api/health', methods=['GET', 'OPTIONS'])
 def health_check():
@@ -881,6 +1425,9 @@ def health_check():
 def index():
     return jsonify({'message': '書籍注文システム API', 'version': '1.0.0'}), 200
 
+# 処理関数をすべて登録してからジョブの実行を始める
+job_queue.start(app)
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
@@ -0,0 +1,180 @@
+"""トークン認証
+
+JWT の署名の検証は1トークンにつき1回だけ行い、検証済みの内容（claims）を
+トークンのハッシュをキーにした LRU に有効期限まで保持する。ルートでは
+@auth.user_required / @auth.admin_required を付け、ユーザー ID は g.user_id で参照する。
+User は current_user() を呼んだときにだけ読み込む。
+
+失効させたトークン（ログアウトなど）は revoked_tokens テーブルに登録し、
+各プロセスは一定間隔で差分を読み込んで手元の失効リストに反映する。
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from functools import wraps
+
+import jwt
+from flask import g, jsonify, request
+
+from models import db, RevokedToken, User
+
+ALGORITHM = 'HS256'
+# 期限切れの失効トークンを削除する間隔（秒）
+PURGE_INTERVAL = 3600
+
+
+def token_hash(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def bearer_token():
+    """Authorization ヘッダーのトークン（無ければ空文字）"""
+    return request.headers.get('Authorization', '').replace('Bearer ', '')
+
+
+class Authenticator:
+    """トークンの発行・検証・失効"""
+
+    def __init__(self, secret_key, cache_size=10000, refresh_interval=30):
+        self.secret_key = secret_key
+        self.cache_size = cache_size
+        self.refresh_interval = refresh_interval
+        # トークンのハッシュ -> (claims, 有効期限の UNIX 時刻)
+        self._cache = OrderedDict()
+        # 失効させたトークンのハッシュ -> 有効期限
+        self._revoked = {}
+        self._revoked_since = None
+        self._last_refresh = 0
+        self._last_purge = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, secret_key):
+        return cls(
+            secret_key,
+            cache_size=int(os.getenv('AUTH_CACHE_SIZE', 10000)),
+            refresh_interval=float(os.getenv('AUTH_REVOCATION_REFRESH', 30)),
+        )
+
+    def issue(self, claims, lifetime):
+        payload = dict(claims, exp=datetime.utcnow() + lifetime)
+        return jwt.encode(payload, self.secret_key, algorithm=ALGORITHM)
+
+    def decode(self, token):
+        """トークンを検証して claims を返す。不正・期限切れ・失効済みなら None"""
+        if not token:
+            return None
+        key = token_hash(token)
+        self._refresh_revocations()
+        now = time.time()
+        with self._lock:
+            if key in self._revoked:
+                return None
+            entry = self._cache.get(key)
+            if entry is not None:
+                claims, expires = entry
+                if expires > now:
+                    self._cache.move_to_end(key)
+                    return claims
+                del self._cache[key]
+        try:
+            claims = jwt.decode(token, self.secret_key, algorithms=[ALGORITHM])
+        except jwt.InvalidTokenError:
+            return None
+        with self._lock:
+            self._cache[key] = (claims, claims.get('exp', now))
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return claims
+
+    def revoke(self, token):
+        """トークンを失効させる（呼び出し側でコミットすること）"""
+        claims = self.decode(token)
+        if claims is None:
+            return False
+        key = token_hash(token)
+        expires_at = datetime.utcfromtimestamp(claims['exp']) if 'exp' in claims else None
+        db.session.add(RevokedToken(token_hash=key, expires_at=expires_at))
+        with self._lock:
+            self._revoked[key] = expires_at
+            self._cache.pop(key, None)
+        return True
+
+    def _refresh_revocations(self):
+        """他のプロセスで失効させたトークンを読み込む（refresh_interval 秒に1回）"""
+        now = time.monotonic()
+        if now - self._last_refresh < self.refresh_interval:
+            return
+        self._last_refresh = now
+        table = RevokedToken.__table__
+        query = db.select(table.c.token_hash, table.c.revoked_at, table.c.expires_at)
+        if self._revoked_since is not None:
+            # 同じ時刻に登録された行を取りこぼさないよう、境界を含めて読む
+            query = query.where(table.c.revoked_at >= self._revoked_since)
+        # ルートのセッションとは別の接続で読み書きする
+        # （書き込みを先に行い、GET のリクエストでも書き込みのロックを待てるようにする）
+        with db.engine.begin() as connection:
+            purge = now - self._last_purge > PURGE_INTERVAL
+            if purge:
+                self._last_purge = now
+                connection.execute(table.delete().where(table.c.expires_at < datetime.utcnow()))
+            rows = connection.execute(query).all()
+        with self._lock:
+            for key, revoked_at, expires_at in rows:
+                self._revoked[key] = expires_at
+                self._cache.pop(key, None)
+                if self._revoked_since is None or revoked_at > self._revoked_since:
+                    self._revoked_since = revoked_at
+            if purge:
+                # 期限切れのトークンは署名の検証で弾かれるので、失効リストから外してよい
+                cutoff = datetime.utcnow()
+                for key in [key for key, expires_at in self._revoked.items() if expires_at and expires_at < cutoff]:
+                    del self._revoked[key]
+
+    # --- リクエスト単位 ---
+
+    def current_claims(self):
+        """このリクエストのトークンの claims（リクエスト中は1回だけ検証する）"""
+        if 'auth_claims' not in g:
+            g.auth_claims = self.decode(bearer_token())
+        return g.auth_claims
+
+    def current_user_id(self):
+        claims = self.current_claims()
+        return claims.get('user_id') if claims else None
+
+    def current_admin_id(self):
+        claims = self.current_claims()
+        return claims.get('admin_id') if claims else None
+
+    def user_required(self, view):
+        """ユーザーのトークンが必要なルート。g.user_id にユーザー ID を入れる"""
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'OPTIONS':
+                g.user_id = self.current_user_id()
+                if not g.user_id:
+                    return jsonify({'error': '認証が必要です'}), 401
+            return view(*args, **kwargs)
+        return wrapper
+
+    def admin_required(self, view):
+        """管理者のトークンが必要なルート。g.admin_id に管理者 ID を入れる"""
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'OPTIONS':
+                g.admin_id = self.current_admin_id()
+                if not g.admin_id:
+                    return jsonify({'error': '認証が必要です'}), 401
+            return view(*args, **kwargs)
+        return wrapper
+
+
+def current_user():
+    """ログイン中のユーザー。必要になったときに1回だけ読み込む"""
+    if 'current_user' not in g:
+        g.current_user = db.session.get(User, g.user_id) if g.get('user_id') else None
+    return g.current_user
@@ -0,0 +1,474 @@
+"""BookCache への書き込みとキャッシュの有効期限・削除の管理"""
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, func, select, text
+from sqlalchemy.dialects import postgresql, sqlite
+
+from books_client import CircuitOpenError
+from database import write_intent
+from isbn import canonical_isbn, normalize_isbn
+from models import db, BookCache
+from search_index import index_books, unindex_books, is_available
+from facets import index_facets, unindex_facets, is_available as facets_available
+
+# 1文あたりの行数（SQLite のバインド変数の上限を超えないようにする）
+UPSERT_BATCH_SIZE = 200
+
+# Google Books から取得して更新する項目（分類・価格など手入力の項目は上書きしない）
+REFRESH_FIELDS = ('title', 'author', 'publisher', 'published_date', 'thumbnail', 'description')
+
+# BookCache の行が変更されたときに呼ばれる関数（引数は ISBN のリスト）
+_change_listeners = []
+
+
+def on_books_changed(listener):
+    _change_listeners.append(listener)
+
+
+def _notify_changed(isbns):
+    for listener in _change_listeners:
+        listener(isbns)
+
+
+@event.listens_for(BookCache, 'after_update')
+@event.listens_for(BookCache, 'after_delete')
+def _book_changed(mapper, connection, target):
+    _notify_changed([target.isbn])
+
+
+def cache_key(isbn):
+    """メモリキャッシュのキー（ISBN-13。有効な ISBN でなければ正規化した文字列）"""
+    return canonical_isbn(isbn) or normalize_isbn(isbn)
+
+
+def upsert_books(books):
+    """書籍データを BookCache にまとめて登録・更新する
+
+    既存の行は取得できた項目と cached_at を更新する。空の値では上書きしない。
+    SQLite / PostgreSQL では INSERT ... ON CONFLICT を1文で実行するため、
+    複数ワーカーが同じ ISBN を同時に登録しても一意制約違反にならない。
+    """
+    rows = {}
+    for book in books:
+        if book.get('isbn'):
+            rows[book['isbn']] = {field: book.get(field) or None for field in REFRESH_FIELDS}
+            rows[book['isbn']]['isbn'] = book['isbn']
+            rows[book['isbn']]['isbn13'] = canonical_isbn(book['isbn'])
+    if not rows:
+        return
+
+    now = datetime.utcnow()
+    values = [dict(row, cached_at=now) for row in rows.values()]
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+        for start in range(0, len(values), UPSERT_BATCH_SIZE):
+            stmt = insert(BookCache.__table__).values(values[start:start + UPSERT_BATCH_SIZE])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[BookCache.isbn],
+                set_=dict(
+                    {field: func.coalesce(stmt.excluded[field], BookCache.__table__.c[field])
+                     for field in REFRESH_FIELDS},
+                    isbn13=stmt.excluded.isbn13,
+                    cached_at=stmt.excluded.cached_at
+                )
+            )
+            db.session.execute(stmt)
+    else:
+        _upsert_with_lookup(values)
+
+    # Core の INSERT は ORM イベントを通らないため、全文検索・ファセットの索引を直接更新する
+    # （書き込んだ接続で読み、リードレプリカの遅れの影響を受けないようにする）
+    connection = db.session.connection()
+    changed = connection.execute(select(
+        BookCache.id, BookCache.title, BookCache.author, BookCache.publisher, BookCache.description,
+        BookCache.target_audience, BookCache.genre, BookCache.price
+    ).where(BookCache.isbn.in_(list(rows)))).all()
+    if is_available(connection):
+        index_books(connection, changed)
+    if facets_available(connection):
+        index_facets(connection, changed)
+    _notify_changed(list(rows))
+
+
+def _upsert_with_lookup(values):
+    """ON CONFLICT が使えない DB 向け: 1回の IN 検索で既存行を調べて登録・更新する"""
+    existing = {
+        book.isbn: book
+        for book in BookCache.query.filter(BookCache.isbn.in_([v['isbn'] for v in values]))
+    }
+    for value in values:
+        book = existing.get(value['isbn'])
+        if book is None:
+            db.session.add(BookCache(**value))
+            continue
+        for field in REFRESH_FIELDS:
+            if value[field]:
+                setattr(book, field, value[field])
+        book.cached_at = value['cached_at']
+    db.session.flush()
+
+
+class LRUCache:
+    """件数の上限と有効期限のあるスレッドセーフな LRU キャッシュ"""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class BookCachePolicy:
+    """BookCache の有効期限（TTL）・先読み更新・参照統計・件数上限による削除
+
+    - TTL を過ぎた行は期限切れとして扱い、呼び出し側で再取得する
+    - 参照の多い行は期限切れ前（TTL の refresh_ahead 割合を過ぎた時点）に
+      バックグラウンドで再取得する
+    - 参照回数・最終参照日時はメモリに溜めて定期的にまとめて書き込む
+    - 件数が max_entries を超えたら、最後に参照されたのが古い行から削除する
+      （分類・価格など手入力の項目がある行は削除しない）
+    - よく参照される書籍の to_dict() の結果をプロセス内の LRU に保持し、
+      上流に存在しない ISBN もしばらく記録して再問い合わせを避ける
+    """
+
+    def __init__(self, ttl=timedelta(days=30), refresh_ahead=0.8, hot_hits=5,
+                 max_entries=200000, maintenance_interval=300,
+                 memory_size=2048, memory_ttl=300, negative_ttl=3600, fetch_workers=8):
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self.hot_hits = hot_hits
+        self.max_entries = max_entries
+        self.maintenance_interval = maintenance_interval
+        self.memory = LRUCache(memory_size, memory_ttl)
+        self.negative = LRUCache(memory_size, negative_ttl)
+
+        self.metrics = Counter()
+        self._pending_hits = Counter()
+        self._last_access = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='book-cache-refresh')
+        # 一括検索で上流から取得するときの同時実行数の上限（全リクエストで共有）
+        self._fetch_executor = ThreadPoolExecutor(max_workers=fetch_workers, thread_name_prefix='book-fetch')
+        self._app = None
+        self._refresh = None
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            ttl=timedelta(seconds=int(os.getenv('BOOK_CACHE_TTL', 30 * 24 * 3600))),
+            refresh_ahead=float(os.getenv('BOOK_CACHE_REFRESH_AHEAD', 0.8)),
+            hot_hits=int(os.getenv('BOOK_CACHE_HOT_HITS', 5)),
+            max_entries=int(os.getenv('BOOK_CACHE_MAX_ENTRIES', 200000)),
+            maintenance_interval=int(os.getenv('BOOK_CACHE_MAINTENANCE_INTERVAL', 300)),
+            memory_size=int(os.getenv('BOOK_MEMORY_CACHE_SIZE', 2048)),
+            memory_ttl=int(os.getenv('BOOK_MEMORY_CACHE_TTL', 300)),
+            negative_ttl=int(os.getenv('BOOK_NEGATIVE_CACHE_TTL', 3600)),
+            fetch_workers=int(os.getenv('BOOKS_FETCH_WORKERS', 8)),
+        )
+
+    def start(self, app, refresh):
+        """バックグラウンド処理を開始する。refresh(isbn) は上流から再取得する関数"""
+        self._app = app
+        self._refresh = refresh
+        on_books_changed(self.invalidate)
+        if self.maintenance_interval > 0:
+            thread = threading.Thread(target=self._maintenance_loop, name='book-cache-maintenance', daemon=True)
+            thread.start()
+
+    def age(self, book):
+        if book.cached_at is None:
+            return self.ttl
+        return datetime.utcnow() - book.cached_at
+
+    def is_expired(self, book):
+        return self.age(book) >= self.ttl
+
+    def invalidate(self, isbns):
+        """変更された書籍をメモリキャッシュから取り除く"""
+        for isbn in isbns:
+            key = cache_key(isbn)
+            self.memory.invalidate(key)
+            self.negative.invalidate(key)
+
+    def get_book(self, isbn, fetch):
+        """ISBN の書籍データ（dict）を返す。見つからなければ None
+
+        メモリの LRU → BookCache → fetch(ISBN-13)（上流からの取得）の順に探す。
+        上流から取得できないときは期限切れのキャッシュを返す。上流が
+        「該当なし」と答えた ISBN は negative_ttl の間、問い合わせない。
+        """
+        key = cache_key(isbn)
+        found, payload = self._from_memory(key)
+        if found:
+            return payload
+
+        book = self.lookup(isbn)
+        if book is not None and not self.is_expired(book):
+            payload = book.to_dict()
+            self.memory.put(key, (book.id, payload))
+            return payload
+
+        books = self._fetch_upstream(key, fetch, remember_miss=book is None)
+        if books:
+            return books[0]
+        if book is not None:
+            return book.to_dict()
+        return None
+
+    def iter_books(self, isbns, fetch):
+        """複数の ISBN の書籍データを (入力された ISBN, 状態, 書籍データ) で順に返す
+
+        状態は found / not_found / invalid。BookCache は IN 検索1回で引き、
+        見つからない ISBN は上流から並行して取得して、取得できた順に返す。
+        fetch が None の場合は上流に問い合わせない（キャッシュのみ）。
+        """
+        pending = {}
+        for isbn in isbns:
+            key = canonical_isbn(isbn)
+            if key is None:
+                yield isbn, 'invalid', None
+                continue
+            found, payload = self._from_memory(key)
+            if found:
+                yield isbn, 'found' if payload else 'not_found', payload
+                continue
+            pending.setdefault(key, []).append(isbn)
+
+        stale = {}
+        keys = list(pending)
+        for start in range(0, len(keys), UPSERT_BATCH_SIZE):
+            for book in BookCache.query.filter(BookCache.isbn13.in_(keys[start:start + UPSERT_BATCH_SIZE])):
+                if book.isbn13 not in pending or book.isbn13 in stale:
+                    continue
+                self._record_access(book.id)
+                payload = book.to_dict()
+                if self.is_expired(book):
+                    self.metrics['stale_hits'] += 1
+                    stale[book.isbn13] = payload
+                    continue
+                self.metrics['hits'] += 1
+                self.memory.put(book.isbn13, (book.id, payload))
+                for isbn in pending.pop(book.isbn13):
+                    yield isbn, 'found', payload
+
+        self.metrics['misses'] += len(pending) - len(stale)
+        if fetch is None:
+            for key, isbns in pending.items():
+                for isbn in isbns:
+                    yield isbn, 'found' if key in stale else 'not_found', stale.get(key)
+            return
+        futures = {
+            self._fetch_executor.submit(self._fetch_in_context, key, fetch, key not in stale): key
+            for key in pending
+        }
+        for future in as_completed(futures):
+            key = futures[future]
+            books = future.result()
+            payload = books[0] if books else stale.get(key)
+            for isbn in pending[key]:
+                yield isbn, 'found' if payload else 'not_found', payload
+
+    def _from_memory(self, key):
+        """メモリキャッシュを引く。(見つかったか, 書籍データ) を返す（該当なしの記録は None）"""
+        entry = self.memory.get(key)
+        if entry is not None:
+            book_id, payload = entry
+            self.metrics['memory_hits'] += 1
+            self._record_access(book_id)
+            return True, payload
+        if self.negative.get(key):
+            self.metrics['negative_hits'] += 1
+            return True, None
+        return False, None
+
+    def _fetch_upstream(self, key, fetch, remember_miss=True):
+        """正規化した ISBN（key）で上流から取得する。失敗時は None を返す
+
+        該当なしの場合、remember_miss が真なら negative キャッシュに記録する。
+        """
+        try:
+            books = fetch(key)
+        except CircuitOpenError:
+            return None
+        except Exception as e:
+            print(f"Google Books API エラー: {str(e)}")
+            db.session.rollback()
+            return None
+        if not books and remember_miss:
+            self.negative.put(key, True)
+        return books
+
+    def _fetch_in_context(self, key, fetch, remember_miss):
+        with self._app.app_context():
+            return self._fetch_upstream(key, fetch, remember_miss)
+
+    def lookup(self, isbn):
+        """ISBN でキャッシュを引き、参照統計を記録する。期限切れの行もそのまま返す"""
+        canonical = canonical_isbn(isbn)
+        if canonical:
+            # ISBN-10/13・ハイフンの有無に関わらず isbn13 の索引1回で引く
+            book = BookCache.query.filter_by(isbn13=canonical) \
+                .order_by(BookCache.cached_at.desc()).first()
+        else:
+            book = BookCache.query.filter_by(isbn=normalize_isbn(isbn)).first()
+        if book is None:
+            self.metrics['misses'] += 1
+            return None
+
+        self._record_access(book.id)
+        if self.is_expired(book):
+            self.metrics['stale_hits'] += 1
+        else:
+            self.metrics['hits'] += 1
+            if self._is_hot(book) and self.age(book) >= self.ttl * self.refresh_ahead:
+                self._schedule_refresh(book.isbn)
+        return book
+
+    def _is_hot(self, book):
+        with self._lock:
+            pending = self._pending_hits.get(book.id, 0)
+        return (book.hit_count or 0) + pending >= self.hot_hits
+
+    def _record_access(self, book_id):
+        with self._lock:
+            self._pending_hits[book_id] += 1
+            self._last_access[book_id] = datetime.utcnow()
+
+    def _schedule_refresh(self, isbn):
+        if self._refresh is None:
+            return
+        with self._lock:
+            if isbn in self._refreshing:
+                return
+            self._refreshing.add(isbn)
+        self._executor.submit(self._run_refresh, isbn)
+
+    def _run_refresh(self, isbn):
+        try:
+            with self._app.app_context():
+                self._refresh(isbn)
+                self.metrics['refreshes'] += 1
+        except Exception as e:
+            print(f"キャッシュの先読み更新エラー: {str(e)}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(isbn)
+
+    def flush_access_stats(self):
+        """メモリに溜めた参照回数・最終参照日時を書き込む"""
+        with self._lock:
+            hits, self._pending_hits = self._pending_hits, Counter()
+            last_access, self._last_access = self._last_access, {}
+        if not hits:
+            return
+        db.session.execute(
+            text('UPDATE book_cache SET hit_count = COALESCE(hit_count, 0) + :hits, '
+                 'last_accessed_at = :accessed_at WHERE id = :id'),
+            [{'id': book_id, 'hits': count, 'accessed_at': last_access[book_id]}
+             for book_id, count in hits.items()]
+        )
+        db.session.commit()
+
+    def evict_cold_entries(self):
+        """件数の上限を超えた分を、参照が古い順に削除する"""
+        # 件数・削除対象を読んでから削除するまでを、最初から書き込みのロックを取った1つのトランザクションで行う
+        db.session.commit()
+        with write_intent():
+            cold = self._delete_cold_entries()
+            db.session.commit()
+        if not cold:
+            return 0
+        _notify_changed([row.isbn for row in cold])
+        self.metrics['evictions'] += len(cold)
+        return len(cold)
+
+    def _delete_cold_entries(self):
+        excess = BookCache.query.count() - self.max_entries
+        if excess <= 0:
+            return []
+        cold = db.session.query(BookCache.id, BookCache.isbn).filter(
+            BookCache.target_audience.is_(None),
+            BookCache.genre.is_(None),
+            BookCache.price.is_(None)
+        ).order_by(func.coalesce(BookCache.last_accessed_at, BookCache.cached_at)).limit(excess).all()
+        if not cold:
+            return []
+        cold_ids = [row.id for row in cold]
+        BookCache.query.filter(BookCache.id.in_(cold_ids)).delete(synchronize_session=False)
+        connection = db.session.connection()
+        if is_available(connection):
+            unindex_books(connection, cold_ids)
+        if facets_available(connection):
+            unindex_facets(connection, cold_ids)
+        return cold
+
+    def run_maintenance(self):
+        self.flush_access_stats()
+        self.evict_cold_entries()
+
+    def _maintenance_loop(self):
+        stop = threading.Event()
+        while not stop.wait(self.maintenance_interval):
+            try:
+                with self._app.app_context():
+                    self.run_maintenance()
+            except Exception as e:
+                print(f"キャッシュの定期処理エラー: {str(e)}")
+
+    def stats(self):
+        """ヒット率などの指標とキャッシュの件数を返す"""
+        metrics = dict(self.metrics)
+        lookups = metrics.get('hits', 0) + metrics.get('stale_hits', 0) + metrics.get('misses', 0)
+        stale_before = datetime.utcnow() - self.ttl
+        return {
+            'memory_hits': metrics.get('memory_hits', 0),
+            'negative_hits': metrics.get('negative_hits', 0),
+            'memory_entries': len(self.memory),
+            'hits': metrics.get('hits', 0),
+            'stale_hits': metrics.get('stale_hits', 0),
+            'misses': metrics.get('misses', 0),
+            'hit_ratio': (metrics.get('hits', 0) / lookups) if lookups else None,
+            'refreshes': metrics.get('refreshes', 0),
+            'evictions': metrics.get('evictions', 0),
+            'entries': BookCache.query.count(),
+            'stale_entries': BookCache.query.filter(
+                (BookCache.cached_at < stale_before) | BookCache.cached_at.is_(None)
+            ).count(),
+            'max_entries': self.max_entries,
+            'ttl_seconds': int(self.ttl.total_seconds())
+        }
@@ -0,0 +1,189 @@
+"""Google Books API クライアント
+
+- requests.Session による接続の再利用（keep-alive）
+- 同一クエリの同時リクエストを1回の呼び出しにまとめる（single-flight）
+- 429 / 5xx に対するジッター付き指数バックオフでの再試行
+- 上流が遅い・失敗が続く場合に呼び出しを止めるサーキットブレーカー
+
+接続先は GOOGLE_BOOKS_API_URL で差し替えられるため、テストではローカルの
+偽サーバーを指定できる。
+"""
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_API_URL = 'https://www.googleapis.com/books/v1/volumes'
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class BooksApiError(Exception):
+    """Google Books API の呼び出しに失敗した"""
+
+
+class CircuitOpenError(BooksApiError):
+    """サーキットブレーカーが開いているため呼び出しを行わなかった"""
+
+
+class CircuitBreaker:
+    """連続失敗・低速応答が続いたら一定時間呼び出しを遮断する"""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, slow_threshold=3.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.slow_threshold = slow_threshold
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self._opened_at is not None
+
+    def allow(self):
+        """呼び出してよいか判定する。遮断時間経過後は1件だけ試行を許可する"""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._trial_running:
+                return False
+            self._trial_running = True
+            return True
+
+    def record_success(self, elapsed):
+        if elapsed > self.slow_threshold:
+            self.record_failure()
+            return
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+
+class _Call:
+    """single-flight で共有される実行中の呼び出し"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class BooksClient:
+    def __init__(self, api_url=DEFAULT_API_URL, api_key='', timeout=(3.05, 5.0),
+                 max_retries=2, backoff_base=0.5, backoff_max=4.0, pool_size=10,
+                 breaker=None):
+        self.api_url = api_url
+        self.api_key = api_key
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            api_url=os.getenv('GOOGLE_BOOKS_API_URL', DEFAULT_API_URL),
+            api_key=os.getenv('GOOGLE_BOOKS_API_KEY', ''),
+            breaker=CircuitBreaker(
+                failure_threshold=int(os.getenv('GOOGLE_BOOKS_BREAKER_FAILURES', 5)),
+                reset_timeout=float(os.getenv('GOOGLE_BOOKS_BREAKER_RESET', 30)),
+                slow_threshold=float(os.getenv('GOOGLE_BOOKS_SLOW_THRESHOLD', 3)),
+            )
+        )
+
+    def search_volumes(self, query, max_results=10):
+        """キーワードで検索し、API のレスポンス（JSON）を返す"""
+        return self._single_flight(('q', query, max_results),
+                                   lambda: self._get({'q': query, 'maxResults': max_results}))
+
+    def lookup_isbn(self, isbn):
+        """ISBN で検索し、API のレスポンス（JSON）を返す"""
+        return self._single_flight(('isbn', isbn), lambda: self._get({'q': f'isbn:{isbn}'}))
+
+    def _single_flight(self, key, fn):
+        with self._lock:
+            call = self._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = self._inflight[key] = _Call()
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            call.event.set()
+
+    def _get(self, params):
+        if not self.breaker.allow():
+            raise CircuitOpenError('Google Books API は一時的に停止中です')
+        if self.api_key:
+            params = dict(params, key=self.api_key)
+
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            try:
+                response = self.session.get(self.api_url, params=params, timeout=self.timeout)
+            except requests.RequestException as e:
+                error, response = e, None
+            else:
+                error = None
+
+            if response is not None and response.status_code not in RETRY_STATUS_CODES:
+                if response.ok:
+                    self.breaker.record_success(time.monotonic() - started)
+                    return response.json()
+                # 4xx は再試行しても結果が変わらないためそのまま失敗とする
+                self.breaker.record_success(time.monotonic() - started)
+                raise BooksApiError(f'HTTP {response.status_code}')
+
+            self.breaker.record_failure()
+            if attempt >= self.max_retries or not self.breaker.allow():
+                if error is not None:
+                    raise BooksApiError(str(error)) from error
+                raise BooksApiError(f'HTTP {response.status_code}')
+            time.sleep(self._backoff(attempt, response))
+            attempt += 1
+
+    def _backoff(self, attempt, response):
+        """待ち時間を決める（Retry-After を優先し、なければフルジッター）"""
+        if response is not None:
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                return min(float(retry_after), self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
@@ -0,0 +1,188 @@
+"""パスワードのハッシュ化・検証とログインの試行回数制限
+
+ハッシュの計算（scrypt / pbkdf2）は CPU を使うため、プロセスプールで行う。
+計算待ちが上限に達したら待たずに CredentialsBusy を送出し、ログインが集中しても
+リクエストを溜め込まない。ハッシュ方式（PASSWORD_HASH_METHOD）を変えた場合は、
+ログインに成功したときに新しい方式で計算し直したハッシュを返す。
+
+プールのプロセスは fork で作るため、PasswordHasher.start() はアプリケーションが
+ほかのスレッドを開始する前に呼ぶ。
+"""
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, generate_password_hash, check_password_hash
+
+# Werkzeug 3.0 の既定と同じ（N=32768, r=8, p=1）
+DEFAULT_METHOD = 'scrypt:32768:8:1'
+
+
+def normalize_method(method):
+    """ハッシュ方式を (アルゴリズム, パラメータ...) に揃える
+
+    Werkzeug と同じ既定値で省略されたパラメータを補い、'pbkdf2' と
+    'pbkdf2:sha256:600000' のような同じ方式の書き方の違いを同一とみなす。
+    """
+    name, *args = method.split(':')
+    if name == 'scrypt':
+        return (name, *(map(int, args) if args else (2 ** 15, 8, 1)))
+    if name == 'pbkdf2':
+        hash_name = args[0] if args else 'sha256'
+        iterations = int(args[1]) if len(args) > 1 else DEFAULT_PBKDF2_ITERATIONS
+        return (name, hash_name, iterations)
+    return (name, *args)
+
+
+def _hash(password, method):
+    return generate_password_hash(password, method=method)
+
+
+def _verify(stored_hash, password, method):
+    """(一致したか, 計算し直したハッシュ) を返す。方式が同じなら計算し直さない"""
+    if not check_password_hash(stored_hash, password):
+        return False, None
+    if normalize_method(stored_hash.split('$', 1)[0]) != normalize_method(method):
+        return True, generate_password_hash(password, method=method)
+    return True, None
+
+
+class CredentialsBusy(Exception):
+    """ハッシュの計算待ちが上限に達した"""
+
+
+class PasswordHasher:
+    """パスワードのハッシュ化・検証（workers=0 の場合はプールを使わずその場で計算する）"""
+
+    def __init__(self, method=DEFAULT_METHOD, workers=2, max_pending=32, timeout=10):
+        self.method = method
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            method=os.getenv('PASSWORD_HASH_METHOD', DEFAULT_METHOD),
+            workers=int(os.getenv('PASSWORD_HASH_WORKERS', 2)),
+            max_pending=int(os.getenv('PASSWORD_HASH_MAX_PENDING', 32)),
+            timeout=float(os.getenv('PASSWORD_HASH_TIMEOUT', 10)),
+        )
+
+    def start(self):
+        """プールのプロセスを起動しておく
+
+        プロセスは fork で作るため（spawn ではアプリケーションが読み込み直される）、
+        ほかのスレッドを開始する前に呼ぶこと。
+        """
+        if self.workers:
+            self._pool().submit(int).result()
+
+    def _pool(self):
+        with self._lock:
+            # gunicorn のワーカープロセスごとに作る（親プロセスのプールは引き継げない）
+            if self._executor is None or self._pid != os.getpid():
+                context = multiprocessing.get_context('fork')
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+                self._pid = os.getpid()
+            return self._executor
+
+    def _discard_pool(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def _run(self, func, *args):
+        if not self.workers:
+            return func(*args)
+        if not self._slots.acquire(blocking=False):
+            raise CredentialsBusy()
+        executor = self._pool()
+        try:
+            future = executor.submit(func, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        # 待ちきれずに戻った場合も、計算が終わるまでは枠を空けない
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            raise CredentialsBusy()
+        except BrokenProcessPool:
+            # プロセスが強制終了された場合など。次の呼び出しで作り直す
+            self._discard_pool(executor)
+            raise CredentialsBusy()
+
+    def hash(self, password):
+        return self._run(_hash, password, self.method)
+
+    def verify(self, stored_hash, password):
+        """(一致したか, 新しいハッシュ) を返す。新しいハッシュは方式が変わった場合のみ"""
+        return self._run(_verify, stored_hash, password, self.method)
+
+
+class LoginRateLimiter:
+    """ログインの失敗をアカウント・IP アドレスごとに数え、上限に達したら一定時間拒否する
+
+    ハッシュを計算する前に判定できるよう、プロセスのメモリ上で数える
+    （gunicorn のワーカーごとに数えるため、上限は目安）。
+    """
+
+    def __init__(self, account_limit=5, ip_limit=50, window=900, max_keys=100000):
+        self.account_limit = account_limit
+        self.ip_limit = ip_limit
+        self.window = window
+        self.max_keys = max_keys
+        self._failures = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            account_limit=int(os.getenv('LOGIN_MAX_FAILURES', 5)),
+            ip_limit=int(os.getenv('LOGIN_IP_MAX_FAILURES', 50)),
+            window=int(os.getenv('LOGIN_FAILURE_WINDOW', 900)),
+        )
+
+    def _recent(self, key, now):
+        failures = self._failures.get(key)
+        while failures and failures[0] <= now - self.window:
+            failures.popleft()
+        return failures
+
+    def retry_after(self, account, ip):
+        """拒否する場合は再試行までの秒数、拒否しない場合は 0"""
+        now = time.monotonic()
+        wait = 0
+        with self._lock:
+            for key, limit in ((('account', account), self.account_limit), (('ip', ip), self.ip_limit)):
+                failures = self._recent(key, now)
+                if failures and len(failures) >= limit:
+                    wait = max(wait, int(failures[-limit] + self.window - now) + 1)
+        return wait
+
+    def record_failure(self, account, ip):
+        now = time.monotonic()
+        with self._lock:
+            if len(self._failures) >= self.max_keys:
+                self._prune(now)
+            for key in (('account', account), ('ip', ip)):
+                self._failures.setdefault(key, deque()).append(now)
+
+    def reset(self, account):
+        """ログインに成功したアカウントの失敗回数を消す"""
+        with self._lock:
+            self._failures.pop(('account', account), None)
+
+    def _prune(self, now):
+        for key in [key for key in self._failures if not self._recent(key, now)]:
+            del self._failures[key]
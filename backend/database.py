@@ -0,0 +1,199 @@
+"""データベースエンジンの設定
+
+SQLite では接続ごとに PRAGMA を設定する。WAL モードにすると読み取りと書き込みが
+互いを待たなくなり、gunicorn の複数のワーカーから書き込んでも
+"database is locked" になりにくい。書き込みが重なった場合は busy_timeout の間だけ待つ。
+
+WAL では、読み取りから始めたトランザクションが途中で書き込もうとしたときに
+他の書き込みが先にコミットしていると、待たずに "database is locked" になる。
+そのため読み取ってから書き込む短い処理は、@write_transaction（ルート）または
+write_intent()（ブロック）の中で BEGIN IMMEDIATE で始め、最初から書き込みのロックを取る。
+ロックはコミットまで他の書き込みを待たせるので、上流への問い合わせやパスワードの
+ハッシュ計算など時間のかかる処理はその外で行うこと。
+
+PostgreSQL では DATABASE_URL に postgresql:// の URL を指定する。DATABASE_REPLICA_URL を
+指定すると、@read_replica を付けたルート（一覧・検索・エクスポート）と replica_reads() の
+中の SELECT はリードレプリカに送り、書き込みと SELECT ... FOR UPDATE はプライマリに送る。
+レプリカは遅れて反映されるため、書き込んだ直後に読み直す処理には使わないこと。
+"""
+import os
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from flask import g, has_app_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+# SQLALCHEMY_BINDS でのリードレプリカの名前
+REPLICA_BIND = 'replica'
+
+_write_intent = ContextVar('write_intent', default=False)
+_replica_reads = ContextVar('replica_reads', default=False)
+
+
+def normalize_url(url):
+    """Heroku / Render 形式の postgres:// を SQLAlchemy の postgresql:// に直す"""
+    if url and url.startswith('postgres://'):
+        return 'postgresql://' + url[len('postgres://'):]
+    return url
+
+
+@contextmanager
+def write_intent():
+    """このブロックの中で始めるトランザクションは最初から書き込みのロックを取る"""
+    token = _write_intent.set(True)
+    try:
+        yield
+    finally:
+        _write_intent.reset(token)
+
+
+def write_transaction(view):
+    """GET 以外のリクエストでは、トランザクションを最初から書き込みのロックを取って始める"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method in ('GET', 'HEAD', 'OPTIONS'):
+            return view(*args, **kwargs)
+        with write_intent():
+            return view(*args, **kwargs)
+    return wrapper
+
+
+def read_replica(view):
+    """このルートの SELECT をリードレプリカに送る（レプリカが無ければプライマリ）
+
+    ストリーミングで返すエクスポートはルートを抜けた後も読み続けるため、
+    リクエストが終わるまで g に印を残す。
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.use_replica = True
+        return view(*args, **kwargs)
+    return wrapper
+
+
+@contextmanager
+def replica_reads():
+    """このブロックの中の SELECT をリードレプリカに送る（ジョブなど、リクエストの外で使う）"""
+    token = _replica_reads.set(True)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def _replica_requested():
+    if _replica_reads.get():
+        return True
+    return has_app_context() and g.get('use_replica', False)
+
+
+class RoutingSession(Session):
+    """読み取りの SELECT をリードレプリカに、それ以外をプライマリに送るセッション"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (
+            bind is None
+            and not self._flushing
+            and clause is not None
+            and getattr(clause, 'is_select', False)
+            and getattr(clause, '_for_update_arg', None) is None
+            and _replica_requested()
+        ):
+            replica = self._db.engines.get(REPLICA_BIND)
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+class DatabaseConfig:
+    """接続プールと SQLite の PRAGMA の設定"""
+
+    def __init__(self, pool_size=5, max_overflow=10, pool_timeout=30, pool_recycle=1800,
+                 journal_mode='WAL', synchronous='NORMAL', busy_timeout=5000,
+                 mmap_size=128 * 1024 * 1024, cache_size=-16000, temp_store='MEMORY'):
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.pool_timeout = pool_timeout
+        self.pool_recycle = pool_recycle
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.busy_timeout = busy_timeout
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
+        self.temp_store = temp_store
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            pool_size=int(os.getenv('DB_POOL_SIZE', 5)),
+            max_overflow=int(os.getenv('DB_MAX_OVERFLOW', 10)),
+            pool_timeout=int(os.getenv('DB_POOL_TIMEOUT', 30)),
+            pool_recycle=int(os.getenv('DB_POOL_RECYCLE', 1800)),
+            journal_mode=os.getenv('SQLITE_JOURNAL_MODE', 'WAL'),
+            synchronous=os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL'),
+            busy_timeout=int(os.getenv('SQLITE_BUSY_TIMEOUT', 5000)),
+            mmap_size=int(os.getenv('SQLITE_MMAP_SIZE', 128 * 1024 * 1024)),
+            cache_size=int(os.getenv('SQLITE_CACHE_SIZE', -16000)),
+            temp_store=os.getenv('SQLITE_TEMP_STORE', 'MEMORY'),
+        )
+
+    def pragmas(self):
+        """接続ごとに設定する PRAGMA（journal_mode はファイルに保存されるので install で1回だけ）"""
+        return [
+            ('busy_timeout', self.busy_timeout),
+            ('synchronous', self.synchronous),
+            ('mmap_size', self.mmap_size),
+            ('cache_size', self.cache_size),
+            ('temp_store', self.temp_store),
+        ]
+
+    def engine_options(self, url):
+        """SQLALCHEMY_ENGINE_OPTIONS（レプリカは SQLALCHEMY_BINDS）に設定する値"""
+        url = make_url(normalize_url(url))
+        if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+            # メモリ上のデータベースは接続ごとに別物になるため、プールの設定は変えない
+            return {}
+        options = {
+            'pool_size': self.pool_size,
+            'max_overflow': self.max_overflow,
+            'pool_timeout': self.pool_timeout,
+        }
+        if url.get_backend_name() == 'sqlite':
+            # pysqlite の既定（5秒）ではなく busy_timeout に合わせて待つ
+            options['connect_args'] = {'timeout': self.busy_timeout / 1000}
+        else:
+            # サーバー側で切られた接続（再起動・アイドルタイムアウト）を使う前に検出する
+            options['pool_pre_ping'] = True
+            options['pool_recycle'] = self.pool_recycle
+        return options
+
+    def install(self, engine):
+        """SQLite のエンジンに PRAGMA と BEGIN の設定を組み込む"""
+        if engine.dialect.name != 'sqlite':
+            return
+
+        @event.listens_for(engine, 'connect')
+        def set_pragmas(dbapi_connection, connection_record):
+            # pysqlite が自前で BEGIN を発行しないようにし、下の begin で発行する
+            dbapi_connection.isolation_level = None
+            cursor = dbapi_connection.cursor()
+            for name, value in self.pragmas():
+                cursor.execute(f'PRAGMA {name}={value}')
+            cursor.close()
+
+        @event.listens_for(engine, 'begin')
+        def begin(connection):
+            connection.exec_driver_sql('BEGIN IMMEDIATE' if _write_intent.get() else 'BEGIN')
+
+        if self.journal_mode and engine.url.database not in (None, '', ':memory:'):
+            # トランザクションの外で実行する必要があるため、DB-API の接続を直接使う
+            connection = engine.raw_connection()
+            try:
+                mode = connection.cursor().execute(f'PRAGMA journal_mode={self.journal_mode}').fetchone()[0]
+            finally:
+                connection.close()
+            if mode.lower() != self.journal_mode.lower():
+                print(f"SQLite の journal_mode を {self.journal_mode} にできませんでした（現在: {mode}）")
@@ -0,0 +1,416 @@
+"""注文データ・選書リストのエクスポート
+
+行の供給元（ExportSource）と書き出し形式（ExportWriter）を組み合わせて出力する。
+出力結果は「供給元・形式・オプション・データの指紋」のハッシュをキーに
+ExportCache（ディスク）に保存するため、データが変わっていなければ
+明細の読み出しもファイルの生成も行わずに返せる。キーは ETag としても使う。
+"""
+import csv
+import hashlib
+import json
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+from io import StringIO
+
+from openpyxl import Workbook
+from sqlalchemy import func
+
+from models import db, Customer, Order, OrderItem, BookSelectionItem
+from pdf_render import LAYOUT_VERSION, render_selection_list, selection_list_document
+
+ORDER_ITEM_HEADER = ['注文ID', '注文日', '顧客名', '組織', 'ISBN', '書名', '著者', '出版社', '数量']
+SELECTION_LIST_HEADER = ['ISBN', '書名', '著者', '出版社', '本体価格（税別）', '数量', '合計金額（税別）']
+
+
+def parse_order_filters(args):
+    """クエリパラメータ（start_date, end_date, status）から絞り込み条件を作る
+
+    日付は YYYY-MM-DD 形式。不正な値の場合は ValueError を送出する。
+    """
+    filters = {}
+    for key in ('start_date', 'end_date'):
+        value = args.get(key)
+        if value:
+            try:
+                filters[key] = datetime.strptime(value, '%Y-%m-%d')
+            except ValueError:
+                raise ValueError(f'{key} は YYYY-MM-DD 形式で指定してください')
+    if args.get('status'):
+        filters['status'] = args['status']
+    return filters
+
+
+def _filter_orders(query, start_date=None, end_date=None, status=None):
+    if start_date:
+        query = query.filter(Order.order_date >= start_date)
+    if end_date:
+        # 終了日はその日の終わりまでを含める
+        query = query.filter(Order.order_date < end_date + timedelta(days=1))
+    if status:
+        query = query.filter(Order.status == status)
+    return query
+
+
+def order_item_rows(start_date=None, end_date=None, status=None, batch_size=500):
+    """注文明細を1行ずつ返す（注文・顧客を結合した1クエリをバッチで読み出す）"""
+    query = db.session.query(
+        Order.id, Order.order_date, Customer.name, Customer.organization,
+        OrderItem.isbn, OrderItem.title, OrderItem.author, OrderItem.publisher,
+        OrderItem.quantity
+    ).join(Order, OrderItem.order_id == Order.id) \
+        .join(Customer, Order.customer_id == Customer.id)
+    query = _filter_orders(query, start_date, end_date, status)
+
+    query = query.order_by(Order.order_date.desc(), Order.id.desc(), OrderItem.id) \
+        .execution_options(yield_per=batch_size)
+
+    for row in query:
+        yield [
+            row[0],
+            row[1].strftime('%Y-%m-%d') if row[1] else '',
+            row[2],
+            row[3] or '',
+            row[4] or '',
+            row[5],
+            row[6] or '',
+            row[7] or '',
+            row[8]
+        ]
+
+
+# --- 行の供給元 ---
+
+class ExportSource:
+    """エクスポートする行の供給元
+
+    fingerprint() はデータが変われば変わる値を安く求め、rows() は行を順に返す。
+    summary() は rows() を読み終えた後に呼ばれ、末尾の集計行（無ければ None）を返す。
+    """
+    name = None
+    header = []
+
+    def fingerprint(self):
+        raise NotImplementedError
+
+    def rows(self):
+        raise NotImplementedError
+
+    def summary(self):
+        return None
+
+
+class OrderItemSource(ExportSource):
+    """管理者向けの注文明細一覧"""
+    name = 'orders'
+    header = ORDER_ITEM_HEADER
+
+    def __init__(self, filters):
+        self.filters = filters
+
+    def fingerprint(self):
+        # 注文・明細はアプリからは追加しかされないので、件数・最新の注文日・
+        # 最大の明細 ID が同じなら内容も同じ（集計クエリ1回で求める）
+        query = db.session.query(
+            func.count(OrderItem.id), func.max(Order.order_date), func.max(OrderItem.id)
+        ).join(Order, OrderItem.order_id == Order.id)
+        count, last_order_date, last_item_id = _filter_orders(query, **self.filters).one()
+        return [count, last_order_date.isoformat() if last_order_date else None, last_item_id]
+
+    def rows(self):
+        return order_item_rows(**self.filters)
+
+
+class SelectionListSource(ExportSource):
+    """選書リストの明細（PDF の場合は注文者情報も使う）"""
+    name = 'selection_list'
+    header = SELECTION_LIST_HEADER
+
+    def __init__(self, book_list, user=None):
+        self.book_list = book_list
+        self.user = user
+        self._total_amount = 0
+        self._document = None
+
+    def fingerprint(self):
+        # 明細の追加・変更・削除のたびに選書リストの updated_at が更新される
+        book_list = self.book_list
+        values = [book_list.id, book_list.updated_at.isoformat() if book_list.updated_at else None]
+        if self.user is not None:
+            user = self.user
+            values += [user.id, user.full_name, user.username, user.organization, user.email, user.phone]
+        return values
+
+    def rows(self, batch_size=500):
+        self._total_amount = 0
+        query = db.session.query(
+            BookSelectionItem.isbn, BookSelectionItem.title, BookSelectionItem.author,
+            BookSelectionItem.publisher, BookSelectionItem.price, BookSelectionItem.quantity
+        ).filter(BookSelectionItem.list_id == self.book_list.id) \
+            .order_by(BookSelectionItem.id).execution_options(yield_per=batch_size)
+        for isbn, title, author, publisher, price, quantity in query:
+            subtotal = (price or 0) * quantity
+            self._total_amount += subtotal
+            yield [isbn or '', title, author or '', publisher or '', price or 0, quantity, subtotal]
+
+    def summary(self):
+        return ['合計', '', '', '', '', '', self._total_amount]
+
+    def document(self):
+        """PDF に載せる内容（1回だけ読み出す）"""
+        if self._document is None:
+            self._document = selection_list_document(self.book_list, self.user)
+        return self._document
+
+
+class TrackedSource(ExportSource):
+    """別の供給元の行を返しながら、every 件ごとに track(件数) を呼ぶ（ジョブの進捗報告用）"""
+
+    def __init__(self, source, track, every=500):
+        self.source = source
+        self.track = track
+        self.every = every
+        self.name = source.name
+        self.header = source.header
+
+    def fingerprint(self):
+        return self.source.fingerprint()
+
+    def rows(self):
+        count = 0
+        for count, row in enumerate(self.source.rows(), 1):
+            if count % self.every == 0:
+                self.track(count)
+            yield row
+        self.track(count)
+
+    def summary(self):
+        return self.source.summary()
+
+    def document(self):
+        return self.source.document()
+
+
+# --- 書き出し形式 ---
+
+class ExportWriter:
+    """書き出し形式
+
+    write(source, output, **options) はバイナリのファイルオブジェクトに書き出す。
+    streaming が真の形式は iter_bytes() でチャンクごとに返せる。
+    出力の形式を変えたら version を上げる（キャッシュ済みの古い結果を使わないため）。
+    """
+    extension = None
+    mimetype = None
+    streaming = False
+    version = 1
+
+    def write(self, source, output, **options):
+        for chunk in self.iter_bytes(source, **options):
+            output.write(chunk)
+
+    def iter_bytes(self, source, **options):
+        raise NotImplementedError
+
+
+class CsvWriter(ExportWriter):
+    extension = 'csv'
+    mimetype = 'text/csv'
+    streaming = True
+
+    def iter_bytes(self, source, chunk_rows=500):
+        """CSV を UTF-8（BOM 付き）のチャンク単位で返す"""
+        buffer = StringIO()
+        # Excel で文字化けしないよう先頭に BOM を付ける
+        buffer.write('\ufeff')
+        writer = csv.writer(buffer)
+        writer.writerow(source.header)
+        for count, row in enumerate(source.rows(), 1):
+            writer.writerow(row)
+            if count % chunk_rows == 0:
+                yield _flush(buffer)
+        summary = source.summary()
+        if summary is not None:
+            writer.writerow([])  # 空行
+            writer.writerow(summary)
+        yield _flush(buffer)
+
+
+class JsonWriter(ExportWriter):
+    extension = 'json'
+    mimetype = 'application/json'
+    streaming = True
+
+    def iter_bytes(self, source, chunk_rows=500):
+        """{"columns": [...], "rows": [[...], ...], "summary": [...]} を順に返す"""
+        parts = ['{"columns": ', json.dumps(source.header, ensure_ascii=False), ', "rows": [']
+        for count, row in enumerate(source.rows()):
+            parts.append((', ' if count else '') + json.dumps(row, ensure_ascii=False, default=str))
+            if len(parts) >= chunk_rows:
+                yield ''.join(parts).encode('utf-8')
+                parts = []
+        parts.append('], "summary": ' + json.dumps(source.summary(), ensure_ascii=False, default=str) + '}')
+        yield ''.join(parts).encode('utf-8')
+
+
+class XlsxWriter(ExportWriter):
+    extension = 'xlsx'
+    mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+    def write(self, source, output, sheet_title='注文一覧', split_by_month=False):
+        """行データを write-only モードの Excel に書き出す
+
+        split_by_month が真の場合は注文日（2列目）の年月ごとにシートを分ける。
+        行は注文日順に並んでいる前提。
+        """
+        wb = Workbook(write_only=True)
+        ws = None
+        current_month = None
+        for row in source.rows():
+            month = row[1][:7] if split_by_month else None
+            if ws is None or month != current_month:
+                ws = wb.create_sheet(title=month or sheet_title)
+                ws.append(source.header)
+                current_month = month
+            ws.append(row)
+        if ws is None:
+            ws = wb.create_sheet(title=sheet_title)
+            ws.append(source.header)
+        summary = source.summary()
+        if summary is not None:
+            ws.append([])
+            ws.append(summary)
+        wb.save(output)
+
+
+class PdfWriter(ExportWriter):
+    """選書リストの注文書（SelectionListSource のみ）
+
+    source.document() を先に呼んでおけば、DB にアクセスせずに書き出せる。
+    """
+    extension = 'pdf'
+    mimetype = 'application/pdf'
+    version = LAYOUT_VERSION
+
+    def write(self, source, output):
+        render_selection_list(source.document(), output)
+
+
+WRITERS = {
+    'csv': CsvWriter(),
+    'json': JsonWriter(),
+    'xlsx': XlsxWriter(),
+    'pdf': PdfWriter(),
+}
+
+
+def export_key(source, fmt, **options):
+    """出力結果のキャッシュキー（ETag にも使う）"""
+    writer = WRITERS[fmt]
+    material = json.dumps(
+        [source.name, fmt, writer.version, sorted(options.items()), source.fingerprint()],
+        ensure_ascii=False, default=str
+    )
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()[:32]
+
+
+def _flush(buffer):
+    data = buffer.getvalue().encode('utf-8')
+    buffer.seek(0)
+    buffer.truncate(0)
+    return data
+
+
+# --- 出力結果のキャッシュ ---
+
+class ExportCache:
+    """出力結果をキーごとにファイルで保存するキャッシュ
+
+    ファイルは一時ファイルに書き出してから置き換えるので、書き込み途中の
+    ファイルが読まれることはない。ファイル数が上限を超えたら、最後に
+    使われてから時間が経ったものから削除する。
+    """
+
+    def __init__(self, cache_dir, max_files=200):
+        self.cache_dir = cache_dir
+        self.max_files = max_files
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            cache_dir=os.getenv('EXPORT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'book-order-exports')),
+            max_files=int(os.getenv('EXPORT_CACHE_MAX_FILES', 200)),
+        )
+
+    def path(self, key, extension):
+        return os.path.join(self.cache_dir, f'{key}.{extension}')
+
+    def get(self, key, extension):
+        """保存済みのファイルのパス。無ければ None"""
+        path = self.path(key, extension)
+        try:
+            # 最後に使われた時刻として更新する
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def store(self, key, extension, write):
+        """write(ファイルオブジェクト) で書き出した結果を保存し、パスを返す"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            path = self.path(key, extension)
+            os.replace(tmp_path, path)
+        except BaseException:
+            self._discard(tmp_path)
+            raise
+        self.prune()
+        return path
+
+    def store_stream(self, key, extension, chunks):
+        """チャンクをそのまま返しつつ保存する（最後まで読まれた場合だけ保存する）"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+            os.replace(tmp_path, self.path(key, extension))
+        except BaseException:
+            # クライアントの切断（GeneratorExit）を含む
+            self._discard(tmp_path)
+            raise
+        self.prune()
+
+    def prune(self):
+        """上限を超えたファイルと、取り残された一時ファイル・生成の印を削除する
+
+        一時ファイルと PDF 生成の印（.pending / .error）は1時間を過ぎたら削除する。
+        """
+        files = []
+        now = time.time()
+        for entry in os.scandir(self.cache_dir):
+            try:
+                mtime = entry.stat().st_mtime
+            except OSError:
+                continue
+            if entry.name.endswith(('.tmp', '.pending', '.error')):
+                if now - mtime > 3600:
+                    self._discard(entry.path)
+                continue
+            if '.' in entry.name:
+                files.append((mtime, entry.path))
+        files.sort()
+        for _, path in files[:max(0, len(files) - self.max_files)]:
+            self._discard(path)
+
+    @staticmethod
+    def _discard(path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
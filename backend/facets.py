@@ -0,0 +1,306 @@
+"""BookCache のファセット（利用対象・ジャンル・価格帯・出版社）の索引
+
+書籍ごとのファセットの値を book_facets に、値ごとの書籍数を facet_counts に保持し、
+BookCache の変更に合わせて差分だけを更新する（全文検索の索引と同じく、ORM 経由の
+変更はイベントで、Core の一括書き込みは呼び出し側で反映する）。
+
+絞り込みのない件数（検索フィルタの選択肢）は facet_counts を読むだけで済む。
+検索結果のファセット件数は、検索語に一致した書籍のうち関連度の上位 MATCH_LIMIT 件の
+book_facets を集計する（一致した件数によらず集計の手間が一定になる）。
+ある値の件数は「そのファセット以外の絞り込みをすべて適用した件数」で、
+その値を選んだときに何件になるかを表す。
+"""
+from collections import Counter
+
+from sqlalchemy import and_, event, func, inspect, or_, select, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import db, BookCache, BookFacet, FacetCount
+
+FACETS = ('target_audience', 'genre', 'price', 'publisher')
+
+# 利用対象・ジャンルの選択肢（この順に並べ、索引にあるそれ以外の値は件数順に後ろへ並べる）
+TARGET_AUDIENCES = [
+    '未就学', '小学校低学年', '小学校中学年', '小学校高学年',
+    '中学生', '高校生', '一般', '教員', '保護者',
+]
+GENRES = [
+    '事典・辞書', '国際理解', '社会科', '理科・科学', '読み物', 'ノンフィクション',
+    '伝記・偉人', '歴史', '地理', '環境・自然', '平和・戦争', '教師用', '特別支援用', 'その他',
+]
+
+# 価格帯（税別・円）。(下限, 上限未満)。値は下限の文字列
+PRICE_BUCKETS = [(0, 1000), (1000, 2000), (2000, 3000), (3000, 5000), (5000, None)]
+
+# 出版社は件数の多い順にこの件数まで返す
+PUBLISHER_LIMIT = 20
+
+# 検索結果のファセット件数を集計する書籍の件数（関連度の上位から）
+MATCH_LIMIT = 1000
+
+# 1文で扱う書籍の件数（SQLite のバインド変数の上限を超えないようにする）
+BATCH_SIZE = 200
+
+_INSERT = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+
+
+def is_available(bind=None):
+    bind = bind or db.engine
+    return bind.dialect.name in _INSERT
+
+
+def price_bucket(price):
+    """価格が含まれる価格帯の値（価格が無ければ None）"""
+    if price is None:
+        return None
+    for low, high in PRICE_BUCKETS:
+        if price >= low and (high is None or price < high):
+            return str(low)
+    return None
+
+
+def _bucket_range(value):
+    for low, high in PRICE_BUCKETS:
+        if str(low) == str(value):
+            return low, high
+    raise ValueError('価格帯の指定が正しくありません')
+
+
+def _bucket_label(low, high):
+    if high is None:
+        return f'{low:,}円以上'
+    if low == 0:
+        return f'{high:,}円未満'
+    return f'{low:,}〜{high:,}円未満'
+
+
+def facet_values(book):
+    """書籍のファセットの (ファセット, 値) の集合"""
+    values = {
+        ('target_audience', book.target_audience),
+        ('genre', book.genre),
+        ('price', price_bucket(book.price)),
+        ('publisher', book.publisher),
+    }
+    return {(facet, value[:100]) for facet, value in values if value}
+
+
+def facet_conditions(columns, filters):
+    """検索の絞り込み条件をファセットごとの条件のリストにする
+
+    columns は BookCache または同じ列名を持つサブクエリの .c。
+    不正な値の場合は ValueError を送出する。
+    """
+    conditions = {facet: [] for facet in FACETS}
+    for facet in ('target_audience', 'genre', 'publisher'):
+        if filters.get(facet):
+            conditions[facet].append(getattr(columns, facet) == filters[facet])
+    price = columns.price
+    try:
+        if filters.get('price_min'):
+            conditions['price'].append(price >= float(filters['price_min']))
+        if filters.get('price_max'):
+            conditions['price'].append(price <= float(filters['price_max']))
+    except (TypeError, ValueError):
+        raise ValueError('価格は数値で指定してください')
+    if filters.get('price_range'):
+        low, high = _bucket_range(filters['price_range'])
+        conditions['price'].append(price >= low)
+        if high is not None:
+            conditions['price'].append(price < high)
+    return conditions
+
+
+# --- 索引の更新 ---
+
+def index_facets(connection, books):
+    """書籍のファセットを索引に反映する（変わった値だけを書き換える）
+
+    books は id と target_audience / genre / price / publisher を持つオブジェクト。
+    """
+    books = [book for book in books if book.id is not None]
+    for start in range(0, len(books), BATCH_SIZE):
+        batch = books[start:start + BATCH_SIZE]
+        wanted = {(book.id, facet, value) for book in batch for facet, value in facet_values(book)}
+        existing = _existing_rows(connection, [book.id for book in batch])
+        _remove_rows(connection, existing - wanted)
+        _add_rows(connection, wanted - existing)
+
+
+def unindex_facets(connection, book_ids):
+    """削除した書籍のファセットを索引から取り除く"""
+    book_ids = list(book_ids)
+    for start in range(0, len(book_ids), BATCH_SIZE):
+        _remove_rows(connection, _existing_rows(connection, book_ids[start:start + BATCH_SIZE]))
+
+
+def _existing_rows(connection, book_ids):
+    table = BookFacet.__table__
+    return set(connection.execute(
+        select(table.c.book_id, table.c.facet, table.c.value).where(table.c.book_id.in_(book_ids))
+    ).all())
+
+
+def _add_rows(connection, rows):
+    if not rows:
+        return
+    table = BookFacet.__table__
+    stmt = _INSERT[connection.dialect.name](table).on_conflict_do_nothing()
+    # 他のプロセスが先に登録した行は返らないため、実際に登録した行だけを数える
+    added = connection.execute(
+        stmt.returning(table.c.facet, table.c.value),
+        [{'book_id': book_id, 'facet': facet, 'value': value} for book_id, facet, value in rows]
+    ).all()
+    _adjust_counts(connection, Counter(tuple(row) for row in added))
+
+
+def _remove_rows(connection, rows):
+    if not rows:
+        return
+    table = BookFacet.__table__
+    # 他のプロセスが先に削除した行は返らないため、実際に削除した行だけを数える
+    removed = connection.execute(
+        table.delete()
+        .where(tuple_(table.c.book_id, table.c.facet, table.c.value).in_(list(rows)))
+        .returning(table.c.facet, table.c.value)
+    ).all()
+    deltas = Counter()
+    for facet, value in removed:
+        deltas[(facet, value)] -= 1
+    _adjust_counts(connection, deltas)
+
+
+def _adjust_counts(connection, deltas):
+    """facet_counts の書籍数を増減する"""
+    params = [{'facet': facet, 'value': value, 'book_count': delta}
+              for (facet, value), delta in deltas.items() if delta]
+    if not params:
+        return
+    table = FacetCount.__table__
+    stmt = _INSERT[connection.dialect.name](table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.facet, table.c.value],
+        set_={'book_count': table.c.book_count + stmt.excluded.book_count}
+    )
+    connection.execute(stmt, params)
+
+
+def rebuild_facets(connection, batch_size=1000):
+    """BookCache 全体から索引を作り直す"""
+    connection.execute(BookFacet.__table__.delete())
+    connection.execute(FacetCount.__table__.delete())
+    books = BookCache.__table__
+    counts = Counter()
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            select(books.c.id, books.c.target_audience, books.c.genre, books.c.price, books.c.publisher)
+            .where(books.c.id > last_id).order_by(books.c.id).limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        params = [{'book_id': row.id, 'facet': facet, 'value': value}
+                  for row in rows for facet, value in facet_values(row)]
+        if params:
+            connection.execute(BookFacet.__table__.insert(), params)
+            counts.update((p['facet'], p['value']) for p in params)
+        last_id = rows[-1].id
+    if counts:
+        connection.execute(FacetCount.__table__.insert(), [
+            {'facet': facet, 'value': value, 'book_count': count}
+            for (facet, value), count in counts.items()
+        ])
+
+
+# ORM 経由の変更を索引に反映する
+@event.listens_for(BookCache, 'after_insert')
+def _index_inserted(mapper, connection, target):
+    if is_available(connection):
+        index_facets(connection, [target])
+
+
+@event.listens_for(BookCache, 'after_update')
+def _index_updated(mapper, connection, target):
+    state = inspect(target)
+    if is_available(connection) and any(
+        state.attrs[name].history.has_changes() for name in ('target_audience', 'genre', 'price', 'publisher')
+    ):
+        index_facets(connection, [target])
+
+
+@event.listens_for(BookCache, 'after_delete')
+def _unindex_deleted(mapper, connection, target):
+    if is_available(connection):
+        unindex_facets(connection, [target.id])
+
+
+# --- 集計 ---
+
+def search_facets(query, filters):
+    """検索語で絞り込んだ BookCache のクエリ（ファセットの絞り込み前）のファセット件数
+
+    クエリの並び順（関連度順）の上位 MATCH_LIMIT 件だけを集計する。
+    """
+    if not is_available():
+        return None
+    matched = query.with_entities(
+        BookCache.id, BookCache.target_audience, BookCache.genre, BookCache.price, BookCache.publisher
+    ).limit(MATCH_LIMIT).subquery()
+    table = BookFacet.__table__
+    # 各ファセットの行には、そのファセット以外の絞り込みを適用する
+    where = [
+        or_(table.c.facet == facet, and_(*conditions))
+        for facet, conditions in facet_conditions(matched.c, filters).items() if conditions
+    ]
+    rows = db.session.execute(
+        select(table.c.facet, table.c.value, func.count())
+        .join(matched, matched.c.id == table.c.book_id)
+        .where(*where)
+        .group_by(table.c.facet, table.c.value)
+    ).all()
+    return format_facets(rows)
+
+
+def overall_facets():
+    """BookCache 全体のファセット件数（facet_counts を読むだけ）"""
+    if not is_available():
+        return None
+    table = FacetCount.__table__
+    rows = db.session.execute(
+        select(table.c.facet, table.c.value, table.c.book_count).where(table.c.book_count > 0)
+    ).all()
+    return format_facets(rows)
+
+
+def format_facets(rows):
+    """(ファセット, 値, 件数) の行をレスポンスの形にする"""
+    counts = {facet: {} for facet in FACETS}
+    for facet, value, count in rows:
+        if facet in counts:
+            counts[facet][value] = count
+    return {
+        'target_audience': _ordered(counts['target_audience'], TARGET_AUDIENCES),
+        'genre': _ordered(counts['genre'], GENRES),
+        'price': [
+            {'value': str(low), 'label': _bucket_label(low, high), 'min': low, 'max': high,
+             'count': counts['price'][str(low)]}
+            for low, high in PRICE_BUCKETS if counts['price'].get(str(low))
+        ],
+        'publisher': [
+            {'value': value, 'count': count}
+            for value, count in sorted(counts['publisher'].items(), key=lambda item: (-item[1], item[0]))[:PUBLISHER_LIMIT]
+        ],
+    }
+
+
+def _ordered(counts, known):
+    """既知の選択肢の順に並べ、それ以外の値は件数の多い順に後ろへ並べる"""
+    values = [value for value in known if value in counts]
+    values += sorted((value for value in counts if value not in known), key=lambda value: (-counts[value], value))
+    return [{'value': value, 'count': counts[value]} for value in values]
+
+
+def filter_options(known, facet_counts):
+    """選択肢のリスト（既知の選択肢に、索引にあるそれ以外の値を加える）"""
+    extra = [entry['value'] for entry in facet_counts if entry['value'] not in known]
+    return list(known) + extra
@@ -0,0 +1,75 @@
+"""冪等キー（Idempotency-Key ヘッダー）による再送対策
+
+クライアントが同じキーで再送した場合は、最初のリクエストで返したレスポンスを
+そのまま返す。キーは処理結果と同じトランザクションで保存するため、
+注文だけ登録されてキーが残らない（またはその逆の）状態にはならない。
+"""
+import hashlib
+import json
+import os
+from datetime import datetime, timedelta
+
+from models import db, IdempotencyKey
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 100
+# 期限切れのキーを削除する間隔（秒）
+PURGE_INTERVAL = 3600
+
+_last_purge = None
+
+
+class IdempotencyConflict(Exception):
+    """同じキーで内容の異なるリクエストが送られた"""
+
+
+def request_fingerprint(payload):
+    """リクエスト内容のハッシュ（キーの使い回しを検出するため）"""
+    body = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(body.encode('utf-8')).hexdigest()
+
+
+def _cutoff():
+    # 保存したキーの有効期間（秒）。既定は24時間
+    ttl = int(os.getenv('IDEMPOTENCY_KEY_TTL', str(24 * 3600)))
+    return datetime.utcnow() - timedelta(seconds=ttl)
+
+
+def saved_response(scope, key, fingerprint):
+    """保存済みのレスポンスを (本文, ステータス) で返す。無ければ None"""
+    record = IdempotencyKey.query.filter(
+        IdempotencyKey.scope == scope,
+        IdempotencyKey.key == key,
+        IdempotencyKey.created_at >= _cutoff()
+    ).first()
+    if record is None:
+        return None
+    if record.request_hash != fingerprint:
+        raise IdempotencyConflict('この冪等キーは別の内容のリクエストで使用されています')
+    return json.loads(record.response_body), record.status_code
+
+
+def save_response(scope, key, fingerprint, body, status_code):
+    """レスポンスをセッションに追加する（呼び出し側でコミットすること）"""
+    _purge_expired()
+    # 期限切れで残っている同じキーは置き換える
+    IdempotencyKey.query.filter(
+        IdempotencyKey.scope == scope,
+        IdempotencyKey.key == key
+    ).delete(synchronize_session=False)
+    db.session.add(IdempotencyKey(
+        scope=scope,
+        key=key,
+        request_hash=fingerprint,
+        status_code=status_code,
+        response_body=json.dumps(body, ensure_ascii=False)
+    ))
+
+
+def _purge_expired():
+    global _last_purge
+    now = datetime.utcnow()
+    if _last_purge and (now - _last_purge).total_seconds() < PURGE_INTERVAL:
+        return
+    _last_purge = now
+    IdempotencyKey.query.filter(IdempotencyKey.created_at < _cutoff()).delete(synchronize_session=False)
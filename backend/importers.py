@@ -0,0 +1,184 @@
+"""CSV / Excel の注文シートから選書リストへの取り込み
+
+ファイルは1行ずつ読み、一定件数ごとに書籍情報の補完と一括登録を行うため、
+行数が多くてもメモリ使用量はほぼ一定になる。
+"""
+import codecs
+import csv
+import io
+import os
+
+from openpyxl import load_workbook
+
+from database import write_intent
+from isbn import canonical_isbn
+from models import db, BookSelectionList
+from selection_lists import add_items
+
+IMPORT_BATCH_SIZE = 200
+
+# 見出しの表記ゆれ -> 項目名
+HEADER_ALIASES = {
+    'isbn': 'isbn', 'isbnコード': 'isbn', 'isbn番号': 'isbn',
+    'title': 'title', '書名': 'title', 'タイトル': 'title', '書籍名': 'title',
+    'author': 'author', '著者': 'author', '著者名': 'author',
+    'publisher': 'publisher', '出版社': 'publisher', '出版社名': 'publisher',
+    'price': 'price', '価格': 'price', '本体価格': 'price', '本体価格（税別）': 'price', '税別価格': 'price',
+    'quantity': 'quantity', '数量': 'quantity', '冊数': 'quantity', '注文数': 'quantity',
+}
+
+
+class ImportFormatError(ValueError):
+    """ファイルの形式が取り込めない"""
+
+
+def _normalize_header(value):
+    return str(value or '').strip().replace(' ', '').replace('　', '').lower()
+
+
+def _map_header(header):
+    columns = {}
+    for index, name in enumerate(header):
+        field = HEADER_ALIASES.get(_normalize_header(name))
+        if field and field not in columns:
+            columns[field] = index
+    if 'isbn' not in columns:
+        raise ImportFormatError('ISBN の列が見つかりません')
+    return columns
+
+
+def _detect_encoding(stream):
+    """先頭を読んで UTF-8 か Shift_JIS（cp932）かを判定する"""
+    head = stream.read(64 * 1024)
+    stream.seek(0)
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(head, final=False)
+        return 'utf-8-sig'
+    except UnicodeDecodeError:
+        return 'cp932'
+
+
+def _iter_csv(stream):
+    text = io.TextIOWrapper(stream, encoding=_detect_encoding(stream), newline='')
+    yield from csv.reader(text)
+
+
+def _iter_xlsx(stream):
+    wb = load_workbook(stream, read_only=True, data_only=True)
+    try:
+        yield from wb.worksheets[0].iter_rows(values_only=True)
+    finally:
+        wb.close()
+
+
+def iter_sheet_rows(file_storage):
+    """アップロードされたファイルを1行ずつ (行番号, 値の dict) で返す"""
+    ext = os.path.splitext(file_storage.filename or '')[1].lower()
+    if ext == '.csv':
+        rows = _iter_csv(file_storage.stream)
+    elif ext in ('.xlsx', '.xlsm'):
+        rows = _iter_xlsx(file_storage.stream)
+    else:
+        raise ImportFormatError('CSV または Excel（.xlsx）ファイルを指定してください')
+
+    columns = None
+    for row_number, row in enumerate(rows, 1):
+        if not row or all(value in (None, '') for value in row):
+            continue
+        if columns is None:
+            columns = _map_header(row)
+            continue
+        yield row_number, {
+            field: row[index] if index < len(row) else None
+            for field, index in columns.items()
+        }
+    if columns is None:
+        raise ImportFormatError('見出し行が見つかりません')
+
+
+def _to_item(values):
+    """シートの値を選書リストのアイテムに変換する。(アイテム, エラー) を返す"""
+    raw_isbn = str(values.get('isbn') or '').strip()
+    if raw_isbn.endswith('.0'):
+        # Excel で数値として入力された ISBN
+        raw_isbn = raw_isbn[:-2]
+    isbn = canonical_isbn(raw_isbn)
+    if not isbn:
+        return None, f'ISBN が不正です: {raw_isbn}'
+
+    item = {'isbn': isbn, 'quantity': 1}
+    for field in ('title', 'author', 'publisher'):
+        if values.get(field) not in (None, ''):
+            item[field] = str(values[field]).strip()
+    try:
+        if values.get('quantity') not in (None, ''):
+            item['quantity'] = int(float(values['quantity']))
+        if values.get('price') not in (None, ''):
+            item['price'] = float(str(values['price']).replace(',', '').replace('¥', '').replace('円', ''))
+    except ValueError:
+        return None, '数量または価格が数値ではありません'
+    return item, None
+
+
+def import_rows(list_id, rows, lookup_books, merge_quantities=False, batch_size=IMPORT_BATCH_SIZE):
+    """行を選書リストに取り込み、進捗・エラー・結果をイベントとして順に返す
+
+    lookup_books(isbns, fetch_isbns) は ISBN-13 のリストを受け取り、
+    {ISBN-13: 書籍データ} を返す関数。fetch_isbns（書名が空の行）はキャッシュに
+    無ければ上流から取得し、それ以外はキャッシュのみで補完する。
+    バッチごとにコミットする。
+    """
+    summary = {'rows': 0, 'added': 0, 'merged': 0, 'duplicate': 0, 'invalid': 0}
+    batch = []
+
+    def flush():
+        books = lookup_books(list({item['isbn'] for _, item in batch}),
+                             {item['isbn'] for _, item in batch if not item.get('title')})
+        events, items, row_numbers = [], [], []
+        for row_number, item in batch:
+            book = books.get(item['isbn']) or {}
+            for field in ('title', 'author', 'publisher', 'price', 'thumbnail', 'volume_count', 'is_set_only'):
+                if item.get(field) in (None, '') and book.get(field) not in (None, ''):
+                    item[field] = book[field]
+            if not item.get('title'):
+                summary['invalid'] += 1
+                events.append({'type': 'error', 'row': row_number, 'isbn': item['isbn'],
+                               'error': '書籍情報が見つかりません（書名を入力してください）'})
+                continue
+            items.append(item)
+            row_numbers.append(row_number)
+
+        # 書籍情報の取得（上流への問い合わせを含む）の間に開いたトランザクションを終えてから、
+        # 書き込みのロックを取って追加する
+        db.session.commit()
+        with write_intent():
+            book_list = db.session.get(BookSelectionList, list_id)
+            results = add_items(book_list, items, merge_quantities=merge_quantities)
+            db.session.commit()
+        # 取り込んだ行をセッションに溜めないようにする
+        db.session.expunge_all()
+
+        for row_number, result in zip(row_numbers, results):
+            summary[result['status']] += 1
+            if result['status'] == 'invalid':
+                events.append({'type': 'error', 'row': row_number, 'isbn': result['isbn'], 'error': result['error']})
+            elif result['status'] == 'duplicate':
+                events.append({'type': 'error', 'row': row_number, 'isbn': result['isbn'],
+                               'error': 'この書籍は既にリストに追加されています'})
+        batch.clear()
+        events.append({'type': 'progress', 'processed': summary['rows']})
+        return events
+
+    for row_number, values in rows:
+        summary['rows'] += 1
+        item, error = _to_item(values)
+        if error:
+            summary['invalid'] += 1
+            yield {'type': 'error', 'row': row_number, 'isbn': values.get('isbn'), 'error': error}
+            continue
+        batch.append((row_number, item))
+        if len(batch) >= batch_size:
+            yield from flush()
+    if batch:
+        yield from flush()
+    yield dict(summary, type='summary')
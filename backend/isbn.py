@@ -0,0 +1,69 @@
+"""ISBN の正規化・チェックディジット検証・ISBN-10/13 の相互変換
+
+書籍の照合には ISBN-13 に揃えた値（canonical_isbn）を使う。
+"""
+import re
+
+_ISBN10_RE = re.compile(r'^\d{9}[\dX]$')
+_ISBN13_RE = re.compile(r'^\d{13}$')
+
+
+def normalize_isbn(value):
+    """ハイフン・空白を除き、チェックディジットの x を大文字にする"""
+    if not value:
+        return ''
+    return re.sub(r'[\s\-\u2010\uff0d]', '', str(value)).upper()
+
+
+def looks_like_isbn(value):
+    """桁数・文字種が ISBN の形式か（チェックディジットは見ない）"""
+    normalized = normalize_isbn(value)
+    return bool(_ISBN10_RE.match(normalized) or _ISBN13_RE.match(normalized))
+
+
+def _isbn10_check_digit(first9):
+    total = sum((10 - i) * int(d) for i, d in enumerate(first9))
+    check = (11 - total % 11) % 11
+    return 'X' if check == 10 else str(check)
+
+
+def _isbn13_check_digit(first12):
+    total = sum(int(d) * (1 if i % 2 == 0 else 3) for i, d in enumerate(first12))
+    return str((10 - total % 10) % 10)
+
+
+def is_valid_isbn10(value):
+    normalized = normalize_isbn(value)
+    return bool(_ISBN10_RE.match(normalized)) and _isbn10_check_digit(normalized[:9]) == normalized[9]
+
+
+def is_valid_isbn13(value):
+    normalized = normalize_isbn(value)
+    return bool(_ISBN13_RE.match(normalized)) and _isbn13_check_digit(normalized[:12]) == normalized[12]
+
+
+def to_isbn13(value):
+    """ISBN-10 を ISBN-13 に変換する。不正な値は None"""
+    normalized = normalize_isbn(value)
+    if is_valid_isbn13(normalized):
+        return normalized
+    if not is_valid_isbn10(normalized):
+        return None
+    first12 = '978' + normalized[:9]
+    return first12 + _isbn13_check_digit(first12)
+
+
+def to_isbn10(value):
+    """ISBN-13（978 始まり）を ISBN-10 に変換する。変換できない場合は None"""
+    normalized = normalize_isbn(value)
+    if is_valid_isbn10(normalized):
+        return normalized
+    if not is_valid_isbn13(normalized) or not normalized.startswith('978'):
+        return None
+    first9 = normalized[3:12]
+    return first9 + _isbn10_check_digit(first9)
+
+
+def canonical_isbn(value):
+    """照合用の ISBN-13 を返す。有効な ISBN でなければ None"""
+    return to_isbn13(value)
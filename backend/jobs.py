@@ -0,0 +1,291 @@
+"""バックグラウンドジョブ
+
+重いエクスポート・取り込み・書籍情報の一括取得を gunicorn のリクエスト処理から
+切り離して実行する。ジョブは jobs テーブルに登録し、各ワーカープロセスの
+スレッドが取り出して実行する。取り出しは「queued のときだけ running に更新」で
+行うため、複数のプロセスが同じジョブを実行することはない。
+"""
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from database import write_intent
+from models import db, Job
+
+FINISHED_STATUSES = ('succeeded', 'failed', 'cancelled')
+
+
+class JobCancelled(Exception):
+    """ジョブのキャンセルが要求された"""
+
+
+class JobContext:
+    """ジョブの処理関数に渡す。進捗の報告・キャンセルの確認・結果ファイルの置き場所
+
+    進捗は別スレッドが一定間隔で書き込み（実行中であることの印も兼ねる）、
+    そのときにキャンセルの要求も読み取る。処理関数が DB の書き込み待ちで
+    止まることはない。
+    """
+
+    # 進捗を書き込む間隔（秒）
+    FLUSH_INTERVAL = 1.0
+
+    def __init__(self, queue, job_id, params):
+        self.queue = queue
+        self.job_id = job_id
+        self.params = params
+        self.values = None
+        # 進捗を書き込むスレッドはアプリケーションコンテキストの外で動くため、先に取得しておく
+        self._engine = queue.engine
+        self._cancelled = threading.Event()
+        self._stop = threading.Event()
+        self._flusher = None
+
+    @property
+    def result_dir(self):
+        """このジョブの結果ファイルを置くディレクトリ"""
+        path = os.path.join(self.queue.result_dir, self.job_id)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def progress(self, **values):
+        """進捗を記録し、キャンセルが要求されていれば JobCancelled を送出する"""
+        self.values = values
+        if self._cancelled.is_set():
+            raise JobCancelled()
+
+    def track(self, iterable, every=500, **values):
+        """iterable を順に返しながら、every 件ごとに件数を進捗として報告する"""
+        for count, item in enumerate(iterable, 1):
+            if count % every == 0:
+                self.progress(processed=count, **values)
+            yield item
+
+    def start(self):
+        self._flusher = threading.Thread(target=self._flush_loop, name=f'job-progress-{self.job_id[:8]}', daemon=True)
+        self._flusher.start()
+
+    def stop(self):
+        self._stop.set()
+        self._flusher.join()
+
+    def _flush_loop(self):
+        written = None
+        while not self._stop.wait(self.FLUSH_INTERVAL):
+            values = {'updated_at': datetime.utcnow()}
+            current = self.values
+            if current is not written:
+                values['progress'] = json.dumps(current, ensure_ascii=False, default=str)
+            try:
+                with self._engine.begin() as connection:
+                    connection.execute(Job.__table__.update().where(Job.id == self.job_id).values(**values))
+                    cancel_requested = connection.execute(
+                        db.select(Job.cancel_requested).where(Job.id == self.job_id)
+                    ).scalar()
+                written = current
+            except Exception as e:
+                # SQLite でほかの接続が書き込み中の場合など。次の間隔で書き込む
+                print(f"ジョブの進捗の書き込みエラー: {str(e)}")
+                continue
+            if cancel_requested:
+                self._cancelled.set()
+
+
+class JobQueue:
+    """jobs テーブルを使ったジョブキュー
+
+    処理関数は @queue.handler('種類') で登録する。処理関数は (ctx, params) を受け取り、
+    dict（JSON にできる値）を返す。結果がファイルの場合は
+    {'file': パス, 'download_name': ..., 'mimetype': ...} を返す。
+    """
+
+    def __init__(self, workers=1, poll_interval=2, retention=timedelta(days=7),
+                 stale_after=600, result_dir=None):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.stale_after = stale_after
+        self.result_dir = result_dir or os.path.join(tempfile.gettempdir(), 'book-order-jobs')
+        self.handlers = {}
+        self._wakeup = threading.Event()
+        self._app = None
+        os.makedirs(self.result_dir, exist_ok=True)
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            workers=int(os.getenv('JOB_WORKERS', 1)),
+            poll_interval=float(os.getenv('JOB_POLL_INTERVAL', 2)),
+            retention=timedelta(seconds=int(os.getenv('JOB_RETENTION', 7 * 24 * 3600))),
+            stale_after=int(os.getenv('JOB_STALE_AFTER', 600)),
+            result_dir=os.getenv('JOB_RESULT_DIR'),
+        )
+
+    @property
+    def engine(self):
+        return db.engine
+
+    def handler(self, kind):
+        def register(func):
+            self.handlers[kind] = func
+            return func
+        return register
+
+    def start(self, app):
+        """ワーカースレッドを開始する（JOB_WORKERS=0 の場合は実行しない）"""
+        self._app = app
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._worker_loop, name=f'job-worker-{number}', daemon=True)
+            thread.start()
+
+    def enqueue(self, kind, params, owner):
+        """ジョブを登録して ID を返す"""
+        if kind not in self.handlers:
+            raise ValueError(f'不明なジョブの種類です: {kind}')
+        job = Job(id=uuid.uuid4().hex, kind=kind, owner=owner, status='queued',
+                  params=json.dumps(params, ensure_ascii=False))
+        # 呼び出し元の読み取り（選書リストの所有者の確認など）のトランザクションを終えてから、
+        # 書き込みのロックを取って登録する
+        db.session.commit()
+        with write_intent():
+            db.session.add(job)
+            db.session.commit()
+        self._wakeup.set()
+        return job.id
+
+    def save_upload(self, file_storage):
+        """アップロードされたファイルをジョブで読めるように保存し、パスを返す"""
+        upload_dir = os.path.join(self.result_dir, 'uploads')
+        os.makedirs(upload_dir, exist_ok=True)
+        ext = os.path.splitext(file_storage.filename or '')[1].lower()
+        path = os.path.join(upload_dir, uuid.uuid4().hex + ext)
+        file_storage.save(path)
+        return path
+
+    def cancel(self, job_id):
+        """ジョブをキャンセルする。実行中のジョブは次の進捗報告の時点で止まる
+
+        ワーカーが同時に取り出した場合に備え、状態を条件にして更新する。
+        """
+        table = Job.__table__
+        now = datetime.utcnow()
+        cancelled = db.session.execute(
+            table.update().where(table.c.id == job_id, table.c.status == 'queued')
+            .values(status='cancelled', finished_at=now, updated_at=now)
+        ).rowcount
+        if not cancelled:
+            db.session.execute(
+                table.update().where(table.c.id == job_id, table.c.status == 'running')
+                .values(cancel_requested=True)
+            )
+        db.session.commit()
+
+    # --- ワーカー ---
+
+    def _worker_loop(self):
+        last_cleanup = 0
+        while True:
+            try:
+                with self._app.app_context():
+                    if time.monotonic() - last_cleanup > 600:
+                        last_cleanup = time.monotonic()
+                        self.cleanup()
+                    while self.run_next():
+                        pass
+            except Exception as e:
+                print(f"ジョブの実行エラー: {str(e)}")
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def _claim(self):
+        """実行待ちのジョブを1件取り出して running にする。無ければ None"""
+        table = Job.__table__
+        # 複数のプロセスが同時に取り出しても待ち合わせられるよう、最初から書き込みのロックを取る
+        with write_intent(), self.engine.begin() as connection:
+            candidates = connection.execute(
+                db.select(table.c.id).where(table.c.status == 'queued')
+                .order_by(table.c.created_at).limit(5)
+            ).scalars().all()
+            for job_id in candidates:
+                now = datetime.utcnow()
+                claimed = connection.execute(
+                    table.update().where(table.c.id == job_id, table.c.status == 'queued')
+                    .values(status='running', started_at=now, updated_at=now)
+                ).rowcount
+                if claimed:
+                    return job_id
+        return None
+
+    def run_next(self):
+        """ジョブを1件実行する。実行するジョブが無ければ False"""
+        job_id = self._claim()
+        if job_id is None:
+            return False
+        job = db.session.get(Job, job_id)
+        ctx = JobContext(self, job_id, json.loads(job.params or '{}'))
+        handler = self.handlers.get(job.kind)
+        db.session.commit()
+        values = {}
+        ctx.start()
+        try:
+            if handler is None:
+                raise ValueError(f'不明なジョブの種類です: {job.kind}')
+            result = handler(ctx, ctx.params) or {}
+            db.session.commit()
+            values['status'] = 'succeeded'
+            if 'file' in result:
+                values.update(result_path=result.pop('file'),
+                              result_name=result.pop('download_name', None),
+                              result_mimetype=result.pop('mimetype', None))
+            values['result'] = json.dumps(result, ensure_ascii=False, default=str)
+        except JobCancelled:
+            db.session.rollback()
+            values['status'] = 'cancelled'
+        except Exception as e:
+            db.session.rollback()
+            values.update(status='failed', error=str(e))
+        finally:
+            ctx.stop()
+        if ctx.values is not None:
+            values['progress'] = json.dumps(ctx.values, ensure_ascii=False, default=str)
+        values['updated_at'] = values['finished_at'] = datetime.utcnow()
+        with self.engine.begin() as connection:
+            connection.execute(Job.__table__.update().where(Job.id == job_id).values(**values))
+        if values['status'] != 'succeeded':
+            shutil.rmtree(os.path.join(self.result_dir, job_id), ignore_errors=True)
+        return True
+
+    def cleanup(self):
+        """止まったジョブを失敗にし、保存期間を過ぎたジョブと結果ファイルを削除する"""
+        now = datetime.utcnow()
+        table = Job.__table__
+        with self.engine.begin() as connection:
+            # 実行していたプロセスが止まり、進捗が更新されなくなったジョブ
+            connection.execute(
+                table.update().where(
+                    table.c.status == 'running',
+                    table.c.updated_at < now - timedelta(seconds=self.stale_after)
+                ).values(status='failed', error='ジョブが応答しなくなりました', finished_at=now)
+            )
+            expired = connection.execute(
+                db.select(table.c.id).where(
+                    table.c.status.in_(FINISHED_STATUSES),
+                    table.c.finished_at < now - self.retention
+                )
+            ).scalars().all()
+            if expired:
+                connection.execute(table.delete().where(table.c.id.in_(expired)))
+        for job_id in expired:
+            shutil.rmtree(os.path.join(self.result_dir, job_id), ignore_errors=True)
+        # 取り込みのジョブが消し損ねたアップロード
+        upload_dir = os.path.join(self.result_dir, 'uploads')
+        if os.path.isdir(upload_dir):
+            for entry in os.scandir(upload_dir):
+                if time.time() - entry.stat().st_mtime > self.retention.total_seconds():
+                    os.unlink(entry.path)
+        return len(expired)
@@ -0,0 +1,179 @@
+"""スキーマのマイグレーション
+
+テーブルの作成・列の追加などのスキーマの変更をここに順番に登録する。適用済みのものは
+schema_migrations テーブルに記録され、2回目以降は実行されない。新しいデータベースでは
+0000_initial_schema でテーブルを作成し、既存のデータベースでは作成済みのテーブルを飛ばす。
+インデックスや全文検索のテーブルもここで作成し、schema_migrations がスキーマ全体を表すようにする。
+
+起動時（RUN_MIGRATIONS=0 の場合を除く）または `flask --app app migrate` で適用する。
+PostgreSQL では複数のプロセスが同時に適用しないよう、アドバイザリロックを取ってから適用する。
+"""
+from contextlib import contextmanager
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+
+from facets import rebuild_facets, is_available as facets_available
+from isbn import canonical_isbn
+from models import db
+from search_index import create_search_index
+
+BACKFILL_BATCH_SIZE = 5000
+# pg_advisory_lock のキー（任意の定数）
+MIGRATION_LOCK_ID = 7305001
+
+
+def add_column_if_missing(connection, table, column, ddl_type):
+    """列が無ければ追加する（0000_initial_schema で作られた新しいテーブルでは何もしない）"""
+    columns = {c['name'] for c in inspect(connection).get_columns(table)}
+    if column not in columns:
+        connection.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl_type}'))
+
+
+def create_table_if_missing(connection, *table_names):
+    """モデルの定義どおりにテーブルを作成する（既にあるテーブルは変更しない）"""
+    tables = [db.metadata.tables[name] for name in table_names]
+    db.metadata.create_all(connection, tables=tables, checkfirst=True)
+
+
+def create_indexes_if_missing(connection, table_name):
+    """モデルで宣言したテーブルのインデックスのうち、無いものを作成する"""
+    for index in db.metadata.tables[table_name].indexes:
+        index.create(connection, checkfirst=True)
+
+
+def _0000_initial_schema(connection):
+    create_table_if_missing(
+        connection,
+        'customers', 'orders', 'order_items', 'users', 'admins', 'book_cache',
+        'book_selection_lists', 'book_selection_items', 'wishlist_items',
+        'idempotency_keys', 'revoked_tokens', 'jobs',
+    )
+
+
+def _0001_book_cache_access_stats(connection):
+    add_column_if_missing(connection, 'book_cache', 'hit_count', 'INTEGER DEFAULT 0')
+    add_column_if_missing(connection, 'book_cache', 'last_accessed_at', 'TIMESTAMP')
+
+
+def _0002_canonical_isbn(connection):
+    for table in ('book_cache', 'book_selection_items', 'order_items', 'wishlist_items'):
+        add_column_if_missing(connection, table, 'isbn13', 'VARCHAR(13)')
+        # 既存の行に ISBN-13 を埋める
+        last_id = 0
+        while True:
+            rows = connection.execute(text(
+                f'SELECT id, isbn FROM {table} WHERE id > :last_id ORDER BY id LIMIT :limit'
+            ), {'last_id': last_id, 'limit': BACKFILL_BATCH_SIZE}).fetchall()
+            if not rows:
+                break
+            params = [{'id': row[0], 'isbn13': canonical_isbn(row[1])} for row in rows]
+            params = [p for p in params if p['isbn13']]
+            if params:
+                connection.execute(text(f'UPDATE {table} SET isbn13 = :isbn13 WHERE id = :id'), params)
+            last_id = rows[-1][0]
+
+
+def _0003_book_cache_classification(connection):
+    # 分類・フィルタリング用の列より前に作られた book_cache
+    add_column_if_missing(connection, 'book_cache', 'target_audience', 'VARCHAR(50)')
+    add_column_if_missing(connection, 'book_cache', 'genre', 'VARCHAR(50)')
+    add_column_if_missing(connection, 'book_cache', 'price', 'FLOAT')
+    add_column_if_missing(connection, 'book_cache', 'volume_count', 'INTEGER DEFAULT 1')
+    add_column_if_missing(connection, 'book_cache', 'is_set_only', 'BOOLEAN DEFAULT FALSE')
+
+
+def _0004_lookup_indexes(connection):
+    # 外部キー・並び替え・絞り込みの列のインデックス（query_plans.py で使われることを確認する）
+    for table in ('customers', 'orders', 'order_items', 'book_cache',
+                  'book_selection_lists', 'book_selection_items', 'jobs'):
+        create_indexes_if_missing(connection, table)
+
+
+def _0005_book_facets(connection):
+    create_table_if_missing(connection, 'book_facets', 'facet_counts')
+    # 既存のキャッシュから索引を作る
+    if facets_available(connection):
+        rebuild_facets(connection)
+
+
+def _0006_remaining_indexes(connection):
+    # 0004 で扱っていないテーブルのインデックス（以前は起動時に作成していた）
+    for table in ('wishlist_items', 'idempotency_keys', 'revoked_tokens'):
+        create_indexes_if_missing(connection, table)
+
+
+def _0007_book_cache_search_index(connection):
+    # 全文検索の FTS テーブル（SQLite のみ。以前は起動時に作成していた）
+    create_search_index(connection)
+
+
+# (ID, 関数) の順に適用する。適用済みの項目は変更しないこと
+MIGRATIONS = [
+    ('0000_initial_schema', _0000_initial_schema),
+    ('0001_book_cache_access_stats', _0001_book_cache_access_stats),
+    ('0002_canonical_isbn', _0002_canonical_isbn),
+    ('0003_book_cache_classification', _0003_book_cache_classification),
+    ('0004_lookup_indexes', _0004_lookup_indexes),
+    ('0005_book_facets', _0005_book_facets),
+    ('0006_remaining_indexes', _0006_remaining_indexes),
+    ('0007_book_cache_search_index', _0007_book_cache_search_index),
+]
+
+
+@contextmanager
+def _migration_lock():
+    """PostgreSQL では適用中に他のプロセスを待たせる（SQLite では何もしない）"""
+    if db.engine.dialect.name != 'postgresql':
+        yield
+        return
+    with db.engine.connect() as connection:
+        connection.execute(text('SELECT pg_advisory_lock(:id)'), {'id': MIGRATION_LOCK_ID})
+        connection.commit()
+        try:
+            yield
+        finally:
+            connection.execute(text('SELECT pg_advisory_unlock(:id)'), {'id': MIGRATION_LOCK_ID})
+            connection.commit()
+
+
+def run_migrations():
+    """未適用のマイグレーションを順に適用し、適用した ID のリストを返す"""
+    with _migration_lock():
+        return _apply_pending()
+
+
+def _apply_pending():
+    applied_now = []
+    with db.engine.begin() as connection:
+        connection.execute(text(
+            'CREATE TABLE IF NOT EXISTS schema_migrations ('
+            'id VARCHAR(100) PRIMARY KEY, applied_at TIMESTAMP NOT NULL)'
+        ))
+        applied = {row[0] for row in connection.execute(text('SELECT id FROM schema_migrations'))}
+
+    for migration_id, migrate in MIGRATIONS:
+        if migration_id in applied:
+            continue
+        try:
+            with db.engine.begin() as connection:
+                migrate(connection)
+                connection.execute(
+                    text('INSERT INTO schema_migrations (id, applied_at) VALUES (:id, :applied_at)'),
+                    {'id': migration_id, 'applied_at': datetime.utcnow()}
+                )
+        except Exception:
+            # 複数ワーカーが同時に起動した場合は、他のワーカーが適用済みなら問題ない
+            if not _is_applied(migration_id):
+                raise
+            continue
+        applied_now.append(migration_id)
+        print(f"マイグレーションを適用しました: {migration_id}")
+    return applied_now
+
+
+def _is_applied(migration_id):
+    with db.engine.connect() as connection:
+        return connection.execute(
+            text('SELECT 1 FROM schema_migrations WHERE id = :id'), {'id': migration_id}
+        ).first() is not None
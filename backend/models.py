@@ -1,7 +1,13 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import validates
 from datetime import datetime
+import json
 
-db = SQLAlchemy()
+from database import RoutingSession
+from isbn import canonical_isbn
+
+# 読み取り専用のルートの SELECT をリードレプリカに送るセッション（database.py）
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 class Customer(db.Model):
     """顧客情報"""
@@ -18,6 +24,9 @@ class Customer(db.Model):
     # WishlistItemとの関連付けを追加
     wishlist_items = db.relationship('WishlistItem', backref='customer', lazy=True, cascade='all, delete-orphan')
     
+    # 注文時に (名前, メールアドレス) で既存の顧客を探す・名前順の一覧
+    __table_args__ = (db.Index('ix_customers_name_email', 'name', 'email'),)
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -41,6 +50,12 @@ class Order(db.Model):
     
     items = db.relationship('OrderItem', backref='order', lazy=True, cascade='all, delete-orphan')
     
+    # 一覧のキーセットページング用（注文日の新しい順）
+    __table_args__ = (
+        db.Index('ix_orders_order_date_id', 'order_date', 'id'),
+        db.Index('ix_orders_customer_id_order_date_id', 'customer_id', 'order_date', 'id'),
+    )
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -60,6 +75,7 @@ class OrderItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), nullable=False)
     isbn = db.Column(db.String(20))
+    isbn13 = db.Column(db.String(13), index=True)  # 照合用に ISBN-13 に揃えた値
     title = db.Column(db.String(200), nullable=False)
     author = db.Column(db.String(200))
     publisher = db.Column(db.String(100))
@@ -67,6 +83,14 @@ class OrderItem(db.Model):
     price = db.Column(db.Float)
     thumbnail = db.Column(db.String(500))
     
+    # 注文ごとの明細の読み込み（selectin）・エクスポートの結合
+    __table_args__ = (db.Index('ix_order_items_order_id', 'order_id'),)
+    
+    @validates('isbn')
+    def _set_isbn13(self, key, value):
+        self.isbn13 = canonical_isbn(value)
+        return value
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -133,6 +157,7 @@ class BookCache(db.Model):
     
     id = db.Column(db.Integer, primary_key=True)
     isbn = db.Column(db.String(20), unique=True, nullable=False, index=True)
+    isbn13 = db.Column(db.String(13), index=True)  # 照合用に ISBN-13 に揃えた値
     title = db.Column(db.String(200))
     author = db.Column(db.String(200))
     publisher = db.Column(db.String(100))
@@ -146,6 +171,20 @@ class BookCache(db.Model):
     volume_count = db.Column(db.Integer, default=1)  # 全巻数
     is_set_only = db.Column(db.Boolean, default=False)  # セットのみ販売
     cached_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # キャッシュ管理用（参照回数・最終参照日時）
+    hit_count = db.Column(db.Integer, default=0)
+    last_accessed_at = db.Column(db.DateTime)
+    
+    # 書籍検索の絞り込み（利用対象・ジャンルの一致と価格の範囲）
+    __table_args__ = (
+        db.Index('ix_book_cache_target_audience_price', 'target_audience', 'price'),
+        db.Index('ix_book_cache_genre_price', 'genre', 'price'),
+    )
+    
+    @validates('isbn')
+    def _set_isbn13(self, key, value):
+        self.isbn13 = canonical_isbn(value)
+        return value
     
     def to_dict(self):
         return {
@@ -163,6 +202,23 @@ class BookCache(db.Model):
             'is_set_only': self.is_set_only
         }
 
+class BookFacet(db.Model):
+    """書籍ごとのファセットの値（facets.py が BookCache の変更に合わせて更新する）"""
+    __tablename__ = 'book_facets'
+    
+    # 削除された書籍の行は facets.py が消すため、外部キーにはしない（全文検索の索引と同じ）
+    book_id = db.Column(db.Integer, primary_key=True)
+    facet = db.Column(db.String(20), primary_key=True)  # target_audience / genre / price / publisher
+    value = db.Column(db.String(100), primary_key=True)
+
+class FacetCount(db.Model):
+    """ファセットの値ごとの書籍数（BookCache 全体。検索条件の無い集計に使う）"""
+    __tablename__ = 'facet_counts'
+    
+    facet = db.Column(db.String(20), primary_key=True)
+    value = db.Column(db.String(100), primary_key=True)
+    book_count = db.Column(db.Integer, nullable=False, default=0)
+
 class BookSelectionList(db.Model):
     """選書リスト"""
     __tablename__ = 'book_selection_lists'
@@ -177,7 +233,21 @@ class BookSelectionList(db.Model):
     # リストアイテムとの関係
     items = db.relationship('BookSelectionItem', backref='book_list', lazy=True, cascade='all, delete-orphan')
     
+    # 一覧のキーセットページング用（更新日の新しい順）
+    __table_args__ = (
+        db.Index('ix_book_selection_lists_user_id_updated_at_id', 'user_id', 'updated_at', 'id'),
+    )
+    
     def to_dict(self):
+        # 件数・数量・金額の集計とアイテムの変換を1回のループで行う
+        items = []
+        total_quantity = 0
+        total_amount = 0
+        for item in self.items:
+            item_dict = item.to_dict()
+            items.append(item_dict)
+            total_quantity += item.quantity
+            total_amount += item_dict['subtotal']
         return {
             'id': self.id,
             'user_id': self.user_id,
@@ -185,10 +255,10 @@ class BookSelectionList(db.Model):
             'description': self.description,
             'created_at': self.created_at.isoformat() if self.created_at else None,
             'updated_at': self.updated_at.isoformat() if self.updated_at else None,
-            'items_count': len(self.items),
-            'total_quantity': sum(item.quantity for item in self.items),
-            'total_amount': sum((item.price or 0) * item.quantity for item in self.items),
-            'items': [item.to_dict() for item in self.items]
+            'items_count': len(items),
+            'total_quantity': total_quantity,
+            'total_amount': total_amount,
+            'items': items
         }
 
 class BookSelectionItem(db.Model):
@@ -198,6 +268,7 @@ class BookSelectionItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     list_id = db.Column(db.Integer, db.ForeignKey('book_selection_lists.id'), nullable=False)
     isbn = db.Column(db.String(20), nullable=False)
+    isbn13 = db.Column(db.String(13), index=True)  # 照合用に ISBN-13 に揃えた値
     title = db.Column(db.String(200), nullable=False)
     author = db.Column(db.String(200))
     publisher = db.Column(db.String(100))
@@ -209,7 +280,16 @@ class BookSelectionItem(db.Model):
     added_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     # 複合ユニーク制約: 同じリストに同じ本は1つまで
-    __table_args__ = (db.UniqueConstraint('list_id', 'isbn', name='_list_isbn_uc'),)
+    __table_args__ = (
+        db.UniqueConstraint('list_id', 'isbn', name='_list_isbn_uc'),
+        # アイテム一覧のキーセットページング用（追加日の新しい順）
+        db.Index('ix_book_selection_items_list_id_added_at_id', 'list_id', 'added_at', 'id'),
+    )
+    
+    @validates('isbn')
+    def _set_isbn13(self, key, value):
+        self.isbn13 = canonical_isbn(value)
+        return value
     
     def to_dict(self):
         return {
@@ -235,6 +315,7 @@ class WishlistItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     customer_id = db.Column(db.Integer, db.ForeignKey('customers.id'), nullable=False)
     isbn = db.Column(db.String(20), nullable=False)
+    isbn13 = db.Column(db.String(13), index=True)  # 照合用に ISBN-13 に揃えた値
     title = db.Column(db.String(200), nullable=False)
     author = db.Column(db.String(200))
     publisher = db.Column(db.String(100))
@@ -244,6 +325,11 @@ class WishlistItem(db.Model):
     # 複合ユニーク制約: 同じ顧客が同じ本を複数追加できないようにする
     __table_args__ = (db.UniqueConstraint('customer_id', 'isbn', name='_customer_isbn_uc'),)
     
+    @validates('isbn')
+    def _set_isbn13(self, key, value):
+        self.isbn13 = canonical_isbn(value)
+        return value
+    
     def to_dict(self):
         return {
             'id': self.id,
@@ -255,3 +341,65 @@ class WishlistItem(db.Model):
             'thumbnail': self.thumbnail,
             'added_at': self.added_at.isoformat()
         }
+
+class IdempotencyKey(db.Model):
+    """冪等キーと、そのキーで返したレスポンス（再送時に同じ結果を返すため）"""
+    __tablename__ = 'idempotency_keys'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    scope = db.Column(db.String(50), nullable=False)  # エンドポイントの種類
+    key = db.Column(db.String(100), nullable=False)
+    request_hash = db.Column(db.String(64), nullable=False)
+    status_code = db.Column(db.Integer, nullable=False)
+    response_body = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    
+    __table_args__ = (db.UniqueConstraint('scope', 'key', name='_scope_key_uc'),)
+
+class RevokedToken(db.Model):
+    """失効させたトークン（ログアウトなど）。有効期限を過ぎたら削除してよい"""
+    __tablename__ = 'revoked_tokens'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    token_hash = db.Column(db.String(64), unique=True, nullable=False)  # トークンの SHA-256
+    revoked_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    expires_at = db.Column(db.DateTime)
+
+class Job(db.Model):
+    """バックグラウンドで実行する重い処理（エクスポート・取り込みなど）"""
+    __tablename__ = 'jobs'
+    
+    id = db.Column(db.String(32), primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    owner = db.Column(db.String(50), nullable=False)  # 'admin' または 'user:<ユーザーID>'
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued / running / succeeded / failed / cancelled
+    params = db.Column(db.Text)  # JSON
+    progress = db.Column(db.Text)  # JSON
+    result = db.Column(db.Text)  # JSON
+    result_path = db.Column(db.String(500))
+    result_name = db.Column(db.String(200))
+    result_mimetype = db.Column(db.String(100))
+    error = db.Column(db.Text)
+    cancel_requested = db.Column(db.Boolean, default=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    # 実行待ちのジョブを古い順に取り出す
+    __table_args__ = (db.Index('ix_jobs_status_created_at', 'status', 'created_at'),)
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'progress': json.loads(self.progress) if self.progress else None,
+            'result': json.loads(self.result) if self.result else None,
+            'has_file': bool(self.result_path),
+            'error': self.error,
+            'cancel_requested': bool(self.cancel_requested),
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
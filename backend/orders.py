@@ -0,0 +1,120 @@
+"""注文の登録（1件・一括）
+
+顧客の照合は1回のクエリで行い、注文明細はまとめて INSERT する。
+"""
+from isbn import canonical_isbn
+from models import db, Customer, Order, OrderItem
+
+CUSTOMER_FIELDS = ('name', 'email', 'phone', 'organization')
+ITEM_FIELDS = ('isbn', 'title', 'author', 'publisher', 'thumbnail')
+
+
+class OrderValidationError(ValueError):
+    """注文の内容が不正（errors は [{'index': 注文の位置, 'error': メッセージ}]）"""
+
+    def __init__(self, errors):
+        super().__init__(errors[0]['error'])
+        self.errors = errors
+
+
+def _validate_item(data):
+    if not isinstance(data, dict):
+        return None, '注文明細の形式が不正です'
+    if not data.get('title'):
+        return None, '書名は必須です'
+    values = {field: data.get(field) for field in ITEM_FIELDS}
+    try:
+        quantity = data.get('quantity')
+        values['quantity'] = int(quantity) if quantity not in (None, '') else 1
+        values['price'] = float(data['price']) if data.get('price') not in (None, '') else None
+    except (TypeError, ValueError):
+        return None, '数量または価格が数値ではありません'
+    if values['quantity'] < 1:
+        return None, '数量は1以上である必要があります'
+    return values, None
+
+
+def _validate_order(data):
+    """入力を検証して (注文の値, エラー) を返す"""
+    if not isinstance(data, dict):
+        return None, '注文の形式が不正です'
+    customer = data.get('customer') or {}
+    if not isinstance(customer, dict) or not customer.get('name'):
+        return None, '顧客名は必須です'
+    items = data.get('items') or []
+    if not isinstance(items, list):
+        return None, '注文明細の形式が不正です'
+    values = []
+    for item in items:
+        item_values, error = _validate_item(item)
+        if error:
+            return None, error
+        values.append(item_values)
+    return {
+        'customer': {field: customer.get(field) for field in CUSTOMER_FIELDS},
+        'notes': data.get('notes', ''),
+        'items': values
+    }, None
+
+
+def _resolve_customers(customers):
+    """(名前, メールアドレス) が一致する顧客を探し、無ければ作成する"""
+    names = {c['name'] for c in customers}
+    found = {}
+    for customer in Customer.query.filter(Customer.name.in_(names)).order_by(Customer.id):
+        found.setdefault((customer.name, customer.email), customer)
+
+    created = []
+    for values in customers:
+        key = (values['name'], values['email'])
+        if key not in found:
+            found[key] = Customer(**values)
+            created.append(found[key])
+    if created:
+        db.session.add_all(created)
+        db.session.flush()
+    return [found[(c['name'], c['email'])] for c in customers]
+
+
+def create_orders(payloads):
+    """注文をまとめて登録し、注文 ID のリストを返す
+
+    1件でも不正な注文があれば何も登録せず OrderValidationError を送出する。
+    呼び出し側で db.session.commit() すること。
+    """
+    orders, errors = [], []
+    for index, data in enumerate(payloads):
+        values, error = _validate_order(data)
+        if error:
+            errors.append({'index': index, 'error': error})
+        else:
+            orders.append(values)
+    if errors:
+        raise OrderValidationError(errors)
+
+    customers = _resolve_customers([values['customer'] for values in orders])
+    order_ids = _insert_orders([
+        {'customer_id': customer.id, 'notes': values['notes'], 'total_items': len(values['items'])}
+        for customer, values in zip(customers, orders)
+    ])
+
+    rows = [
+        dict(item, order_id=order_id, isbn13=canonical_isbn(item['isbn']))
+        for order_id, values in zip(order_ids, orders)
+        for item in values['items']
+    ]
+    if rows:
+        # 全行が同じ列を持つので1回の executemany で登録される
+        db.session.execute(OrderItem.__table__.insert(), rows)
+    return order_ids
+
+
+def _insert_orders(rows):
+    """注文をまとめて INSERT し、入力順の ID を返す
+
+    PostgreSQL では複数行の INSERT ... RETURNING にまとめられる
+    （SQLite では SQLAlchemy が1行ずつの INSERT に切り替える）。
+    """
+    table = Order.__table__
+    statement = table.insert().returning(table.c.id, sort_by_parameter_order=True)
+    return list(db.session.execute(statement, rows).scalars())
@@ -0,0 +1,79 @@
+"""一覧 API 用のカーソル（キーセット）ページング"""
+import base64
+import json
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+
+
+def encode_cursor(values):
+    """並び替えキーの値を URL に使えるカーソル文字列にする"""
+    encoded = []
+    for value in values:
+        if isinstance(value, datetime):
+            encoded.append({'dt': value.isoformat()})
+        else:
+            encoded.append(value)
+    raw = json.dumps(encoded, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """カーソル文字列を並び替えキーの値に戻す。不正な場合は ValueError"""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        decoded = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        values = []
+        for value in decoded:
+            if isinstance(value, dict):
+                values.append(datetime.fromisoformat(value['dt']))
+            else:
+                values.append(value)
+        return values
+    except (ValueError, KeyError, TypeError):
+        raise ValueError('cursor が不正です')
+
+
+def parse_page_args(args, default_limit=DEFAULT_LIMIT):
+    """クエリパラメータから (cursor, limit, fields) を取り出す"""
+    cursor = decode_cursor(args['cursor']) if args.get('cursor') else None
+    try:
+        limit = int(args.get('limit', default_limit))
+    except ValueError:
+        raise ValueError('limit は整数で指定してください')
+    limit = max(1, min(limit, MAX_LIMIT))
+    fields = [f.strip() for f in args.get('fields', '').split(',') if f.strip()] or None
+    return cursor, limit, fields
+
+
+def keyset_page(query, columns, cursor, limit, descending=True, key=None):
+    """キーセット方式で1ページ分を取得し、(行のリスト, next_cursor) を返す
+
+    columns は並び替えに使う列（最後は一意な列）。key は行から
+    columns に対応する値のタプルを取り出す関数。
+    """
+    if cursor is not None:
+        if len(cursor) != len(columns):
+            raise ValueError('cursor が不正です')
+        if descending:
+            query = query.filter(tuple_(*columns) < tuple(cursor))
+        else:
+            query = query.filter(tuple_(*columns) > tuple(cursor))
+    ordering = [c.desc() for c in columns] if descending else [c.asc() for c in columns]
+    rows = query.order_by(*ordering).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(key(rows[-1]))
+    return rows, next_cursor
+
+
+def project(record, fields):
+    """fields が指定されていれば、その項目だけを残す"""
+    if not fields:
+        return record
+    return {name: record[name] for name in fields if name in record}
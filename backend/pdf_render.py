@@ -0,0 +1,290 @@
+"""選書リストの注文書 PDF の生成
+
+フォントとスタイルはモジュールの読み込み時に1回だけ用意する。生成は
+スレッドプールで行い、できた PDF はエクスポートのキャッシュ（ExportCache）に
+保存するため、変更のないリストは再生成せずに返せる。
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import escape
+
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.cidfonts import UnicodeCIDFont
+from reportlab.platypus import SimpleDocTemplate, PageBreak, Paragraph, Spacer, Table
+
+
+def _register_font():
+    """日本語フォントを登録する。使えない環境では Helvetica を使う"""
+    try:
+        pdfmetrics.registerFont(UnicodeCIDFont('HeiseiKakuGo-W5'))
+        return 'HeiseiKakuGo-W5'
+    except Exception:
+        return 'Helvetica'
+
+
+FONT_NAME = _register_font()
+
+_styles = getSampleStyleSheet()
+TITLE_STYLE = ParagraphStyle(
+    'CustomTitle',
+    parent=_styles['Heading1'],
+    fontName=FONT_NAME,
+    fontSize=16,
+    spaceAfter=20,
+    alignment=1  # センター揃え
+)
+NORMAL_STYLE = ParagraphStyle(
+    'CustomNormal',
+    parent=_styles['Normal'],
+    fontName=FONT_NAME,
+    fontSize=10,
+    spaceAfter=6
+)
+CELL_STYLE = ParagraphStyle(
+    'ItemCell',
+    parent=_styles['Normal'],
+    fontName=FONT_NAME,
+    fontSize=8,
+    leading=10,
+    wordWrap='CJK'  # 日本語を文字単位で折り返す
+)
+ITEM_TABLE_STYLE = [
+    ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+    ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+    ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+    ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+    ('FONTNAME', (0, 0), (-1, -1), FONT_NAME),
+    ('FONTSIZE', (0, 0), (-1, -1), 8),
+    ('LEADING', (0, 0), (-1, -1), 10),
+    ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+    ('GRID', (0, 0), (-1, -1), 1, colors.black)
+]
+ITEM_HEADER = ['ISBN', '書名', '著者', '出版社', '本体価格', '数量', '小計']
+# 列幅を固定して、表の幅を全行から計算し直さないようにする（合計は A4 の本文幅）
+ITEM_COL_WIDTHS = [72, 130, 75, 64, 40, 26, 44]
+# Table の既定のセルの余白
+CELL_PADDING_X = 6
+CELL_PADDING_Y = 3
+# レイアウトを変えたら上げる（キャッシュ済みの古い PDF を使わないようにする）
+LAYOUT_VERSION = 2
+
+
+def _cell(value):
+    """折り返して表示するセル"""
+    return Paragraph(escape(value or ''), CELL_STYLE)
+
+
+def _yen(value):
+    return f'¥{value:,.0f}'
+
+
+def _item_rows(items):
+    """明細を (表の行, 小計, 行の高さ) にする
+
+    行の高さは折り返し後のセルの高さから求め、ページの区切りを決めるのに使う。
+    """
+    for isbn, title, author, publisher, price, quantity in items:
+        subtotal = (price or 0) * quantity
+        cells = [_cell(title), _cell(author), _cell(publisher)]
+        height = max(
+            cell.wrap(width - 2 * CELL_PADDING_X, A4[1])[1]
+            for cell, width in zip(cells, ITEM_COL_WIDTHS[1:4])
+        )
+        row = [
+            isbn or '',
+            *cells,
+            _yen(price) if price else '未定',
+            str(quantity),
+            _yen(subtotal) if price else '未定'
+        ]
+        yield row, subtotal, max(height, CELL_STYLE.leading) + 2 * CELL_PADDING_Y
+
+
+def _item_table(rows, total_amount=None):
+    """1ページ分の明細表。最後の行にページ小計、最終ページには合計を付ける"""
+    footers = [['ページ小計', '', '', '', '', '', _yen(sum(subtotal for _, subtotal in rows))]]
+    if total_amount is not None:
+        footers.append(['合計', '', '', '', '', '', _yen(total_amount)])
+    return _table([ITEM_HEADER] + [row for row, _ in rows], footers)
+
+
+def _table(data, footers):
+    style = list(ITEM_TABLE_STYLE)
+    style.append(('BACKGROUND', (0, 1), (-1, -1 - len(footers)), colors.beige))
+    for row in range(-len(footers), 0):
+        style.extend([
+            ('SPAN', (0, row), (-2, row)),
+            ('ALIGN', (0, row), (-2, row), 'RIGHT'),
+            ('BACKGROUND', (0, row), (-1, row), colors.lightgrey),
+        ])
+    # 行の高さの見積もりを超えてページに収まらない場合も、見出しを繰り返して分割する
+    return Table(data + footers, colWidths=ITEM_COL_WIDTHS, repeatRows=1, style=style)
+
+
+def _flowable_height(flowable, width, height):
+    return flowable.wrap(width, height)[1] + flowable.getSpaceBefore() + flowable.getSpaceAfter()
+
+
+def selection_list_document(book_list, user):
+    """PDF に載せる内容を取り出す（DB へのアクセスはここで済ませる）"""
+    return {
+        'user': {
+            'name': user.full_name or user.username,
+            'organization': user.organization,
+            'email': user.email,
+            'phone': user.phone
+        },
+        'list': {
+            'name': book_list.name,
+            'created_at': book_list.created_at
+        },
+        'items': [
+            (item.isbn, item.title, item.author, item.publisher, item.price, item.quantity)
+            for item in book_list.items
+        ]
+    }
+
+
+def render_selection_list(document, output):
+    """注文書 PDF を output（ファイルパスまたはファイルオブジェクト）に書き出す"""
+    doc = SimpleDocTemplate(output, pagesize=A4)
+    story = []
+
+    # タイトル
+    story.append(Paragraph('図書注文書', TITLE_STYLE))
+    story.append(Spacer(1, 20))
+
+    # 注文者情報
+    user = document['user']
+    story.append(Paragraph(f'注文者: {escape(str(user["name"]))}', NORMAL_STYLE))
+    if user['organization']:
+        story.append(Paragraph(f'所属: {escape(str(user["organization"]))}', NORMAL_STYLE))
+    story.append(Paragraph(f'メール: {escape(str(user["email"]))}', NORMAL_STYLE))
+    if user['phone']:
+        story.append(Paragraph(f'電話: {escape(str(user["phone"]))}', NORMAL_STYLE))
+    story.append(Spacer(1, 20))
+
+    # リスト情報
+    book_list = document['list']
+    story.append(Paragraph(f'選書リスト名: {escape(str(book_list["name"]))}', NORMAL_STYLE))
+    story.append(Paragraph(f'作成日: {book_list["created_at"].strftime("%Y年%m月%d日")}', NORMAL_STYLE))
+    story.append(Spacer(1, 20))
+
+    # 書籍リスト（ページに収まる行数ごとに表を分け、ページごとに小計を出す）
+    items = document['items']
+    if items:
+        total_amount = sum((price or 0) * quantity for *_, price, quantity in items)
+        frame_height = doc.height - 12  # Frame の上下の余白の分を引く
+        # 見出し行と小計・合計の行の高さ
+        fixed_height = _flowable_height(
+            _table([ITEM_HEADER], [['', '', '', '', '', '', '']] * 2), doc.width, frame_height
+        )
+        available = frame_height - fixed_height - sum(
+            _flowable_height(flowable, doc.width, frame_height) for flowable in story
+        )
+        page, page_height = [], 0
+        for row, subtotal, height in _item_rows(items):
+            if page and page_height + height > available:
+                story.append(_item_table(page))
+                story.append(PageBreak())
+                page, page_height = [], 0
+                available = frame_height - fixed_height
+            page.append((row, subtotal))
+            page_height += height
+        story.append(_item_table(page, total_amount))
+
+    doc.build(story)
+
+
+class PdfRenderer:
+    """PDF の生成キュー
+
+    生成した PDF は ExportCache に保存する。render_id は「選書リスト ID-キャッシュキー」。
+    生成中・失敗の印もキャッシュと同じディレクトリにファイルで置くので、
+    複数のワーカープロセスで共有される。
+    """
+
+    # 生成中の印がこれより古ければ、生成したプロセスが止まったとみなす（秒）
+    PENDING_TIMEOUT = 300
+
+    def __init__(self, cache, workers=2):
+        self.cache = cache
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pdf-render')
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, cache):
+        return cls(
+            cache,
+            workers=int(os.getenv('PDF_RENDER_WORKERS', 2)),
+        )
+
+    def _marker(self, render_id, suffix):
+        return os.path.join(self.cache.cache_dir, render_id + suffix)
+
+    def cached_path(self, render_id):
+        """生成済みの PDF のパス。無ければ None"""
+        return self.cache.get(render_id, 'pdf')
+
+    def status(self, render_id):
+        """生成状況を done / pending / failed / missing のいずれかで返す"""
+        if self.cached_path(render_id):
+            return {'status': 'done'}
+        with self._lock:
+            if render_id in self._futures:
+                return {'status': 'pending'}
+        try:
+            if time.time() - os.path.getmtime(self._marker(render_id, '.pending')) < self.PENDING_TIMEOUT:
+                return {'status': 'pending'}
+        except OSError:
+            pass
+        try:
+            with open(self._marker(render_id, '.error'), encoding='utf-8') as f:
+                return {'status': 'failed', 'error': f.read()}
+        except OSError:
+            return {'status': 'missing'}
+
+    def submit(self, render_id, write):
+        """生成を依頼する。write(ファイルオブジェクト) は DB にアクセスしないこと
+
+        同じ render_id の生成中はその Future を返す。
+        """
+        with self._lock:
+            future = self._futures.get(render_id)
+            if future is None:
+                with open(self._marker(render_id, '.pending'), 'w'):
+                    pass
+                future = self._executor.submit(self._render, render_id, write)
+                self._futures[render_id] = future
+            return future
+
+    def render(self, render_id, write):
+        """生成を依頼して完了を待ち、PDF のパスを返す（同じ生成を待つ場合も同時に実行するのは1回）"""
+        return self.submit(render_id, write).result()
+
+    def _render(self, render_id, write):
+        try:
+            path = self.cache.store(render_id, 'pdf', write)
+        except Exception as e:
+            with open(self._marker(render_id, '.error'), 'w', encoding='utf-8') as f:
+                f.write(str(e))
+            raise
+        finally:
+            self._discard(self._marker(render_id, '.pending'))
+            with self._lock:
+                self._futures.pop(render_id, None)
+        self._discard(self._marker(render_id, '.error'))
+        return path
+
+    @staticmethod
+    def _discard(path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
@@ -0,0 +1,62 @@
+"""よく使うクエリの実行計画の確認
+
+一覧・検索・エクスポートなどで頻繁に実行するクエリを EXPLAIN し、想定した
+インデックスが使われているかを確認する。`flask --app app check-indexes` で実行し、
+使われていないクエリがあれば終了コード 1 で終わる（デプロイ前の確認用）。
+
+PostgreSQL では行数の少ないテーブルだと順次走査が選ばれるため、確認中は
+enable_seqscan を無効にして、インデックスを使える計画かどうかだけを見る。
+"""
+from sqlalchemy import select, text
+
+from models import BookCache, BookSelectionItem, BookSelectionList, Customer, Job, Order, OrderItem
+
+
+def _hot_queries():
+    """(名前, 使われるべきインデックス, クエリ) のリスト"""
+    return [
+        ('注文一覧（注文日の新しい順）', 'ix_orders_order_date_id',
+         select(Order.id).order_by(Order.order_date.desc(), Order.id.desc()).limit(50)),
+        ('顧客ごとの注文一覧', 'ix_orders_customer_id_order_date_id',
+         select(Order.id).where(Order.customer_id == 1)
+         .order_by(Order.order_date.desc(), Order.id.desc()).limit(50)),
+        ('注文明細の読み込み', 'ix_order_items_order_id',
+         select(OrderItem.id).where(OrderItem.order_id.in_([1, 2, 3]))),
+        ('注文時の顧客の照合', 'ix_customers_name_email',
+         select(Customer.id).where(Customer.name.in_(['a', 'b']))),
+        ('選書リストの一覧', 'ix_book_selection_lists_user_id_updated_at_id',
+         select(BookSelectionList.id).where(BookSelectionList.user_id == 1)
+         .order_by(BookSelectionList.updated_at.desc(), BookSelectionList.id.desc()).limit(50)),
+        ('選書リストのアイテム一覧', 'ix_book_selection_items_list_id_added_at_id',
+         select(BookSelectionItem.id).where(BookSelectionItem.list_id == 1)
+         .order_by(BookSelectionItem.added_at.desc(), BookSelectionItem.id.desc()).limit(50)),
+        ('書籍検索（ジャンル・価格）', 'ix_book_cache_genre_price',
+         select(BookCache.id).where(BookCache.genre == '歴史', BookCache.price >= 1000, BookCache.price <= 3000)),
+        ('書籍検索（利用対象・価格）', 'ix_book_cache_target_audience_price',
+         select(BookCache.id).where(BookCache.target_audience == '中学生', BookCache.price <= 3000)),
+        ('実行待ちのジョブの取り出し', 'ix_jobs_status_created_at',
+         select(Job.id).where(Job.status == 'queued').order_by(Job.created_at).limit(5)),
+    ]
+
+
+def explain(connection, statement):
+    """クエリの実行計画を行のリストで返す"""
+    dialect = connection.dialect
+    sql = str(statement.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+    if dialect.name == 'sqlite':
+        return [row[-1] for row in connection.execute(text('EXPLAIN QUERY PLAN ' + sql))]
+    return [row[0] for row in connection.execute(text('EXPLAIN ' + sql))]
+
+
+def check_query_plans(bind):
+    """各クエリの (名前, インデックス, 使われたか, 実行計画) のリストを返す"""
+    results = []
+    with bind.connect() as connection:
+        if connection.dialect.name == 'postgresql':
+            connection.execute(text('SET LOCAL enable_seqscan = off'))
+        for name, index_name, statement in _hot_queries():
+            plan = explain(connection, statement)
+            used = any(index_name in line for line in plan)
+            results.append((name, index_name, used, plan))
+        connection.rollback()
+    return results
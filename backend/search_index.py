@@ -0,0 +1,184 @@
+"""BookCache の全文検索インデックス (SQLite FTS5)
+
+日本語は形態素解析の代わりに bigram に分割して格納し、検索語も同じ規則で
+bigram のフレーズに変換して MATCH する。英数字は単語単位で扱う。
+"""
+import re
+import unicodedata
+
+from sqlalchemy import Float, Integer, column, event, select, text
+
+from models import db, BookCache
+
+FTS_TABLE = 'book_cache_fts'
+
+# bm25 の列ごとの重み（title, author, publisher, description）
+COLUMN_WEIGHTS = (10.0, 5.0, 2.0, 1.0)
+
+_WORD_RE = re.compile(r'[^\W_]+')
+_CJK_RE = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]')
+
+
+def _split_runs(word):
+    """単語を CJK 部分とそれ以外の部分に分ける"""
+    runs = []
+    current = ''
+    current_is_cjk = None
+    for ch in word:
+        is_cjk = bool(_CJK_RE.match(ch))
+        if current and is_cjk != current_is_cjk:
+            runs.append((current, current_is_cjk))
+            current = ''
+        current += ch
+        current_is_cjk = is_cjk
+    if current:
+        runs.append((current, current_is_cjk))
+    return runs
+
+
+def tokenize(value):
+    """テキストをインデックス用のトークン列に変換する"""
+    if not value:
+        return []
+    normalized = unicodedata.normalize('NFKC', value).lower()
+    tokens = []
+    for word in _WORD_RE.findall(normalized):
+        for run, is_cjk in _split_runs(word):
+            if is_cjk and len(run) > 1:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+            else:
+                tokens.append(run)
+    return tokens
+
+
+def _index_text(value):
+    return ' '.join(tokenize(value))
+
+
+def build_match_query(query):
+    """検索語を FTS5 の MATCH 式に変換する。検索できない場合は None"""
+    phrases = []
+    for word in (query or '').split():
+        tokens = tokenize(word)
+        if not tokens:
+            continue
+        # 1文字の CJK は bigram に一致しないため全文検索では扱えない
+        if len(tokens) == 1 and len(tokens[0]) == 1 and _CJK_RE.match(tokens[0]):
+            return None
+        phrase = '"' + ' '.join(tokens) + '"'
+        # 英数字の語は前方一致で検索する
+        if not _CJK_RE.match(tokens[-1]):
+            phrase += ' *'
+        phrases.append(phrase)
+    if not phrases:
+        return None
+    return ' AND '.join(phrases)
+
+
+def is_available(bind=None):
+    bind = bind or db.engine
+    return bind.dialect.name == 'sqlite'
+
+
+def _row_params(book):
+    return {
+        'rowid': book.id,
+        'title': _index_text(book.title),
+        'author': _index_text(book.author),
+        'publisher': _index_text(book.publisher),
+        'description': _index_text(book.description),
+    }
+
+
+_INSERT_SQL = text(
+    f'INSERT INTO {FTS_TABLE} (rowid, title, author, publisher, description) '
+    'VALUES (:rowid, :title, :author, :publisher, :description)'
+)
+_DELETE_SQL = text(f'DELETE FROM {FTS_TABLE} WHERE rowid = :rowid')
+
+
+def index_books(connection, books):
+    """書籍をインデックスに登録（既存行は置き換え）する"""
+    params = [_row_params(book) for book in books if book.id is not None]
+    if not params:
+        return
+    connection.execute(_DELETE_SQL, [{'rowid': p['rowid']} for p in params])
+    connection.execute(_INSERT_SQL, params)
+
+
+def unindex_books(connection, book_ids):
+    """指定した書籍をインデックスから削除する"""
+    if book_ids:
+        connection.execute(_DELETE_SQL, [{'rowid': book_id} for book_id in book_ids])
+
+
+def create_search_index(connection):
+    """FTS テーブルを作成し、既存のキャッシュを取り込む（マイグレーションから呼ぶ）"""
+    if not is_available(connection):
+        return
+    exists = connection.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+        {'name': FTS_TABLE}
+    ).first()
+    if exists:
+        return
+    connection.execute(text(
+        f'CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5('
+        "title, author, publisher, description, tokenize = 'unicode61')"
+    ))
+    rebuild_search_index(connection)
+
+
+def rebuild_search_index(connection, batch_size=1000):
+    """BookCache 全体からインデックスを作り直す（コミットは呼び出し側で行う）"""
+    if not is_available(connection):
+        return
+    connection.execute(text(f'DELETE FROM {FTS_TABLE}'))
+    books = BookCache.__table__
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            select(books.c.id, books.c.title, books.c.author, books.c.publisher, books.c.description)
+            .where(books.c.id > last_id).order_by(books.c.id).limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        index_books(connection, rows)
+        last_id = rows[-1].id
+
+
+def filter_by_text(query, keyword):
+    """BookCache のクエリに全文検索条件を適用し、関連度順に並べる
+
+    全文検索が使えない場合（SQLite 以外、1文字の漢字検索など）は
+    LIKE 検索にフォールバックする。
+    """
+    match = build_match_query(keyword) if is_available() else None
+    if match is None:
+        return query.filter(
+            (BookCache.title.contains(keyword)) |
+            (BookCache.author.contains(keyword)) |
+            (BookCache.publisher.contains(keyword))
+        )
+    weights = ', '.join(str(w) for w in COLUMN_WEIGHTS)
+    ranked = text(
+        f'SELECT rowid AS book_id, bm25({FTS_TABLE}, {weights}) AS rank '
+        f'FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :match'
+    ).bindparams(match=match).columns(
+        column('book_id', Integer), column('rank', Float)
+    ).subquery()
+    return query.join(ranked, ranked.c.book_id == BookCache.id).order_by(ranked.c.rank)
+
+
+# ORM 経由の変更をインデックスに反映する
+@event.listens_for(BookCache, 'after_insert')
+@event.listens_for(BookCache, 'after_update')
+def _sync_search_index(mapper, connection, target):
+    if is_available(connection):
+        index_books(connection, [target])
+
+
+@event.listens_for(BookCache, 'after_delete')
+def _remove_from_search_index(mapper, connection, target):
+    if is_available(connection):
+        unindex_books(connection, [target.id])
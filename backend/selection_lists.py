@@ -0,0 +1,95 @@
+"""選書リストへのアイテムの一括追加"""
+from datetime import datetime
+
+from isbn import canonical_isbn
+from models import db, BookSelectionItem
+
+ITEM_FIELDS = ('author', 'publisher', 'price', 'volume_count', 'is_set_only', 'thumbnail')
+
+
+def _match_key(isbn):
+    """重複判定のキー（ISBN-13。有効な ISBN でなければ入力のまま）"""
+    return canonical_isbn(isbn) or isbn
+
+
+def _validate(data):
+    """入力を検証して (アイテムの値, エラー) を返す"""
+    if not isinstance(data, dict):
+        return None, '形式が不正です'
+    isbn = str(data.get('isbn') or '').strip()
+    title = data.get('title')
+    if not isbn or not title:
+        return None, 'ISBNと書名は必須です'
+    if not canonical_isbn(isbn):
+        return None, f'ISBN が不正です: {isbn}'
+    try:
+        quantity = int(data.get('quantity', 1))
+    except (TypeError, ValueError):
+        return None, '数量は整数で指定してください'
+    if quantity < 1:
+        return None, '数量は1以上である必要があります'
+    values = {field: data.get(field) for field in ITEM_FIELDS}
+    values['volume_count'] = values['volume_count'] or 1
+    values['is_set_only'] = bool(values['is_set_only'])
+    values.update(isbn=isbn, title=title, quantity=quantity)
+    return values, None
+
+
+def add_items(book_list, items, merge_quantities=False):
+    """選書リストにアイテムをまとめて追加し、1件ごとの結果を返す
+
+    既存アイテムとの重複は1回のクエリで調べ、追加は1トランザクションで行う。
+    結果の status は added / duplicate / merged / invalid のいずれか。
+    merge_quantities が真の場合、重複した書籍は数量を加算する（merged）。
+    呼び出し側で db.session.commit() すること。
+    """
+    outcomes = [None] * len(items)
+    accepted = {}  # 重複判定のキー -> 値（同じ書籍の最初の入力）
+    positions = {}  # 重複判定のキー -> その書籍に該当する入力の位置
+    for index, data in enumerate(items):
+        values, error = _validate(data)
+        if error:
+            isbn = data.get('isbn') if isinstance(data, dict) else None
+            outcomes[index] = {'index': index, 'isbn': isbn, 'status': 'invalid', 'error': error}
+            continue
+        key = _match_key(values['isbn'])
+        positions.setdefault(key, []).append(index)
+        if key not in accepted:
+            accepted[key] = values
+        elif merge_quantities:
+            accepted[key]['quantity'] += values['quantity']
+
+    existing = {}
+    if accepted:
+        keys = list(accepted)
+        query = BookSelectionItem.query.filter(BookSelectionItem.list_id == book_list.id).filter(
+            BookSelectionItem.isbn13.in_(keys) | BookSelectionItem.isbn.in_(keys)
+        )
+        existing = {_match_key(item.isbn): item for item in query}
+
+    statuses = {}
+    for key, values in accepted.items():
+        current = existing.get(key)
+        if current is None:
+            existing[key] = BookSelectionItem(list_id=book_list.id, **values)
+            db.session.add(existing[key])
+            statuses[key] = 'added'
+        elif merge_quantities:
+            current.quantity += values['quantity']
+            statuses[key] = 'merged'
+        else:
+            statuses[key] = 'duplicate'
+
+    if any(status != 'duplicate' for status in statuses.values()):
+        book_list.updated_at = datetime.utcnow()
+    db.session.flush()
+
+    for key, indexes in positions.items():
+        item = existing[key]
+        for n, index in enumerate(indexes):
+            status = statuses[key]
+            if n > 0:
+                # 同じリクエスト内の2件目以降
+                status = 'merged' if merge_quantities else 'duplicate'
+            outcomes[index] = {'index': index, 'isbn': items[index]['isbn'], 'status': status, 'item_id': item.id}
+    return outcomes
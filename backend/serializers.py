@@ -0,0 +1,24 @@
+"""エンドポイントごとのリレーション読み込み方針
+
+lazy=True のリレーションを to_dict 内で辿ると行ごとにクエリが発行されるため、
+一覧系のエンドポイントでは読み込み方針（load plan）をここで宣言し、
+クエリに適用してから to_dict する。
+"""
+from sqlalchemy.orm import joinedload, selectinload
+
+from models import Order, BookSelectionList
+
+# エンドポイント名 -> クエリに付与するローダーオプション
+LOAD_PLANS = {
+    'admin_get_orders': lambda: (joinedload(Order.customer), selectinload(Order.items)),
+    'admin_get_customer_orders': lambda: (joinedload(Order.customer), selectinload(Order.items)),
+    'manage_selection_lists': lambda: (selectinload(BookSelectionList.items),),
+}
+
+
+def apply_load_plan(query, endpoint):
+    """エンドポイントの読み込み方針をクエリに適用する"""
+    plan = LOAD_PLANS.get(endpoint)
+    if plan is None:
+        return query
+    return query.options(*plan())
@@ -0,0 +1,39 @@
+"""テスト用のアプリケーション
+
+app.py は読み込み時にデータベースを初期化するため、読み込む前に一時ディレクトリの
+SQLite と、バックグラウンド処理を止める設定を環境変数に入れておく。
+"""
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+_tmp_dir = tempfile.mkdtemp(prefix='book-order-test-')
+atexit.register(shutil.rmtree, _tmp_dir, ignore_errors=True)
+os.environ.update({
+    'DATABASE_URL': f'sqlite:///{os.path.join(_tmp_dir, "test.db")}',
+    'EXPORT_CACHE_DIR': os.path.join(_tmp_dir, 'exports'),
+    'JOB_RESULT_DIR': os.path.join(_tmp_dir, 'jobs'),
+    'JOB_WORKERS': '0',
+    'BOOK_CACHE_MAINTENANCE_INTERVAL': '0',
+    'PASSWORD_HASH_WORKERS': '0',
+    # 失効リストの読み込みがリクエストのクエリ数に混ざらないようにする
+    'AUTH_REVOCATION_REFRESH': '1000000000',
+})
+
+
+@pytest.fixture(scope='session')
+def app_module():
+    import app
+    return app
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
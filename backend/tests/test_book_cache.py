@@ -0,0 +1,18 @@
+"""BookCache の上流への問い合わせ"""
+ISBN13 = '9784060000002'
+
+
+def test_get_book_queries_upstream_with_canonical_isbn(app_module):
+    policy = app_module.cache_policy
+    queried = []
+
+    def fetch(isbn):
+        queried.append(isbn)
+        return []
+
+    with app_module.app.app_context():
+        # ハイフン付き・ISBN-10 の入力でも、上流には同じ ISBN-13 で問い合わせる
+        for isbn in ('978-4-06-000000-2', '4-06-000000-0', '4060000000'):
+            policy.negative.invalidate(ISBN13)
+            assert policy.get_book(isbn, fetch) is None
+    assert queried == [ISBN13] * 3
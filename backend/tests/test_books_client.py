@@ -0,0 +1,137 @@
+"""Google Books API クライアント
+
+GOOGLE_BOOKS_API_URL をローカルの偽サーバーに向け、再試行・サーキットブレーカー・
+single-flight で上流へのリクエスト数がどうなるかを確かめる。
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from books_client import BooksApiError, BooksClient, CircuitOpenError
+
+
+class FakeGoogleBooks:
+    """応答するステータスを順に返す偽の Google Books API"""
+
+    def __init__(self):
+        self.statuses = []
+        self.delay = 0
+        self.requests = []
+        self._lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with fake._lock:
+                    fake.requests.append(self.path)
+                    status = fake.statuses.pop(0) if fake.statuses else 200
+                time.sleep(fake.delay)
+                body = json.dumps({'totalItems': 0, 'items': []}).encode()
+                self.send_response(status)
+                if status == 429:
+                    self.send_header('Retry-After', '0')
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/books/v1/volumes'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def fake_api():
+    fake = FakeGoogleBooks()
+    yield fake
+    fake.close()
+
+
+@pytest.fixture
+def make_client(fake_api, monkeypatch):
+    def make(**env):
+        monkeypatch.setenv('GOOGLE_BOOKS_API_URL', fake_api.url)
+        monkeypatch.setenv('GOOGLE_BOOKS_API_KEY', '')
+        for name, value in env.items():
+            monkeypatch.setenv(name, str(value))
+        client = BooksClient.from_env()
+        client.backoff_base = 0.01
+        return client
+    return make
+
+
+def test_retries_5xx_and_429(fake_api, make_client):
+    fake_api.statuses = [503, 429, 200]
+    client = make_client()
+    assert client.lookup_isbn('9784000000000') == {'totalItems': 0, 'items': []}
+    assert len(fake_api.requests) == 3
+
+
+def test_gives_up_after_max_retries(fake_api, make_client):
+    fake_api.statuses = [500] * 10
+    client = make_client(GOOGLE_BOOKS_BREAKER_FAILURES=100)
+    with pytest.raises(BooksApiError):
+        client.lookup_isbn('9784000000000')
+    assert len(fake_api.requests) == client.max_retries + 1
+
+
+def test_does_not_retry_4xx(fake_api, make_client):
+    fake_api.statuses = [404]
+    client = make_client()
+    with pytest.raises(BooksApiError):
+        client.lookup_isbn('9784000000000')
+    assert len(fake_api.requests) == 1
+
+
+def test_breaker_opens_and_half_opens(fake_api, make_client):
+    fake_api.statuses = [500] * 3
+    client = make_client(GOOGLE_BOOKS_BREAKER_FAILURES=3, GOOGLE_BOOKS_BREAKER_RESET=0.2)
+    with pytest.raises(BooksApiError):
+        client.lookup_isbn('9784000000000')
+    assert len(fake_api.requests) == 3
+    assert client.breaker.is_open
+
+    # 開いている間は上流を呼ばない
+    with pytest.raises(CircuitOpenError):
+        client.lookup_isbn('9784000000000')
+    assert len(fake_api.requests) == 3
+
+    # 遮断時間の経過後は1件だけ試し、成功すれば閉じる
+    time.sleep(0.3)
+    client.lookup_isbn('9784000000000')
+    assert len(fake_api.requests) == 4
+    assert not client.breaker.is_open
+
+
+def test_single_flight_collapses_concurrent_lookups(fake_api, make_client):
+    fake_api.delay = 0.5
+    client = make_client()
+    count = 10
+    barrier = threading.Barrier(count)
+    results, errors = [], []
+
+    def lookup():
+        barrier.wait()
+        try:
+            results.append(client.lookup_isbn('9784000000000'))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=lookup) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert len(results) == count
+    assert len(fake_api.requests) == 1
@@ -0,0 +1,59 @@
+"""SQLite への同時書き込み
+
+WAL モードで、読み取ってから書き込む処理を複数のスレッドから同時に実行しても、
+@write_transaction の中であれば "database is locked" にならないことを確かめる。
+"""
+import threading
+import time
+import uuid
+
+from sqlalchemy import func, text
+
+from database import write_transaction
+from models import db, Customer
+
+THREADS = 8
+WRITES_PER_THREAD = 20
+
+
+def test_journal_mode_is_wal(app_module):
+    with app_module.app.app_context():
+        assert db.session.execute(text('PRAGMA journal_mode')).scalar().lower() == 'wal'
+
+
+def test_concurrent_read_then_write(app_module):
+    prefix = f'同時書き込み{uuid.uuid4().hex[:8]}-'
+
+    @write_transaction
+    def add_customer(number):
+        # 読み取りでトランザクションを始めてから書き込む
+        db.session.execute(db.select(func.count()).select_from(Customer)).scalar()
+        time.sleep(0.001)
+        db.session.add(Customer(name=f'{prefix}{number}'))
+        db.session.commit()
+
+    barrier = threading.Barrier(THREADS)
+    errors = []
+
+    def worker(thread_number):
+        barrier.wait()
+        for i in range(WRITES_PER_THREAD):
+            with app_module.app.test_request_context(method='POST'):
+                try:
+                    add_customer(thread_number * WRITES_PER_THREAD + i)
+                except Exception as e:
+                    db.session.rollback()
+                    errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors, errors[:3]
+    with app_module.app.app_context():
+        count = db.session.execute(
+            db.select(func.count()).select_from(Customer).where(Customer.name.startswith(prefix))
+        ).scalar()
+    assert count == THREADS * WRITES_PER_THREAD
@@ -0,0 +1,17 @@
+"""エクスポートのファイルキャッシュ"""
+import os
+import time
+
+from exports import ExportCache
+
+
+def test_prune_removes_stale_markers(tmp_path):
+    cache = ExportCache(str(tmp_path))
+    old = time.time() - 2 * 3600
+    for name in ('a.tmp', 'b.pending', 'c.error', 'd.pdf'):
+        (tmp_path / name).write_text('')
+        os.utime(tmp_path / name, (old, old))
+    (tmp_path / 'e.error').write_text('')
+
+    cache.prune()
+    assert sorted(os.listdir(tmp_path)) == ['d.pdf', 'e.error']
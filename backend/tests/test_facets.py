@@ -0,0 +1,21 @@
+"""検索結果のファセット件数"""
+import uuid
+
+import facets
+from models import db, BookCache
+from search_index import filter_by_text
+
+
+def test_search_facets_counts_only_top_matches(app_module, monkeypatch):
+    keyword = f'facet{uuid.uuid4().hex[:8]}'
+    with app_module.app.app_context():
+        for i in range(5):
+            db.session.add(BookCache(isbn=f'{keyword}-{i}', title=f'{keyword} {i}', genre='歴史', price=1500))
+        db.session.commit()
+
+        query = filter_by_text(BookCache.query, keyword)
+        assert facets.search_facets(query, {})['genre'] == [{'value': '歴史', 'count': 5}]
+
+        # 一致した件数が多くても、関連度の上位 MATCH_LIMIT 件だけを集計する
+        monkeypatch.setattr(facets, 'MATCH_LIMIT', 3)
+        assert facets.search_facets(query, {})['genre'] == [{'value': '歴史', 'count': 3}]
@@ -0,0 +1,54 @@
+"""注文書 PDF の生成にかかる手間
+
+明細をページごとの表に分けていれば、表の組版（Table.wrap）で扱う行数は明細の
+行数にほぼ比例する。1つの表に全行を入れる組み方に戻ると、ページを送るたびに
+残りの行をすべて組み直すため、行数の2乗で増える。
+
+経過時間は環境による揺れが大きく、数千行までは差も小さいため、生成時間を決める
+組版の行数を数えて、10倍の明細で 10 倍を大きく超えないことを確かめる。
+"""
+import io
+from datetime import datetime
+
+from reportlab.platypus import Table
+
+from pdf_render import render_selection_list
+
+SMALL = 100
+LARGE = 1000
+# 表ごとに組むと約 10 倍、1つの表に全行を入れると約 70 倍になる
+MAX_RATIO = 15
+
+
+def _document(count):
+    return {
+        'user': {'name': '山田 太郎', 'organization': '○○小学校', 'email': 'taro@example.com', 'phone': None},
+        'list': {'name': '選書リスト', 'created_at': datetime(2024, 4, 1)},
+        'items': [
+            (f'978400000{i:04d}', f'書籍のタイトル {i} ' * (1 + i % 3), '著者名', '出版社', 1000 + i, 1 + i % 3)
+            for i in range(count)
+        ],
+    }
+
+
+def _laid_out_rows(monkeypatch, document):
+    """PDF を生成し、Table.wrap で組んだ行数の合計を返す"""
+    rows = [0]
+    wrap = Table.wrap
+
+    def counting_wrap(self, *args, **kwargs):
+        rows[0] += len(self._cellvalues)
+        return wrap(self, *args, **kwargs)
+
+    monkeypatch.setattr(Table, 'wrap', counting_wrap)
+    output = io.BytesIO()
+    render_selection_list(document, output)
+    monkeypatch.setattr(Table, 'wrap', wrap)
+    assert output.getvalue().startswith(b'%PDF')
+    return rows[0]
+
+
+def test_layout_work_is_linear(monkeypatch):
+    small = _laid_out_rows(monkeypatch, _document(SMALL))
+    large = _laid_out_rows(monkeypatch, _document(LARGE))
+    assert large / small < MAX_RATIO, (small, large)
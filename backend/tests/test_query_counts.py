@@ -0,0 +1,110 @@
+"""一覧系エンドポイントのクエリ数
+
+読み込み方針（serializers.LOAD_PLANS）が効いていれば、発行される SQL の数は
+件数によらず一定になる。N 件と 5N 件で同じ数になることを確かめる。
+"""
+import uuid
+
+import pytest
+from sqlalchemy import event
+
+from models import db, Admin, BookSelectionItem, BookSelectionList, Customer, Order, OrderItem, User
+
+N = 8
+ITEMS_PER_ROW = 3
+
+
+def _count_queries(app_module, client, url, headers):
+    """リクエスト中に発行された SQL の数と、レスポンスの JSON を返す"""
+    with app_module.app.app_context():
+        engine = db.engine
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        response = client.get(url, headers=headers)
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    assert response.status_code == 200, response.get_json()
+    return len(statements), response.get_json()
+
+
+def _add_orders(customer_id, count):
+    for _ in range(count):
+        order = Order(customer_id=customer_id, total_items=ITEMS_PER_ROW)
+        order.items = [
+            OrderItem(isbn=f'978400000{i:04d}', title=f'書籍{i}', quantity=1, price=1000)
+            for i in range(ITEMS_PER_ROW)
+        ]
+        db.session.add(order)
+    db.session.commit()
+
+
+def _add_selection_lists(user_id, count):
+    for _ in range(count):
+        book_list = BookSelectionList(user_id=user_id, name='選書リスト')
+        book_list.items = [
+            BookSelectionItem(isbn=f'978400000{i:04d}', title=f'書籍{i}', quantity=2, price=1000)
+            for i in range(ITEMS_PER_ROW)
+        ]
+        db.session.add(book_list)
+    db.session.commit()
+
+
+@pytest.fixture
+def admin_headers(app_module):
+    with app_module.app.app_context():
+        admin = Admin.query.first()
+        return {'Authorization': f'Bearer {app_module.generate_token(admin.id)}'}
+
+
+@pytest.fixture
+def customer_id(app_module):
+    with app_module.app.app_context():
+        customer = Customer(name=f'顧客{uuid.uuid4().hex[:8]}', email='customer@example.com')
+        db.session.add(customer)
+        db.session.commit()
+        return customer.id
+
+
+@pytest.fixture
+def user(app_module):
+    with app_module.app.app_context():
+        name = f'user{uuid.uuid4().hex[:8]}'
+        user = User(username=name, email=f'{name}@example.com', password_hash='-')
+        db.session.add(user)
+        db.session.commit()
+        return user.id, {'Authorization': f'Bearer {app_module.generate_user_token(user.id)}'}
+
+
+def _assert_constant(app_module, client, url, headers, key, grow):
+    """N 件のときと 5N 件のときのクエリ数が同じであること"""
+    with app_module.app.app_context():
+        grow(N)
+    # 初回のみのクエリ（キャッシュの読み込みなど）を数えないよう、1回空打ちする
+    client.get(url, headers=headers)
+    small, small_body = _count_queries(app_module, client, url, headers)
+    with app_module.app.app_context():
+        grow(4 * N)
+    large, large_body = _count_queries(app_module, client, url, headers)
+    assert len(large_body[key]) >= len(small_body[key]) + 4 * N
+    assert small == large
+
+
+def test_admin_get_orders(app_module, client, admin_headers, customer_id):
+    _assert_constant(app_module, client, '/api/admin/orders?limit=500', admin_headers, 'orders',
+                     lambda count: _add_orders(customer_id, count))
+
+
+def test_admin_get_customer_orders(app_module, client, admin_headers, customer_id):
+    _assert_constant(app_module, client, f'/api/admin/customer/{customer_id}/orders?limit=500', admin_headers,
+                     'orders', lambda count: _add_orders(customer_id, count))
+
+
+def test_manage_selection_lists(app_module, client, user):
+    user_id, headers = user
+    _assert_constant(app_module, client, '/api/selection-lists?limit=500', headers, 'lists',
+                     lambda count: _add_selection_lists(user_id, count))
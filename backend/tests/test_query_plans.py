@@ -0,0 +1,15 @@
+"""よく使うクエリの実行計画
+
+query_plans.check_query_plans が挙げるクエリが、いずれも想定したインデックスを
+使っていることを確かめる（インデックスの削除や条件の変更で使われなくなったら失敗する）。
+"""
+from models import db
+from query_plans import check_query_plans
+
+
+def test_hot_queries_use_indexes(app_module):
+    with app_module.app.app_context():
+        results = check_query_plans(db.engine)
+    assert results
+    unused = [(name, index_name, plan) for name, index_name, used, plan in results if not used]
+    assert not unused
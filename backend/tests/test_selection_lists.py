@@ -0,0 +1,33 @@
+"""選書リストへの一括追加"""
+import uuid
+
+from importers import _to_item
+from models import db, BookSelectionList, User
+
+
+def _user_list(app_module):
+    with app_module.app.app_context():
+        name = f'user{uuid.uuid4().hex[:8]}'
+        user = User(username=name, email=f'{name}@example.com', password_hash='-')
+        db.session.add(user)
+        db.session.flush()
+        book_list = BookSelectionList(user_id=user.id, name='選書リスト')
+        db.session.add(book_list)
+        db.session.commit()
+        return book_list.id, {'Authorization': f'Bearer {app_module.generate_user_token(user.id)}'}
+
+
+def test_bulk_add_rejects_malformed_isbn(app_module, client):
+    list_id, headers = _user_list(app_module)
+    response = client.post(f'/api/selection-lists/{list_id}/items/bulk', headers=headers, json={'items': [
+        {'isbn': '978-4-00-000000-0', 'title': '書籍'},
+        {'isbn': '12345', 'title': '不正な ISBN'},
+    ]})
+    assert response.status_code == 200
+    body = response.get_json()
+    assert [result['status'] for result in body['results']] == ['added', 'invalid']
+    assert body['results'][1]['error'] == 'ISBN が不正です: 12345'
+    assert body['summary'] == {'added': 1, 'invalid': 1}
+
+    # 取り込みでも同じ行は不正になる
+    assert _to_item({'isbn': '12345', 'title': '不正な ISBN'})[0] is None
@@ -42,10 +42,22 @@ const API = {
 
   // 選書リスト管理
   async getSelectionLists(token) {
-    const response = await fetch(`${API_BASE_URL}/selection-lists`, {
-      headers: { 'Authorization': `Bearer ${token}` },
-    });
-    return response.json();
+    // 一覧はページ単位で返るため、next_cursor をたどって全件を集める
+    const lists = [];
+    let cursor = null;
+    do {
+      const query = cursor ? `?cursor=${encodeURIComponent(cursor)}` : '';
+      const response = await fetch(`${API_BASE_URL}/selection-lists${query}`, {
+        headers: { 'Authorization': `Bearer ${token}` },
+      });
+      const page = await response.json();
+      if (!page.lists) {
+        return page;
+      }
+      lists.push(...page.lists);
+      cursor = page.next_cursor;
+    } while (cursor);
+    return { lists, next_cursor: null };
   },
 
   async createSelectionList(token, listData) {